@@ -1,41 +1,93 @@
+import argparse
+import os
 import pandas as pd
 
 from modules.DatasetCleaning import DatasetCleaning
+from modules.StreamingLoader import StreamingLoader
 from modules.PopulationData import PopulationData
 from modules.AssembleDataset import AssembleDataset
+from modules.DatasetCache import DatasetCache
 from modules.VariablesPreprocessing import DataPreprocessing
 from modules.NormalizeTarget import NormalizeTarget
+from modules.IncrementalPipeline import IncrementalPipeline
+from modules.PanelStore import PanelStore
+from modules.PartitionedPipeline import PartitionedPipeline
+from modules.StageProfiler import StageProfiler
 
 
 # main driver class
 class Main:
-    def main(self):
-        dataset = pd.read_csv("data/Accident_Information.csv", low_memory=False)
-        dc = DatasetCleaning(dataset, "attributes.txt")
-        dc.selectAttributes()
-        dc.reportMissingValues()
-        dc.removeMissingValues()
-        dc.optimizeDatatypes()
-        dc.splitDataset()
+    def main(self, profile=False, trace_memory=False, out_of_core=False, partition_size=500_000):
+        # every stage records its wall time, CPU time, memory and rows to the JSON run report,
+        # cProfile statistics and traced allocations are captured only on request
+        profiler = StageProfiler("reports/Run-report.json", profile=profile, trace_memory=trace_memory)
+        profiler.activate()
+
+        if out_of_core:
+            self.mainOutOfCore(partition_size)
+            profiler.saveReport()
+            profiler.deactivate()
+            return
+
+        # the cleaned dataset is cached in a binary columnar format keyed on the source and attributes files,
+        # so the CSV file is parsed only if any of them changed
+        cache = DatasetCache("data/Accident_Information.csv", "attributes.txt")
+        if cache.isCached():
+            cache.loadDataset()
+            dataset = cache.dataset
+        else:
+            # stream only the selected attributes chunk by chunk, dropping missing values on the way
+            # the loaded dataset is owned by the loader only, so DatasetCleaning does not have to copy it
+            loader = StreamingLoader("data/Accident_Information.csv", "attributes.txt")
+            loader.loadDataset()
+            loader.reportMissingValues()
+            loader.reportMemory()
+            dc = DatasetCleaning(loader.dataset, "attributes.txt", copy=False)
+            # the streamed attributes are already compact, the report of the loader is kept
+            dc.optimizeDatatypes(report_path=None)
+            cache.saveDataset(dc.dataset)
+            dataset = dc.dataset
 
         # print(dc.dataset.dtypes)
         # print("Shapes")
         # print("General dataset shape:", dc.dataset.shape)
         # print("Fragmented dataset shape:", pd.concat(dc.fragmented_dataset).shape)
-        # dc.saveFragmentedDataset("data", "Fragmented_UK_Accidents")
+        # dc.splitDataset(compression="gzip")
+        # dc.saveFragmentedDataset("data", "Fragmented_UK_Accidents", workers=4)
         # assembler = AssembleDataset("Fragmented", "data")
-        # assembler.assembleFromCSVFiles()
+        # assembler.assembleFromManifest("Optimized_Fragmented_UK_Accidents_manifest.json", workers=4)
         # optimized_dataset = assembler.dataset
         # print("Reassembled dataset shape:", optimized_dataset.shape)
         # optimized_dataset.drop(columns=["Unnamed: 0"], inplace=True)
         # print(optimized_dataset.columns)
         # print(optimized_dataset["Local_Authority_(District)"].value_counts())
 
-        dp = DataPreprocessing(dc.dataset, print_progress=True)
-        dp.formatVariables()
-        dp.geoTransform()
-        dp.sjoinDistricts()
-        dp.aggregateDistricts(save=True)
+        # only the years whose records (or the district, recoding or population inputs) changed since the previous
+        # run are processed again, aggregated files of the other years are reused
+        pipeline = IncrementalPipeline("data/cache/pipeline_manifest.json", "data/Local_authorities.shp",
+                                       "attributes.txt", "data/")
+        # the aggregated (year, district) data of all the years is kept in the panel store, if it is missing,
+        # all the years are processed again
+        panel = PanelStore("data/panel/")
+        changed_years = pipeline.compareYears(dataset, "data/", force=not panel.isStored())
+        for year in pipeline.removed_years:
+            if os.path.isfile(f"data/aggregated_{year}.gpkg"):
+                os.remove(f"data/aggregated_{year}.gpkg")
+
+        dummy_classes = None
+        if len(changed_years) > 0:
+            if not pipeline.isFullRun():
+                dataset = dataset.loc[dataset["Year"].isin(changed_years)].copy()
+            dp = DataPreprocessing(dataset, print_progress=True)
+            dp.formatVariables()
+            dp.geoTransform()
+            dp.sjoinDistricts()
+            dp.aggregateDistricts(save=True, dummy_classes=pipeline.manifest["dummy_classes"])
+            dummy_classes = dp.dummy_classes
+            # the changed years replace their previous version in the panel, the removed years are dropped
+            panel.savePanel(dp.aggregated_df, dp.districts, removed_years=pipeline.removed_years)
+        elif len(pipeline.removed_years) > 0:
+            panel.removeYears(pipeline.removed_years)
 
         # TODO
         # as we are not able to upload the Accidents_Information file anyway,
@@ -48,22 +100,75 @@ class Main:
         # TODO
         # Take the average population across these 12 years and normalize casualties counts with it.
 
-        nt = NormalizeTarget("data/", "casualties")
-        population_df = nt.mergePopulationFiles()
-        aggrData, aggCols = nt.aggregateData("geometry", "auth", ["Accident_Index", "Local_Authority_(District)", "year",
-                                                                  "index"])
-        nt.normalize(population_df, aggrData, aggCols)
-        normalized = nt.norm_df
-        print(normalized.columns)
+        if pipeline.normalizationChanged("data/normalized.gpkg"):
+            # the aggregated data of all the years is read from the panel store
+            panel.loadPanel()
+            nt = NormalizeTarget("data/", "casualties", panel=panel)
+            population_df = nt.mergePopulationFiles()
+            aggrData, aggCols = nt.aggregatePanel("geometry", "auth")
+            nt.normalize(population_df, aggrData, aggCols)
+            # per-year, pooled and 3-year rolling rates of all the districts, each in a layer of a single file
+            nt.normalizeRates(windows=(3,))
+            normalized = nt.norm_df
+            print(normalized.columns)
+
+        pipeline.saveManifest(dummy_classes)
+
+        profiler.saveReport()
+        profiler.deactivate()
 
         # population_data = PopulationData("data/population_data.csv", 2005, 2017)
         # population_data.saveAnnualRecords(["laname21", "ladcode21"], "data")
+        # population_data.saveLongRecords(["laname21", "ladcode21"], "data/population.feather")
         # population_data.getPopulationsDataFrames(["laname21", "ladcode21"])
         # dataframes = population_data.population_dataframes
         #print(dataframes[0].head())
 
 
+    def mainOutOfCore(self, partition_size):
+        # the accidents are cleaned, recoded, joined with districts and aggregated partition by partition,
+        # so the accidents of a single partition are held at once (but the concatenated accident indices
+        # of the cells grow with the dataset, see PartitionedPipeline); the outputs are the same as those
+        # of the in-memory path
+        partitioned = PartitionedPipeline("data/Accident_Information.csv", "attributes.txt",
+                                          "data/Local_authorities.shp", "data/", partition_size=partition_size)
+        if partitioned.run(save=True) != 0:
+            return
+        partitioned.reportMissingValues()
+
+        # all the years are aggregated again: the years which are not in the dataset anymore are dropped
+        panel = PanelStore("data/panel/")
+        years = partitioned.aggregated_df.index.get_level_values("year").unique()
+        stored_years = panel.years if (panel.isStored() and (panel.loadPanel() == 0)) else []
+        removed_years = [year for year in stored_years if year not in years]
+        for year in removed_years:
+            if os.path.isfile(f"data/aggregated_{year}.gpkg"):
+                os.remove(f"data/aggregated_{year}.gpkg")
+        panel.savePanel(partitioned.aggregated_df, partitioned.districts, removed_years=removed_years)
+
+        nt = NormalizeTarget("data/", "casualties", panel=panel)
+        population_df = nt.mergePopulationFiles()
+        aggrData, aggCols = nt.aggregatePanel("geometry", "auth")
+        nt.normalize(population_df, aggrData, aggCols)
+        nt.normalizeRates(windows=(3,))
+
+        # the manifest of the incremental runs does not describe these outputs, the next in-memory run is a full one
+        if os.path.isfile("data/cache/pipeline_manifest.json"):
+            os.remove("data/cache/pipeline_manifest.json")
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--profile", action="store_true",
+                        help="capture cProfile statistics of every stage in reports/profiles/")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="trace the peak of Python memory allocations of every stage")
+    parser.add_argument("--out-of-core", action="store_true",
+                        help="process the accidents partition by partition, for datasets larger than memory")
+    parser.add_argument("--partition-size", type=int, default=500_000,
+                        help="number of records of a partition of the out-of-core mode")
+    args = parser.parse_args()
+
     driver = Main()
-    driver.main()
+    driver.main(profile=args.profile, trace_memory=args.trace_memory, out_of_core=args.out_of_core,
+                partition_size=args.partition_size)
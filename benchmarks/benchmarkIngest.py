@@ -0,0 +1,78 @@
+import argparse
+import resource
+import subprocess
+import sys
+import time
+
+import pandas as pd
+
+from modules.DatasetCleaning import DatasetCleaning
+from modules.StreamingLoader import StreamingLoader, NA_VALUES
+
+
+# Peak-RSS benchmark of loading the accidents dataset.
+# Each loading path runs in a separate process, so that the peak resident set size of one path
+# does not hide the other one.
+# Usage (from the repository root):
+#   python -m benchmarks.benchmarkIngest data/Accident_Information.csv
+
+
+def loadLegacy(filename, attributesFile):
+    # the original path: read everything, deep copy, select, drop missing values and downcast
+    # the same missing values as in the streaming loader are used, so that both paths load the same records
+    dataset = pd.read_csv(filename, low_memory=False, keep_default_na=False, na_values=NA_VALUES)
+    dc = DatasetCleaning(dataset, attributesFile)
+    del dataset
+    dc.selectAttributes()
+    dc.removeMissingValues()
+    dc.optimizeDatatypes()
+    return dc.dataset
+
+
+def loadStreaming(filename, attributesFile):
+    loader = StreamingLoader(filename, attributesFile)
+    loader.loadDataset()
+    dc = DatasetCleaning(loader.dataset, attributesFile, copy=False)
+    dc.optimizeDatatypes()
+    return dc.dataset
+
+
+def runPath(path, filename, attributesFile):
+    start = time.perf_counter()
+    if path == "legacy":
+        dataset = loadLegacy(filename, attributesFile)
+    else:
+        dataset = loadStreaming(filename, attributesFile)
+    elapsed = time.perf_counter() - start
+
+    # ru_maxrss is reported in kilobytes on Linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    dataset_mb = dataset.memory_usage(deep=True).sum() / 1_000_000
+    print(f"{path},{elapsed:.2f},{peak_rss_mb:.1f},{dataset_mb:.1f},{dataset.shape[0]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare peak RSS of the legacy and the streaming loader.")
+    parser.add_argument("filename", nargs="?", default="data/Accident_Information.csv")
+    parser.add_argument("--attributes", default="attributes.txt")
+    parser.add_argument("--path", choices=["legacy", "streaming"], default=None,
+                        help="run a single loading path in this process")
+    args = parser.parse_args()
+
+    if args.path is not None:
+        runPath(args.path, args.filename, args.attributes)
+        return
+
+    print(f"{'path':<10} {'time [s]':>10} {'peak RSS [MB]':>14} {'dataset [MB]':>13} {'records':>10}")
+    for path in ["legacy", "streaming"]:
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.benchmarkIngest", args.filename,
+             "--attributes", args.attributes, "--path", path],
+            capture_output=True, text=True, check=True
+        ).stdout.strip().splitlines()[-1]
+        name, elapsed, peak_rss_mb, dataset_mb, records = output.split(",")
+        print(f"{name:<10} {elapsed:>10} {peak_rss_mb:>14} {dataset_mb:>13} {records:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import sys
+
+import numpy as np
+
+from benchmarks.syntheticData import generateAccidents
+from modules.AnalyzeGWR import AnalyzeGWR
+from modules.DatasetCleaning import DatasetCleaning
+from modules.NormalizeTarget import NormalizeTarget
+from modules.StageProfiler import StageProfiler
+from modules.StreamingLoader import StreamingLoader
+from modules.VariablesPreprocessing import DataPreprocessing
+
+
+# Benchmark of the whole pipeline, from loading and cleaning the accidents dataset to the bandwidth selection
+# of the GWR model, on synthetic data of a given scale. Every stage is timed and memory-profiled by StageProfiler
+# and compared with the baseline stored by a previous run of the same scale and seed, so performance regressions
+# (and changed results) are visible run to run. The baseline is stored on the first run (or with --save-baseline).
+# Usage (from the repository root):
+#   python -m benchmarks.benchmarkPipeline --records 1000000
+#   python -m benchmarks.benchmarkPipeline --records 1000000 --save-baseline
+
+
+def runPipeline(filename, workdir, districts_path, attributesFile, population_dir, independent_variables,
+                profiler):
+    """
+    Run all the stages of the pipeline on the given accidents file, writing all the outputs to workdir.
+    :return: dictionary with the results used to check that the outputs did not change
+    """
+    output_dir = os.path.join(workdir, "output", "")
+    if os.path.isdir(output_dir):
+        shutil.rmtree(output_dir)
+    os.makedirs(output_dir)
+    for file in os.listdir(population_dir):
+        if re.compile("population_[0-9]+").match(file):
+            shutil.copy(os.path.join(population_dir, file), output_dir)
+
+    profiler.activate()
+    try:
+        loader = StreamingLoader(filename, attributesFile)
+        loader.loadDataset()
+        dc = DatasetCleaning(loader.dataset, attributesFile, copy=False)
+        dc.optimizeDatatypes()
+        results = {"records_loaded": int(dc.dataset.shape[0])}
+
+        # no district cache, so the spatial join is measured from scratch on every run
+        dp = DataPreprocessing(dc.dataset, districts_path=districts_path, output_dir=output_dir, cache_dir=None)
+        dp.formatVariables()
+        dp.geoTransform()
+        dp.sjoinDistricts()
+        results["records_joined"] = int(dp.accidents_df.shape[0])
+        dp.aggregateDistricts(save=True)
+        del loader, dc, dp
+
+        with profiler.stage("NormalizeTarget.__init__"):
+            nt = NormalizeTarget(output_dir, "casualties")
+        population_df = nt.mergePopulationFiles()
+        aggrData, aggCols = nt.aggregateData("geometry", "auth",
+                                             ["Accident_Index", "Local_Authority_(District)", "year", "index"])
+        nt.normalize(population_df, aggrData, aggCols)
+        results["districts"] = int(nt.norm_df.shape[0])
+        results["casualties"] = round(float(nt.norm_df["casualties"].sum()), 6)
+
+        with profiler.stage("AnalyzeGWR.__init__"):
+            gwr = AnalyzeGWR(output_dir + "normalized.gpkg", ["casualties"], independent_variables)
+        gwr.calibrateRegression()
+        results["bandwidth"] = None if gwr.bandwidth is None else float(np.asarray(gwr.bandwidth).ravel()[0])
+
+    finally:
+        profiler.deactivate()
+
+    return results
+
+
+def compareBaseline(current, baseline, tolerance, min_seconds):
+    """
+    Compare the stages and results of the current run with the baseline.
+    A stage regressed if its wall time grew by more than the tolerance (and by more than min_seconds).
+    :return: tuple (list of regressed stages, list of changed results)
+    """
+    baseline_stages = {stage["stage"]: stage for stage in baseline["stages"]}
+    regressions = []
+
+    print(f"{'stage':45s} {'baseline s':>11s} {'current s':>10s} {'ratio':>7s} {'peak RSS +MB':>13s}")
+    for stage in current["stages"]:
+        previous = baseline_stages.get(stage["stage"])
+        increase = stage["peak_rss_increase_mb"]
+        increase = "" if increase is None else f"{increase:.1f}"
+        if previous is None:
+            print(f"{stage['stage']:45s} {'-':>11s} {stage['wall_time_s']:10.3f} {'new':>7s} {increase:>13s}")
+            continue
+
+        ratio = stage["wall_time_s"] / max(previous["wall_time_s"], 1e-9)
+        regressed = ((ratio > 1 + tolerance) & (stage["wall_time_s"] - previous["wall_time_s"] > min_seconds))
+        if regressed:
+            regressions.append(stage["stage"])
+        print(f"{stage['stage']:45s} {previous['wall_time_s']:11.3f} {stage['wall_time_s']:10.3f} {ratio:7.2f} "
+              f"{increase:>13s}{'  REGRESSION' if regressed else ''}")
+
+    changed = [key for key in baseline["results"] if baseline["results"][key] != current["results"].get(key)]
+    for key in changed:
+        print(f"Result {key} changed: {baseline['results'][key]} (baseline), {current['results'].get(key)} (current)")
+
+    print(f"Total wall time: {baseline['total_wall_time_s']:.3f} s (baseline), "
+          f"{current['total_wall_time_s']:.3f} s (current)")
+    return regressions, changed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every stage of the pipeline on synthetic data.")
+    parser.add_argument("--records", type=int, default=100_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", default="benchmarks/work")
+    parser.add_argument("--baseline-dir", default="benchmarks/baselines")
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the baseline")
+    parser.add_argument("--districts", default="data/Local_authorities.shp")
+    parser.add_argument("--attributes", default="attributes.txt")
+    parser.add_argument("--population-dir", default="data/")
+    parser.add_argument("--independent", nargs="+", default=["weather_1", "speed_2", "urban_1"],
+                        help="independent variables of the GWR model")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative growth of wall time")
+    parser.add_argument("--min-seconds", type=float, default=0.05, help="ignore smaller absolute growth")
+    parser.add_argument("--profile", action="store_true", help="capture cProfile statistics of every stage")
+    parser.add_argument("--trace-memory", action="store_true", help="trace Python allocations of every stage")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.workdir):
+        os.makedirs(args.workdir)
+
+    # the synthetic data depends only on the scale and the seed, so it is generated once
+    filename = os.path.join(args.workdir, f"Synthetic_{args.records}_{args.seed}.csv")
+    if not os.path.isfile(filename):
+        print(f"Generating {args.records} synthetic records")
+        if generateAccidents(filename, args.districts, args.attributes, args.records, args.seed) != 0:
+            sys.exit(-1)
+
+    profiler = StageProfiler(os.path.join(args.workdir, f"Run-report_{args.records}_{args.seed}.json"),
+                             profile=args.profile, trace_memory=args.trace_memory)
+    results = runPipeline(filename, args.workdir, args.districts, args.attributes, args.population_dir,
+                          args.independent, profiler)
+    profiler.saveReport()
+
+    with open(profiler.report_path, 'r') as fh:
+        current = json.load(fh)
+    current.update({"records": args.records, "seed": args.seed, "results": results,
+                    "python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count()})
+
+    baseline_path = os.path.join(args.baseline_dir, f"pipeline_{args.records}_{args.seed}.json")
+    if args.save_baseline or not os.path.isfile(baseline_path):
+        if not os.path.isdir(args.baseline_dir):
+            os.makedirs(args.baseline_dir)
+        with open(baseline_path, 'w') as fh:
+            json.dump(current, fh, indent=2)
+        for stage in current["stages"]:
+            print(f"{stage['stage']:45s} {stage['wall_time_s']:10.3f} s")
+        print(f"Baseline stored: {baseline_path}")
+        return
+
+    with open(baseline_path, 'r') as fh:
+        baseline = json.load(fh)
+    regressions, changed = compareBaseline(current, baseline, args.tolerance, args.min_seconds)
+    if (len(regressions) > 0) | (len(changed) > 0):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import argparse
+import time
+
+import pandas as pd
+
+from modules.DatasetCleaning import DatasetCleaning
+from modules.StreamingLoader import StreamingLoader
+from modules.VariablesPreprocessing import DataPreprocessing, RECODING
+
+
+# Benchmark and equivalence check of DataPreprocessing.formatVariables() against the original implementation
+# based on DataFrame.replace and per-class boolean masks.
+# Usage (from the repository root):
+#   python -m benchmarks.benchmarkRecoding data/Accident_Information.csv
+
+
+def legacyFormatVariables(accidents_df):
+    """
+    The original implementation of DataPreprocessing.formatVariables(), kept as the reference output.
+    """
+    accidents_df.rename(
+        {
+            "1st_Road_Class": "road_class",
+            "Accident_Severity": "severity",
+            "Carriageway_Hazards": "hazards",
+            "Junction_Detail": "junction",
+            "Light_Conditions": "dark",
+            "Number_of_Casualties": "casualties",
+            "Number_of_Vehicles": "vehicles",
+            "Road_Surface_Conditions": "wet",
+            "Road_Type": "road_type",
+            "Special_Conditions_at_Site": "special",
+            "Speed_limit": "speed",
+            "Time": "time",
+            "Urban_or_Rural_Area": "urban",
+            "Weather_Conditions": "weather",
+            "Year": "year"
+        },
+        axis=1, inplace=True
+    )
+    accidents_df.replace(
+        {
+            "road_class": {'A': 0, 'B': 1, 'C': 2, "A(M)": 0, "Motorway": 0, "Unclassified": 3},
+            "severity": {"Slight": 0, "Serious": 1, "Fatal": 2},
+            "hazards": {"None": 0},
+            "junction": {"Not at junction or within 20 metres": 0},
+            "dark": {"Daylight": 0},
+            "wet": {"Dry": 0, "Data missing or out of range": 0},
+            "road_type": {"Single carriageway": 0, "Dual carriageway": 1},
+            "special": {"None": 0},
+            "urban": {"Rural": 0, "Urban": 1, "Unallocated": 1},
+            "weather": {"Fine no high winds": 0, "Unknown": 0, "Data missing or out of range": 0}
+        },
+        inplace=True
+    )
+    accidents_df.loc[accidents_df["hazards"] != 0, "hazards"] = 1
+    accidents_df.loc[accidents_df["junction"] != 0, "junction"] = 1
+    accidents_df.loc[accidents_df["dark"] != 0, "dark"] = 1
+    accidents_df.loc[accidents_df["vehicles"] >= 5, "vehicles"] = 5
+    accidents_df.loc[accidents_df["wet"] != 0, "wet"] = 1
+    accidents_df.loc[(accidents_df["road_type"] != 0) & (accidents_df["road_type"] != 1), "road_type"] = 2
+    accidents_df.loc[accidents_df["special"] != 0, "special"] = 1
+    accidents_df.loc[accidents_df["speed"] <= 30, "speed"] = 0
+    accidents_df.loc[(accidents_df["speed"] > 30) & (accidents_df["speed"] < 60), "speed"] = 1
+    accidents_df.loc[accidents_df["speed"] >= 60, "speed"] = 2
+    accidents_df.loc[accidents_df["weather"] != 0, "weather"] = 1
+    accidents_df.dropna(subset="speed", inplace=True)
+    return accidents_df
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the vectorized recoding against the original one.")
+    parser.add_argument("filename", nargs="?", default="data/Accident_Information.csv")
+    parser.add_argument("--attributes", default="attributes.txt")
+    parser.add_argument("--districts", default="data/Local_authorities.shp")
+    args = parser.parse_args()
+
+    loader = StreamingLoader(args.filename, args.attributes)
+    loader.loadDataset()
+    dc = DatasetCleaning(loader.dataset, args.attributes, copy=False)
+    dc.optimizeDatatypes()
+
+    # the original recoding expects the attributes as Python strings, not categoricals
+    legacy_df = dc.dataset.copy(deep=True)
+    legacy_df = legacy_df.astype({column: "object" for column in legacy_df.columns
+                                  if isinstance(legacy_df[column].dtype, (pd.CategoricalDtype, pd.StringDtype))})
+    start = time.perf_counter()
+    legacy_df = legacyFormatVariables(legacy_df)
+    legacy_time = time.perf_counter() - start
+
+    dp = DataPreprocessing(dc.dataset.copy(deep=True), districts_path=args.districts)
+    start = time.perf_counter()
+    dp.formatVariables()
+    vectorized_time = time.perf_counter() - start
+
+    recoded = list(RECODING.keys())
+    legacy_memory = legacy_df[recoded].memory_usage(deep=True).sum() / 1_000_000
+    vectorized_memory = dp.accidents_df[recoded].memory_usage(deep=True).sum() / 1_000_000
+
+    # the recoded attributes must hold the same codes, only the data type is narrower
+    legacy_df[recoded] = legacy_df[recoded].astype("uint8")
+    vectorized_df = dp.accidents_df.astype({column: "object" for column in dp.accidents_df.columns
+                                            if legacy_df[column].dtype == "object"})
+    pd.testing.assert_frame_equal(vectorized_df, legacy_df)
+
+    print(f"Records: {dp.accidents_df.shape[0]}")
+    print(f"Original recoding:   {legacy_time:.3f} s")
+    print(f"Vectorized recoding: {vectorized_time:.3f} s ({legacy_time / vectorized_time:.1f}x)")
+    print(f"Recoded attributes memory: {legacy_memory:.1f} MB (original), {vectorized_memory:.1f} MB (vectorized)")
+    print("Outputs are equal")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import argparse
+import os
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from mgwr.gwr import GWR
+from mgwr.sel_bw import Sel_BW
+
+from modules.AnalyzeGWR import AnalyzeGWR
+from modules.SparseGWR import SparseGWR
+
+
+# Benchmark of the sparse GWR engine (SparseGWR). At the district scale the selected bandwidth and the fitted
+# model are compared with mgwr (Sel_BW and GWR) on the normalized data. The engine is then fitted on synthetic
+# locations (a jittered grid with spatially varying coefficients) of growing number with a fixed bandwidth, and
+# the wall time and the peak memory (tracemalloc) are reported per location, which should stay roughly constant.
+# Usage (from the repository root):
+#   python -m benchmarks.benchmarkSparseGWR data/normalized.gpkg --sizes 1000 10000 50000 --workers 4
+
+
+def compareMGWR(geopackage, independent_variables, workers):
+    gwr = AnalyzeGWR(geopackage, ["casualties"], independent_variables)
+    coords, y, X = gwr.g_coords, gwr.dependent_variable, gwr.independent_variables
+
+    start = time.perf_counter()
+    bw = Sel_BW(coords, y, X).search()
+    reference = GWR(coords, y, X, bw).fit()
+    mgwr_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    engine = SparseGWR(coords, y, X, workers=workers)
+    sparse_bw = engine.search()
+    results = engine.fit(sparse_bw)
+    sparse_seconds = time.perf_counter() - start
+
+    if sparse_bw != bw:
+        raise RuntimeError("Selected bandwidths differ: %s (mgwr), %s (sparse)" % (bw, sparse_bw))
+    print(f"Districts: {len(y)}, bandwidth: {bw}, mgwr: {mgwr_seconds:.3f} s, sparse: {sparse_seconds:.3f} s")
+    for attribute in ["params", "bse", "tvalues", "predy", "localR2"]:
+        expected, actual = np.asarray(getattr(reference, attribute)), np.asarray(getattr(results, attribute))
+        difference = np.max(np.abs(expected - actual) / (1 + np.abs(expected)))
+        print(f"  {attribute:8s} max relative difference: {difference:.2e}")
+        if difference > 1e-6:
+            raise RuntimeError("Results differ from mgwr: %s" % attribute)
+    print(f"  aicc: {reference.aicc:.6f} (mgwr), {results.aicc:.6f} (sparse)")
+
+
+def syntheticLocations(n, seed):
+    # a jittered grid of locations (1 km apart) with two regressors and coefficients varying over space
+    rng = np.random.default_rng(seed)
+    side = int(np.ceil(np.sqrt(n)))
+    coords = np.column_stack([np.arange(n) % side, np.arange(n) // side]) * 1000.0
+    coords += rng.uniform(-250, 250, size=coords.shape)
+    X = rng.normal(size=(n, 2))
+    u, v = coords[:, 0] / (side * 1000.0), coords[:, 1] / (side * 1000.0)
+    y = 1 + (1 + u) * X[:, 0] + (2 - v) * X[:, 1] + rng.normal(scale=0.5, size=n)
+    return coords, y.reshape(-1, 1), X
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the sparse GWR engine with mgwr and measure its scaling.")
+    parser.add_argument("geopackage", nargs="?", default="data/normalized.gpkg")
+    parser.add_argument("--variables", nargs="+", default=["weather_1", "dark_1"])
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1000, 5000, 20000])
+    parser.add_argument("--bandwidth", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if os.path.isfile(args.geopackage):
+        compareMGWR(args.geopackage, args.variables, args.workers)
+
+    rows = []
+    for n in args.sizes:
+        coords, y, X = syntheticLocations(n, args.seed)
+        tracemalloc.start()
+        start = time.perf_counter()
+        results = SparseGWR(coords, y, X, workers=args.workers).fit(args.bandwidth)
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        rows.append({"locations": n, "bandwidth": args.bandwidth, "seconds": round(seconds, 3),
+                     "peak_mb": round(peak / 2 ** 20, 1), "us_per_location": round(seconds / n * 1e6, 1),
+                     "kb_per_location": round(peak / 2 ** 10 / n, 2), "weights_nnz": results.W.nnz,
+                     "R2": round(results.R2, 4)})
+    print(pd.DataFrame(rows).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import argparse
+import os
+import tempfile
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from libpysal.weights import WSP
+from scipy import sparse
+from spreg import ML_Error, ML_Lag
+
+from modules.SpatialDiagnostics import SpatialDiagnostics, contiguityWeights, rowStandardize
+
+
+# Check of the spatial lag and error models of SpatialDiagnostics against spreg (ML_Lag and ML_Error):
+# the spatial coefficient, the coefficients, their standard errors (and of rho) and the log-likelihood.
+# The models are fitted on a synthetic lattice of square polygons (queen contiguity) with a spatially lagged
+# dependent variable, and on the normalized data if it is present. spreg runs with the "full" method, which uses
+# the weights as they are ("ord" computes tr(W_A'W_A) of the lag model with the symmetrized weights).
+# Differences on the normalized data are reported only: its regressors are ill-conditioned and the bounded
+# search of ML_Error stops at the default xatol (1e-5), short of the maximum of the likelihood.
+# Usage (from the repository root):
+#   python -m benchmarks.benchmarkSpatialDiagnostics data/normalized.gpkg --side 20 --rho 0.5
+
+
+def syntheticLattice(path, side, rho, seed):
+    # side x side square polygons, y = (I - rho W)^-1 (X beta + e) with the row-standardized queen weights
+    rng = np.random.default_rng(seed)
+    columns, rows = np.meshgrid(np.arange(side), np.arange(side))
+    polygons = shapely.box(columns.ravel(), rows.ravel(), columns.ravel() + 1, rows.ravel() + 1)
+    n = len(polygons)
+    weights = rowStandardize(contiguityWeights(polygons, queen=True))
+    X = rng.normal(size=(n, 2))
+    y = np.linalg.solve(np.eye(n) - rho * weights.toarray(), 1 + X @ np.array([2.0, -1.0]) + rng.normal(size=n))
+    frame = gpd.GeoDataFrame({"y": y, "x1": X[:, 0], "x2": X[:, 1]}, geometry=polygons, crs="EPSG:27700")
+    frame.to_file(path, driver="GPKG")
+    return ["x1", "x2"]
+
+
+def compareSpreg(geopackage, dependent_variable, independent_variables, tolerance, check=True):
+    diagnostics = SpatialDiagnostics(geopackage, dependent_variable, independent_variables, cache_dir=None)
+    diagnostics.buildWeights()
+    if (diagnostics.fitLagModel() != 0) or (diagnostics.fitErrorModel() != 0):
+        raise RuntimeError("The spatial models cannot be fitted")
+
+    w = WSP(sparse.csr_matrix(diagnostics.weights)).to_W(silence_warnings=True)
+    y, X = diagnostics.y.reshape(-1, 1), diagnostics.X[:, 1:]
+    references = {"lag": (ML_Lag(y, X, w, method="full"), "rho"),
+                  "error": (ML_Error(y, X, w, method="full"), "lambda")}
+    print(f"{geopackage}: {len(y)} polygons")
+    for model, (reference, coefficient) in references.items():
+        results = diagnostics.results[model]
+        names = ["constant"] + list(independent_variables)
+        # spreg orders the estimates as (betas, spatial coefficient)
+        expected = {"coefficients": np.asarray(reference.betas).ravel()[:len(names)],
+                    "standard_errors": np.asarray(reference.std_err)[:len(names)]}
+        for attribute, values in expected.items():
+            actual = np.array([results[attribute][name] for name in names])
+            difference = np.max(np.abs(values - actual) / (1 + np.abs(values)))
+            print(f"  {model:5s} {attribute:15s} max relative difference: {difference:.2e}")
+            if check and (difference > tolerance):
+                raise RuntimeError("Results differ from spreg: %s %s" % (model, attribute))
+
+        spatial = float(np.asarray(reference.betas).ravel()[-1])
+        llf = float(reference.logll)
+        print(f"  {model:5s} {coefficient}: {results[coefficient]:.6f} (ours), {spatial:.6f} (spreg), "
+              f"log-likelihood: {results['log_likelihood']:.4f} (ours), {llf:.4f} (spreg)")
+        if check and ((abs(results[coefficient] - spatial) > tolerance) or
+                      (abs(results["log_likelihood"] - llf) > 1e-4)):
+            raise RuntimeError("Results differ from spreg: %s" % coefficient)
+        if model == "lag":
+            spatial_error = float(np.asarray(reference.std_err)[-1])
+            print(f"  lag   rho standard error: {results['rho_standard_error']:.6f} (ours), "
+                  f"{spatial_error:.6f} (spreg), p-value: {results['rho_p_value']:.2e}")
+            if check and (abs(results["rho_standard_error"] - spatial_error) > tolerance):
+                raise RuntimeError("Results differ from spreg: standard error of rho")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the spatial lag and error models with spreg.")
+    parser.add_argument("geopackage", nargs="?", default="data/normalized.gpkg")
+    parser.add_argument("--target", default="casualties")
+    parser.add_argument("--variables", nargs="+", default=["weather_1", "dark_1"])
+    parser.add_argument("--side", type=int, default=20)
+    parser.add_argument("--rho", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tolerance", type=float, default=1e-4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "lattice.gpkg")
+        compareSpreg(path, "y", syntheticLattice(path, args.side, args.rho, args.seed), args.tolerance)
+
+    if os.path.isfile(args.geopackage):
+        compareSpreg(args.geopackage, args.target, args.variables, args.tolerance, check=False)
+
+
+if __name__ == "__main__":
+    main()
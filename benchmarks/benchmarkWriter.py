@@ -0,0 +1,92 @@
+import argparse
+import os
+import shutil
+import time
+
+import pandas as pd
+
+from modules.DatasetCleaning import DatasetCleaning
+from modules.GeoPackageWriter import GeoPackageWriter, MODES
+from modules.NormalizeTarget import NormalizeTarget
+from modules.StreamingLoader import StreamingLoader
+from modules.VariablesPreprocessing import DataPreprocessing
+
+
+# Throughput benchmark of writing the yearly aggregated GeoDataFrames: the original loop of GeoDataFrame.to_file()
+# calls against every mode of GeoPackageWriter. The outputs of every mode are read back with NormalizeTarget
+# and compared with the output of the original loop.
+# Usage (from the repository root):
+#   python -m benchmarks.benchmarkWriter data/Accident_Information.csv --workers 4
+
+
+def writeLegacy(frames, years, output_dir):
+    # the original path: one to_file() call per year, one after another
+    start = time.perf_counter()
+    for d, y in zip(frames, years):
+        d.to_file(output_dir + f"aggregated_{y}.gpkg", driver="GPKG")
+    seconds = time.perf_counter() - start
+    size = sum(os.path.getsize(output_dir + f"aggregated_{y}.gpkg") for y in years)
+    return {"mode": "legacy", "workers": 1, "years": len(frames), "records": sum(len(d) for d in frames),
+            "bytes": size, "seconds": round(seconds, 4)}
+
+
+def readBack(output_dir):
+    nt = NormalizeTarget(output_dir, "casualties")
+    aggregated, _ = nt.aggregateData("geometry", "auth", [])
+    # concatenated strings (e.g. Accident_Index) depend on the order of the years read, so only the counts
+    # of districts are compared
+    aggregated = pd.DataFrame(aggregated).set_index("auth").sort_index()
+    return aggregated.select_dtypes("number")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare throughput of writing the aggregated GeoPackages.")
+    parser.add_argument("filename", nargs="?", default="data/Accident_Information.csv")
+    parser.add_argument("--attributes", default="attributes.txt")
+    parser.add_argument("--districts", default="data/Local_authorities.shp")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--work-dir", default="benchmarks/work/writer/")
+    args = parser.parse_args()
+
+    loader = StreamingLoader(args.filename, args.attributes)
+    loader.loadDataset()
+    dc = DatasetCleaning(loader.dataset, args.attributes, copy=False)
+    dc.optimizeDatatypes()
+    dp = DataPreprocessing(dc.dataset, districts_path=args.districts)
+    dp.formatVariables()
+    dp.geoTransform()
+    dp.sjoinDistricts()
+    frames = dp.aggregateDistricts(return_list=True)
+    years = list(dp.aggregated_df.index.get_level_values("year").unique())
+
+    rows = []
+    reference = None
+    for mode in ["legacy"] + MODES:
+        output_dir = os.path.join(args.work_dir, mode) + "/"
+        shutil.rmtree(output_dir, ignore_errors=True)
+        os.makedirs(output_dir)
+        if mode == "legacy":
+            rows.append(writeLegacy(frames, years, output_dir))
+        else:
+            writer = GeoPackageWriter(output_dir, mode=mode, workers=args.workers if mode == "files" else 1)
+            if writer.writeYears(frames, years) != 0:
+                raise RuntimeError("Writing in the %s mode failed" % mode)
+            rows.append(writer.throughput)
+
+        # every mode must give the same data as the original loop
+        data = readBack(output_dir)
+        if reference is None:
+            reference = data
+        else:
+            pd.testing.assert_frame_equal(data, reference)
+
+    results = pd.DataFrame(rows)
+    results["records_per_s"] = (results["records"] / results["seconds"]).round(1)
+    results["mb_per_s"] = (results["bytes"] / 2 ** 20 / results["seconds"]).round(3)
+    results["speedup"] = (results["seconds"].iloc[0] / results["seconds"]).round(2)
+    print(results.to_string(index=False))
+    print("Outputs are equal")
+
+
+if __name__ == "__main__":
+    main()
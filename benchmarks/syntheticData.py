@@ -0,0 +1,204 @@
+import argparse
+import math
+import time
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from pyproj import Transformer
+
+
+# Generator of synthetic UK accident records with the schema of attributes.txt, used by the benchmarks
+# in place of the real Accident_Information.csv (which is too big to be hosted in the repository).
+# Accident locations are sampled inside the local authority polygons, so every record joins a district the same way
+# as a real one. Records are generated and written chunk by chunk, so any scale (100k - 20M records) fits in memory,
+# and every chunk has its own random stream spawned from the seed, so the output depends only on the seed and scale.
+# Usage (from the repository root):
+#   python -m benchmarks.syntheticData data/Synthetic_1000000.csv --records 1000000 --seed 0
+
+
+# Classes of the categorical attributes (with their probabilities), including the ones merged by the recoding
+CLASSES = {
+    "1st_Road_Class": (["A", "B", "C", "A(M)", "Motorway", "Unclassified"],
+                       [0.45, 0.13, 0.08, 0.01, 0.04, 0.29]),
+    "Accident_Severity": (["Slight", "Serious", "Fatal"], [0.85, 0.14, 0.01]),
+    "Carriageway_Hazards": (["None", "Other object on road", "Any animal in carriageway (except ridden horse)",
+                             "Pedestrian in carriageway - not injured", "Previous accident",
+                             "Vehicle load on road", "Data missing or out of range"],
+                            [0.97, 0.01, 0.005, 0.004, 0.004, 0.002, 0.005]),
+    "Junction_Detail": (["Not at junction or within 20 metres", "T or staggered junction", "Crossroads",
+                         "Roundabout", "Private drive or entrance", "Other junction", "Slip road",
+                         "More than 4 arms (not roundabout)", "Mini-roundabout"],
+                        [0.41, 0.31, 0.1, 0.09, 0.035, 0.025, 0.014, 0.011, 0.005]),
+    "Light_Conditions": (["Daylight", "Darkness - lights lit", "Darkness - no lighting",
+                          "Darkness - lighting unknown", "Darkness - lights unlit"],
+                         [0.73, 0.19, 0.06, 0.015, 0.005]),
+    "Road_Surface_Conditions": (["Dry", "Wet or damp", "Frost or ice", "Snow", "Flood over 3cm. deep",
+                                 "Data missing or out of range"],
+                                [0.69, 0.28, 0.02, 0.006, 0.002, 0.002]),
+    "Road_Type": (["Single carriageway", "Dual carriageway", "Roundabout", "One way street", "Slip road",
+                   "Unknown"],
+                  [0.74, 0.15, 0.065, 0.02, 0.01, 0.015]),
+    "Special_Conditions_at_Site": (["None", "Roadworks", "Auto traffic signal - out", "Oil or diesel",
+                                    "Road surface defective", "Mud", "Road sign or marking defective or obscured",
+                                    "Data missing or out of range", "Auto signal part defective"],
+                                   [0.975, 0.012, 0.003, 0.003, 0.002, 0.002, 0.001, 0.001, 0.001]),
+    "Urban_or_Rural_Area": (["Urban", "Rural", "Unallocated"], [0.64, 0.3599, 0.0001]),
+    "Weather_Conditions": (["Fine no high winds", "Raining no high winds", "Other", "Unknown",
+                            "Raining + high winds", "Fine + high winds", "Snowing no high winds", "Fog or mist",
+                            "Snowing + high winds", "Data missing or out of range"],
+                           [0.8, 0.12, 0.02, 0.02, 0.014, 0.013, 0.007, 0.005, 0.001, 0.0]),
+    "Speed_limit": ([20.0, 30.0, 40.0, 50.0, 60.0, 70.0], [0.03, 0.64, 0.08, 0.04, 0.14, 0.07])
+}
+
+# Attributes which may be missing in the real data (filled with empty values at missing_rate)
+MISSING_ATTRIBUTES = ["Latitude", "Longitude", "Speed_limit", "Time"]
+
+
+def readAttributes(attributesFile):
+    with open(attributesFile, 'r') as fh:
+        return [line.strip() for line in fh if line.strip()]
+
+
+def samplePoints(districts, counts, rng, batch=4096):
+    """
+    Sample points uniformly inside the district polygons by rejection from their bounding boxes.
+    :param districts: GeoSeries (or array) of district polygons
+    :param counts: numpy array with the number of points to sample in every district
+    :param rng: numpy random generator
+    :return: tuple of numpy arrays (x, y, district position) ordered by district
+    """
+    geometries = np.asarray(districts)
+    bounds = shapely.bounds(geometries)
+    # share of the bounding box covered by the polygon, to draw enough candidates at once
+    coverage = shapely.area(geometries) / np.maximum((bounds[:, 2] - bounds[:, 0]) * (bounds[:, 3] - bounds[:, 1]),
+                                                     1e-9)
+
+    xs, ys = [], []
+    for position in np.flatnonzero(counts):
+        needed = counts[position]
+        minx, miny, maxx, maxy = bounds[position]
+        shapely.prepare(geometries[position])
+        accepted_x, accepted_y = [], []
+        while needed > 0:
+            size = max(batch, math.ceil(1.2 * needed / max(coverage[position], 0.01)))
+            x = rng.uniform(minx, maxx, size)
+            y = rng.uniform(miny, maxy, size)
+            inside = shapely.contains_xy(geometries[position], x, y)
+            x, y = x[inside][:needed], y[inside][:needed]
+            accepted_x.append(x)
+            accepted_y.append(y)
+            needed -= len(x)
+        xs.append(np.concatenate(accepted_x))
+        ys.append(np.concatenate(accepted_y))
+
+    positions = np.repeat(np.arange(len(counts)), counts)
+    return np.concatenate(xs), np.concatenate(ys), positions
+
+
+def generateChunk(districts, transformer, attributes, n_records, first_record, rng, years=(2005, 2017),
+                  missing_rate=0.001):
+    """
+    Generate a chunk of synthetic accident records.
+    :param districts: GeoDataFrame with district polygons (with LAD21NM names)
+    :param transformer: transformer from the CRS of districts to WGS 84
+    :param attributes: names of attributes of the records (the order of columns)
+    :param n_records: number of records
+    :param first_record: number of the first record (used to keep accident indices unique)
+    :param rng: numpy random generator
+    :param years: the first and the last year of records
+    :param missing_rate: share of missing values in MISSING_ATTRIBUTES
+    :return: DataFrame with the records
+    """
+    # every district gets records, more populated (smaller) districts are not left out by area-proportional sampling
+    counts = rng.multinomial(n_records, np.full(len(districts), 1 / len(districts)))
+    x, y, positions = samplePoints(districts.geometry.values, counts, rng)
+
+    # the records are shuffled, so they are not ordered by district as in the sampling
+    order = rng.permutation(n_records)
+    x, y, positions = x[order], y[order], positions[order]
+    lon, lat = transformer.transform(x, y)
+
+    year = rng.integers(years[0], years[1] + 1, n_records)
+    columns = {
+        "Accident_Index": pd.Series(year.astype(str)).str.cat(
+            pd.Series(np.arange(first_record, first_record + n_records)).map("{:09d}".format)
+        ).to_numpy(),
+        "Latitude": lat,
+        "Longitude": lon,
+        "Local_Authority_(District)": districts["LAD21NM"].to_numpy()[positions],
+        "Number_of_Casualties": 1 + rng.poisson(0.35, n_records),
+        "Number_of_Vehicles": 1 + rng.poisson(0.9, n_records),
+        "Time": pd.Series(rng.integers(0, 24, n_records)).map("{:02d}:".format).str.cat(
+            pd.Series(rng.integers(0, 60, n_records)).map("{:02d}".format)
+        ).to_numpy(),
+        "Year": year
+    }
+    for attribute, (classes, probabilities) in CLASSES.items():
+        probabilities = np.asarray(probabilities) / np.sum(probabilities)
+        columns[attribute] = np.asarray(classes, dtype=object)[rng.choice(len(classes), n_records, p=probabilities)]
+
+    chunk = pd.DataFrame({attribute: columns[attribute] for attribute in attributes})
+    for attribute in MISSING_ATTRIBUTES:
+        if (attribute in chunk.columns) & (missing_rate > 0):
+            chunk.loc[rng.random(n_records) < missing_rate, attribute] = np.nan
+    return chunk
+
+
+def generateAccidents(filename, districts_path="data/Local_authorities.shp", attributesFile="attributes.txt",
+                      n_records=100_000, seed=0, chunksize=1_000_000, years=(2005, 2017), missing_rate=0.001):
+    """
+    Generate a synthetic accidents CSV file with the attributes of attributesFile.
+    :param filename: path of the generated CSV file
+    :param districts_path: path to the districts shapefile
+    :param attributesFile: path to the text file with names of attributes
+    :param n_records: number of records
+    :param seed: seed of the random streams
+    :param chunksize: number of records generated and written at once
+    :param years: the first and the last year of records
+    :param missing_rate: share of missing values in MISSING_ATTRIBUTES
+    :return: status if successful (0) or unsuccessful (-1)
+    """
+    status = -1
+
+    try:
+        districts = gpd.read_file(districts_path)
+        transformer = Transformer.from_crs(districts.crs, "EPSG:4326", always_xy=True)
+        attributes = readAttributes(attributesFile)
+
+        n_chunks = max(1, math.ceil(n_records / chunksize))
+        streams = np.random.SeedSequence(seed).spawn(n_chunks)
+        for i, stream in enumerate(streams):
+            first_record = i * chunksize
+            chunk = generateChunk(districts, transformer, attributes, min(chunksize, n_records - first_record),
+                                  first_record, np.random.default_rng(stream), years, missing_rate)
+            chunk.to_csv(filename, mode='w' if i == 0 else 'a', header=(i == 0), index=False)
+        status = 0
+
+    except Exception as e:
+        print("Error: %s" % e)
+
+    return status
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic UK accident records.")
+    parser.add_argument("filename")
+    parser.add_argument("--records", type=int, default=100_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--districts", default="data/Local_authorities.shp")
+    parser.add_argument("--attributes", default="attributes.txt")
+    parser.add_argument("--chunksize", type=int, default=1_000_000)
+    parser.add_argument("--missing-rate", type=float, default=0.001)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    status = generateAccidents(args.filename, args.districts, args.attributes, args.records, args.seed,
+                               args.chunksize, missing_rate=args.missing_rate)
+    if status == 0:
+        print(f"Generated {args.records} records in {time.perf_counter() - start:.1f} s: {args.filename}")
+
+
+if __name__ == "__main__":
+    main()
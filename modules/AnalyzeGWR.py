@@ -1,33 +1,102 @@
-import geopandas as gpd
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
 from mgwr.gwr import GWR
-from mgwr.sel_bw import Sel_BW
+
+from modules.BandwidthSearch import BandwidthSearch
+from modules.LazyGeoPackage import LazyGeoPackage
+from modules.SparseGWR import SparseGWR
+from modules.StageProfiler import profileStage
+
+
+# State of a worker process of the permutation test, set once by initializeWorker()
+WORKER_STATE = {}
+
+
+def initializeWorker(coords, y, X, bandwidth, sparse=False):
+    """
+    Initializer of a worker process: sorts the distances (or queries the neighbours with SparseGWR) and computes
+    the kernel weights of the bandwidth once per process.
+    """
+    WORKER_STATE["search"] = (SparseGWR if sparse else BandwidthSearch)(coords, y, X)
+    WORKER_STATE["search"].localKernel(bandwidth, keep=True)
+    WORKER_STATE["bandwidth"] = bandwidth
+
+
+def permuteBatch(seed, size):
+    """
+    Task of a worker process: computes the deviations of local coefficients of a batch of permutations.
+    """
+    return permutedDeviations(WORKER_STATE["search"], WORKER_STATE["bandwidth"], seed, size)
+
+
+def permutedDeviations(search, bandwidth, seed, size):
+    """
+    Refit GWR with the observations randomly moved between the locations and get the standard deviations
+    of the local coefficients. The locations (and so the kernel weights) stay the same, only the rows of data
+    are permuted.
+    :param search: BandwidthSearch with the data and the kernel weights of the bandwidth
+    :param bandwidth: the fixed bandwidth of the refits
+    :param seed: SeedSequence of the batch
+    :param size: number of permutations
+    :return: size x k array of standard deviations of local coefficients
+    """
+    rng = np.random.default_rng(seed)
+    deviations = np.empty((size, search.k))
+    for i in range(size):
+        order = rng.permutation(search.n)
+        deviations[i] = search.localCoefficients(bandwidth, search.X[order], search.y[order]).std(axis=0)
+    return deviations
+
 
 class AnalyzeGWR:
-    def __init__(self, geopackage, dependent_variable, independent_variables):
+    def __init__(self, geopackage, dependent_variable, independent_variables, districts=None, sparse=False):
 
-        self.dataset = gpd.read_file(geopackage)
+        # only the target, the regressors and the centroids are read from the GeoPackage
+        self.source = LazyGeoPackage(geopackage)
+        dependent_columns = [dependent_variable] if isinstance(dependent_variable, str) else list(dependent_variable)
+        self.dataset = self.source.read(dependent_columns + [x for x in independent_variables
+                                                             if x not in dependent_columns], geometry=False)
+        self.dependent_columns = dependent_columns
         self.dependent_variable = self.dataset[dependent_variable].values
         self.independent_variables = self.dataset[independent_variables].values
+        self.coefficient_names = ["constant"] + list(independent_variables)
 
-        self.g_coords = []
+        # coordinates of the district centroids (n x 2 array), looked up by the names of districts in the district
+        # cache (DistrictCache) if given, so no geometry is read
+        if (districts is not None) and (districts.load() != 0):
+            districts = None
+        self.g_coords = self.source.centroids(districts=districts)
 
-        for row in zip(self.dataset.geometry.centroid.x, self.dataset.geometry.centroid.y):
-            self.g_coords.append(row)
+        # with sparse, the model is selected and fitted by SparseGWR (adaptive bisquare kernel over the k nearest
+        # neighbours from a KD-tree, for many more locations than districts, e.g. LSOAs or grid cells)
+        self.sparse = sparse
 
         self.selector = None
         self.bandwidth = None
         self.results = None
+        self.permutation_results = None
 
-    def calibrateRegression(self):
+    @profileStage("dataset")
+    def calibrateRegression(self, workers=1):
+        # the bandwidth minimizing AICc is selected by the same golden section search as Sel_BW(...).search(),
+        # but with the distances between centroids sorted once and all local regressions solved in batches,
+        # with more workers both candidate bandwidths of every step are scored at once
+        # the selected bandwidth is reused by fitRegression()
         status = -1
         try:
-            self.selector = Sel_BW(self.g_coords, self.dependent_variable, self.independent_variables)
+            engine = SparseGWR if self.sparse else BandwidthSearch
+            self.selector = engine(self.g_coords, self.dependent_variable, self.independent_variables,
+                                   workers=workers)
             self.bandwidth = self.selector.search(bw_min=2)
             status = 0
         except Exception as e:
             print("Error %s" % e)
         return status
 
+    @profileStage("dataset")
     def fitRegression(self):
 
         status = -1
@@ -36,10 +105,93 @@ class AnalyzeGWR:
             return status
 
         try:
-            self.results = GWR(self.g_coords, self.dependent_variable, self.independent_variables, self.bandwidth).fit()
+            if self.sparse:
+                selector = self.selector if isinstance(self.selector, SparseGWR) else SparseGWR(
+                    self.g_coords, self.dependent_variable, self.independent_variables)
+                self.results = selector.fit(self.bandwidth)
+            else:
+                self.results = GWR(self.g_coords, self.dependent_variable, self.independent_variables,
+                                   self.bandwidth).fit()
+            status = 0
+
+        except Exception as e:
+            print("Error: %s" % e)
+
+        return status
+
+    @profileStage("dataset")
+    def permutationTest(self, permutations=999, batch_size=50, workers=1, seed=0, checkpoint_path=None):
+        """
+        Monte Carlo test of the spatial variability of the local coefficients. The standard deviation of every
+        local coefficient is compared with the deviations after randomly moving the observations between
+        the locations. The refits reuse the selected bandwidth and its kernel weights, so no bandwidth is searched.
+        Permutations are run in batches (in a pool of worker processes with more workers), every batch has its own
+        random stream spawned from the seed, so the results do not depend on the number of workers.
+        Completed batches are saved to the checkpoint file, so an interrupted test continues from them.
+        Sets the permutation_results field to a DataFrame with the p-value of every coefficient.
+        :param permutations: number of permutations
+        :param batch_size: number of permutations of a batch
+        :param workers: number of worker processes
+        :param seed: seed of the permutations
+        :param checkpoint_path: path of the .npz checkpoint file, no checkpoints if None
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+        status = -1
+
+        if (self.bandwidth == None):
+            return status
+
+        try:
+            search = self.selector
+            if search is None:
+                search = (SparseGWR if self.sparse else BandwidthSearch)(self.g_coords, self.dependent_variable,
+                                                                         self.independent_variables)
+            observed = search.localCoefficients(self.bandwidth).std(axis=0)
+
+            n_batches = int(np.ceil(permutations / batch_size))
+            sizes = [min(batch_size, permutations - i * batch_size) for i in range(n_batches)]
+            seeds = np.random.SeedSequence(seed).spawn(n_batches)
+
+            # the checkpoint is valid only for the same data, bandwidth and permutations
+            data_hash = pd.util.hash_array(np.concatenate([search.X.ravel(), search.y])).sum()
+            key = f"{self.bandwidth}-{permutations}-{batch_size}-{seed}-{data_hash}"
+            deviations = np.full((permutations, search.k), np.nan)
+            done = np.zeros(n_batches, dtype=bool)
+            if (checkpoint_path is not None) and os.path.isfile(checkpoint_path):
+                checkpoint = np.load(checkpoint_path)
+                if str(checkpoint["key"]) == key:
+                    deviations, done = checkpoint["deviations"], checkpoint["done"]
+
+            def complete(batch, batch_deviations):
+                deviations[batch * batch_size:batch * batch_size + sizes[batch]] = batch_deviations
+                done[batch] = True
+                if checkpoint_path is not None:
+                    np.savez(checkpoint_path + ".tmp.npz", key=key, deviations=deviations, done=done)
+                    os.replace(checkpoint_path + ".tmp.npz", checkpoint_path)
+
+            remaining = [batch for batch in range(n_batches) if not done[batch]]
+            if (workers > 1) & (len(remaining) > 1):
+                initargs = (self.g_coords, self.dependent_variable, self.independent_variables, self.bandwidth,
+                            self.sparse)
+                with ProcessPoolExecutor(workers, initializer=initializeWorker, initargs=initargs) as executor:
+                    futures = {executor.submit(permuteBatch, seeds[batch], sizes[batch]): batch
+                               for batch in remaining}
+                    for future in as_completed(futures):
+                        complete(futures[future], future.result())
+            else:
+                search.localKernel(self.bandwidth, keep=True)
+                for batch in remaining:
+                    complete(batch, permutedDeviations(search, self.bandwidth, seeds[batch], sizes[batch]))
+
+            self.permutation_results = pd.DataFrame({
+                "coefficient": self.coefficient_names,
+                "observed_sd": observed,
+                "mean_permuted_sd": deviations.mean(axis=0),
+                "p_value": ((deviations >= observed).sum(axis=0) + 1) / (permutations + 1)
+            })
             status = 0
 
         except Exception as e:
             print("Error: %s" % e)
 
-        return status
\ No newline at end of file
+        return status
@@ -1,5 +1,12 @@
+import json
 import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from modules.StreamingLoader import NA_VALUES
 
 class AssembleDataset:
     def __init__(self, pattern, data_directory):
@@ -26,7 +33,7 @@ class AssembleDataset:
             # iterate over the directory passed by the constructor to the class instance looking for
             # CSV files which contain a provided pattern.
             for file in os.listdir(self.directory):
-                if (self.pattern in file):
+                if (self.pattern in file) & (".csv" in file):
                     self.dataset_chunks.append(pd.read_csv(f"{self.directory}/{file}", low_memory=False))
 
             self.dataset = pd.concat(self.dataset_chunks)
@@ -37,4 +44,94 @@ class AssembleDataset:
 
         return status
 
+    def assembleFromManifest(self, manifest_file, workers=1):
+        """
+        A method for assembling chunks of dataset in memory from the CSV files listed in the manifest saved by
+        DatasetCleaning.saveFragmentedDataset(). The files are read concurrently in a pool of threads (the CSV parser
+        releases the GIL), with the data types of attributes from the manifest, and concatenated in the order
+        of records. Compressed files are decompressed according to their suffix.
+        It sets the None field dataset to the assembled dataset before finishing execution.
+
+        :param manifest_file: name of the manifest file in the directory
+        :param workers: number of threads reading the files
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+
+        status = -1
+
+        try:
+            with open(f"{self.directory}/{manifest_file}", 'r') as fh:
+                manifest = json.load(fh)
+
+            # categoricals get the categories of the whole dataset, so they stay categorical after concatenation
+            dtypes = {}
+            for column, datatype in manifest["dtypes"].items():
+                if isinstance(datatype, dict):
+                    dtypes[column] = pd.CategoricalDtype(datatype["categories"])
+                else:
+                    dtypes[column] = datatype
+
+            def readChunk(file):
+                # strings such as "None" are valid categories, only empty fields are missing values
+                return pd.read_csv(f"{self.directory}/{file}", index_col=0, dtype=dtypes, keep_default_na=False,
+                                   na_values=NA_VALUES)
+
+            if workers > 1:
+                with ThreadPoolExecutor(workers) as executor:
+                    self.dataset_chunks = list(executor.map(readChunk, manifest["files"]))
+            else:
+                self.dataset_chunks = [readChunk(file) for file in manifest["files"]]
+
+            self.dataset = pd.concat(self.dataset_chunks)
+            if len(self.dataset) != sum(manifest["rows"]):
+                raise ValueError("the files do not hold the records of the manifest")
+            status = 0
+
+        except Exception as e:
+            print("Error: %s" % e)
+
+        return status
+
+    def assembleFromFeatherFiles(self, columns=None, memory_map=True):
+        """
+        A method for assembling chunks of dataset in memory from separate Feather (Arrow IPC) files.
+        Unlike CSV files, Feather files keep the data types of attributes (including the narrow unsigned integers
+        and categoricals), so no parsing or type conversion is required.
+        The chunks are concatenated in the order of their numeric suffix, e.g. Optimized_dataset_1.feather,
+        Optimized_dataset_2.feather, ...
+        It sets the None field dataset to the assembled dataset before finishing execution.
+
+        :param columns: names of attributes to read, all attributes are read if None. The index is always restored.
+        :param memory_map: whether to memory-map the files instead of reading them to memory at once
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+
+        status = -1
 
+        try:
+            files = [file for file in os.listdir(self.directory)
+                     if (self.pattern in file) & file.endswith(".feather")]
+            files.sort(key=lambda file: int(re.findall("[0-9]+", file)[-1]))
+
+            tables = []
+            for file in files:
+                path = f"{self.directory}/{file}"
+                read_columns = columns
+                if columns is not None:
+                    # the index of the dataframe is stored as additional columns, which must be read as well
+                    schema = pa.ipc.open_file(path).schema
+                    index_columns = [c for c in schema.pandas_metadata["index_columns"] if isinstance(c, str)]
+                    read_columns = list(columns) + [c for c in index_columns if c not in columns]
+                tables.append(feather.read_table(path, columns=read_columns, memory_map=memory_map))
+
+            # the chunks are concatenated as Arrow tables, so the dataframe is built (and categories unified) once
+            self.dataset_chunks = tables
+            # strings (e.g. Accident_Index) stay Arrow strings instead of Python objects
+            string_types = {pa.string(): pd.StringDtype("pyarrow"), pa.large_string(): pd.StringDtype("pyarrow")}
+            self.dataset = pa.concat_tables(tables).to_pandas(types_mapper=string_types.get)
+            status = 0
+
+        except Exception as e:
+            print("Error: %s" % e)
+
+        return status
@@ -0,0 +1,265 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+# Multiplier of the adaptive bandwidth (the distance to the k-th nearest neighbour), the same as in mgwr,
+# so that the k-th neighbour itself gets a non-zero weight
+EPS = 1.0000001
+
+# Constant used to determine the width of the golden section search sections, the same as in mgwr
+DELTA = 0.38197
+
+
+def kernelFunction(kernel, z):
+    """
+    Evaluate a kernel function (as defined in mgwr) on distances divided by the bandwidth.
+    """
+    if kernel == "bisquare":
+        return (1 - z ** 2) ** 2
+    elif kernel == "gaussian":
+        return np.exp(-0.5 * z ** 2)
+    elif kernel == "exponential":
+        return np.exp(-z)
+    raise ValueError("Unsupported kernel function: %s" % kernel)
+
+
+def gaussianAICc(rss, n, tr_S):
+    """
+    AICc of a Gaussian GWR model, as mgwr.diagnostics.get_AICc().
+    :param rss: residual sum of squares
+    :param n: number of observations
+    :param tr_S: trace of the hat matrix
+    """
+    llf = -np.log(rss) * n / 2 - (1 + np.log(np.pi / (n / 2))) * n / 2
+    return -2.0 * llf + 2.0 * n * (tr_S + 1.0) / (n - tr_S - 2.0)
+
+
+def localRegressions(X, y, neighbours, weights, X_local=None):
+    """
+    Solve the weighted least squares of a batch of local regressions over the neighbours of their locations.
+    :param X: independent variables (with the constant) of all the observations
+    :param y: dependent variable of all the observations
+    :param neighbours: b x m array of positions of neighbours of every location of the batch
+    :param weights: b x m array of kernel weights of the neighbours
+    :param X_local: b x k array, if given (XtWX)^-1 X_local is solved as well (for the diagonal of the hat matrix)
+    :return: b x k x 1 array of local coefficients (b x k x 2 with the solution for X_local)
+    """
+    Xn = X[neighbours]
+    XtWX = np.einsum("bm,bmk,bml->bkl", weights, Xn, Xn)
+    rhs = np.einsum("bm,bmk,bm->bk", weights, Xn, y[neighbours])[:, :, None]
+    if X_local is not None:
+        rhs = np.concatenate([rhs, X_local[:, :, None]], axis=2)
+    try:
+        return np.linalg.solve(XtWX, rhs)
+    except np.linalg.LinAlgError:
+        # too few neighbours within a (small fixed) bandwidth
+        return np.linalg.pinv(XtWX) @ rhs
+
+
+class BandwidthSearch:
+    def __init__(self, coords, y, X, kernel="bisquare", fixed=False, constant=True, workers=1, batch_size=128):
+        """
+        A class for selecting the bandwidth of a Gaussian GWR model by minimizing AICc, giving the same bandwidth
+        as mgwr.sel_bw.Sel_BW(coords, y, X).search() with the golden section search.
+        The pairwise distances between observations are computed once and sorted, so every observation has its
+        neighbours ranked by distance. A candidate bandwidth is then scored without rebuilding any kernel:
+        the local regressions of all the observations are solved as batched weighted least squares over their
+        nearest neighbours only (the bisquare kernel is zero beyond the bandwidth), and the scores of evaluated
+        bandwidths are kept, so no bandwidth is fitted twice.
+        :param coords: coordinates of observations (n x 2 array or list of tuples)
+        :param y: dependent variable (n x 1 array)
+        :param X: independent variables without the constant (n x k array)
+        :param kernel: kernel function: "bisquare", "gaussian" or "exponential"
+        :param fixed: True for a fixed (distance) bandwidth, False for an adaptive (nearest neighbours) one
+        :param constant: whether to add the constant (intercept) to the independent variables
+        :param workers: number of threads evaluating the two candidate bandwidths of every search step at once
+        :param batch_size: number of local regressions solved at once
+        """
+        self.coords = np.asarray(coords, dtype="float64")
+        self.y = np.asarray(y, dtype="float64").reshape(-1)
+        X = np.asarray(X, dtype="float64").reshape(len(self.y), -1)
+        self.X = np.hstack([np.ones((len(self.y), 1)), X]) if constant else X
+        self.kernel = kernel
+        self.fixed = fixed
+        self.workers = workers
+        self.batch_size = batch_size
+        self.n, self.k = self.X.shape
+
+        # distances to all the observations sorted for every observation and the positions of its neighbours
+        # (ranks), the first neighbour is the observation itself
+        distances = np.sqrt(((self.coords[:, None, :] - self.coords[None, :, :]) ** 2).sum(axis=2))
+        self.neighbours = np.argsort(distances, axis=1, kind="stable")
+        self.sorted_distances = np.take_along_axis(distances, self.neighbours, axis=1)
+
+        # scores of the evaluated bandwidths, the history of the search (as in Sel_BW) and the kept kernel weights
+        self.scores = {}
+        self.kernels = {}
+        self.sel_hist = []
+        self.bw = None
+
+    def localBandwidths(self, bw):
+        """
+        :return: bandwidth (distance) of every observation
+        """
+        if self.fixed:
+            return np.full(self.n, float(bw))
+        return self.sorted_distances[:, int(bw) - 1] * EPS
+
+    def localKernel(self, bw, keep=False):
+        """
+        A method for computing the kernel weights of the neighbours of every observation. Only the neighbours
+        within the bandwidth are included for the bisquare kernel (the weights of others are zero).
+        :param bw: bandwidth (number of neighbours if adaptive, distance if fixed)
+        :param keep: whether to keep the weights for the following calls (e.g. for refits with the same bandwidth)
+        :return: tuple (positions of neighbours (n x m array), weights (n x m array))
+        """
+        if bw in self.kernels:
+            return self.kernels[bw]
+
+        bandwidths = self.localBandwidths(bw)
+        if self.kernel == "bisquare":
+            m = int((self.sorted_distances < bandwidths[:, None]).sum(axis=1).max())
+        else:
+            m = self.n
+
+        distances = self.sorted_distances[:, :m]
+        weights = kernelFunction(self.kernel, distances / bandwidths[:, None])
+        if self.kernel == "bisquare":
+            weights[distances >= bandwidths[:, None]] = 0
+
+        kernel = (self.neighbours[:, :m], weights)
+        if keep:
+            self.kernels[bw] = kernel
+        return kernel
+
+    def localCoefficients(self, bw, X=None, y=None):
+        """
+        A method for computing the local coefficients of all the observations with the given bandwidth.
+        :param bw: bandwidth (number of neighbours if adaptive, distance if fixed)
+        :param X: independent variables (with the constant) at the locations, the data of the search if None
+        :param y: dependent variable at the locations, the data of the search if None
+        :return: n x k array of local coefficients
+        """
+        X = self.X if X is None else X
+        y = self.y if y is None else y
+        neighbours, weights = self.localKernel(bw)
+        betas = np.empty((self.n, self.k))
+        for start in range(0, self.n, self.batch_size):
+            stop = min(start + self.batch_size, self.n)
+            betas[start:stop] = localRegressions(X, y, neighbours[start:stop], weights[start:stop])[:, :, 0]
+        return betas
+
+    def score(self, bw):
+        """
+        A method for computing AICc of the GWR model with the given bandwidth.
+        :param bw: bandwidth (number of neighbours if adaptive, distance if fixed, np.inf for the global model)
+        :return: AICc
+        """
+        if bw in self.scores:
+            return self.scores[bw]
+
+        if bw == np.inf:
+            # the global (OLS) model
+            betas = np.linalg.lstsq(self.X, self.y, rcond=None)[0]
+            predy = self.X @ betas
+            tr_S = float(self.k)
+        else:
+            neighbours, weights = self.localKernel(bw)
+            predy = np.empty(self.n)
+            influence = np.empty(self.n)
+            for start in range(0, self.n, self.batch_size):
+                stop = min(start + self.batch_size, self.n)
+                Xi = self.X[start:stop]
+
+                # local coefficients and the diagonal of the hat matrix (the own weight is the first one)
+                solved = localRegressions(self.X, self.y, neighbours[start:stop], weights[start:stop], Xi)
+                predy[start:stop] = np.einsum("bk,bk->b", Xi, solved[:, :, 0])
+                influence[start:stop] = np.einsum("bk,bk->b", Xi, solved[:, :, 1]) * weights[start:stop, 0]
+            tr_S = influence.sum()
+
+        aicc = gaussianAICc(np.sum((self.y - predy) ** 2), self.n, tr_S)
+
+        self.scores[bw] = aicc
+        return aicc
+
+    def scoreAll(self, bandwidths, executor):
+        """
+        Score the bandwidths which were not evaluated yet, at once if there is a pool of threads.
+        """
+        missing = [bw for bw in dict.fromkeys(bandwidths) if bw not in self.scores]
+        if (executor is not None) & (len(missing) > 1):
+            for bw, aicc in zip(missing, executor.map(self.score, missing)):
+                self.scores[bw] = aicc
+        return [self.score(bw) for bw in bandwidths]
+
+    def initialSection(self, bw_min=None, bw_max=None):
+        """
+        :return: the initial search section (a, c), as in Sel_BW
+        """
+        if not self.fixed:
+            a = 40 + 2 * self.k
+            c = self.n
+        else:
+            a = self.sorted_distances[:, 1].min() / 2.0
+            c = self.sorted_distances[:, -1].max() * 2.0
+        if bw_min is not None:
+            a = bw_min
+        if (bw_max is not None) and (bw_max is not np.inf):
+            c = bw_max
+        return a, c
+
+    def search(self, bw_min=None, bw_max=None, tol=1.0e-6, max_iter=200):
+        """
+        A method for selecting the bandwidth with the golden section search of mgwr.
+        Both bandwidths of every search step are scored at once if there are more workers.
+        :param bw_min: minimal bandwidth of the search
+        :param bw_max: maximal bandwidth of the search
+        :param tol: tolerance used to determine convergence
+        :param max_iter: maximal number of iterations
+        :return: the selected bandwidth
+        """
+        a, c = self.initialSection(bw_min, bw_max)
+        b = a + DELTA * np.abs(c - a)
+        d = c - DELTA * np.abs(c - a)
+
+        opt_val, opt_score = None, np.inf
+        diff = 1.0e9
+        iters = 0
+        self.sel_hist = []
+
+        executor = ThreadPoolExecutor(self.workers) if self.workers > 1 else None
+        try:
+            while (np.abs(diff) > tol) and (iters < max_iter):
+                iters += 1
+                if not self.fixed:
+                    b = np.round(b)
+                    d = np.round(d)
+
+                score_b, score_d = self.scoreAll([b, d], executor)
+                if score_b <= score_d:
+                    opt_val, opt_score = b, score_b
+                    c = d
+                    d = b
+                    b = a + DELTA * np.abs(c - a)
+                else:
+                    opt_val, opt_score = d, score_d
+                    a = b
+                    b = d
+                    d = c - DELTA * np.abs(c - a)
+
+                opt_val = np.round(opt_val, 2)
+                self.sel_hist.append((opt_val, opt_score))
+                diff = score_b - score_d
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        if bw_max == np.inf:
+            score_ols = self.score(np.inf)
+            self.sel_hist.append((np.inf, score_ols))
+            if score_ols <= opt_score:
+                opt_val, opt_score = np.inf, score_ols
+
+        self.bw = (opt_val, opt_score, self.sel_hist)
+        return opt_val
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import math
+import os
+
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from modules.AssembleDataset import AssembleDataset
+from modules.DatasetCleaning import MAX_FILESIZE
+from modules.StageProfiler import profileStage
+
+
+class DatasetCache:
+    def __init__(self, source_file, attributesFile, directory="data/cache", max_filesize=MAX_FILESIZE):
+        """
+        A class for caching the cleaned, optimized dataset in the binary columnar Feather (Arrow IPC) format.
+        The cache is keyed on the hash of the source CSV file and of the attributes file, so changing any of them
+        invalidates it. The cached dataset keeps the optimized data types and is split into files no bigger than
+        max_filesize, the same limit as the one for the fragmented CSV files.
+        :param source_file: path to the source CSV file with accidents data
+        :param attributesFile: path to the text file with names of attributes selected for the analysis
+        :param directory: directory to store the cached files
+        :param max_filesize: the maximal size of a single cached file in MB
+        """
+        self.source_file = source_file
+        self.attributes_file = attributesFile
+        self.directory = directory
+        self.max_filesize = max_filesize
+        self.manifest_path = f"{self.directory}/manifest.json"
+        self.dataset = None
+
+        self.key = self.computeKey()
+        self.pattern = f"Optimized_{self.key}_"
+
+    def computeKey(self):
+        """
+        A method for computing the cache key from the contents of the source file and the attributes file.
+        The files are hashed in blocks, so the source file is never loaded to memory at once.
+        :return: hexadecimal key of the cache
+        """
+        digest = hashlib.sha256()
+        for path in [self.source_file, self.attributes_file]:
+            with open(path, 'rb') as fh:
+                for block in iter(lambda: fh.read(8 * 1024 * 1024), b""):
+                    digest.update(block)
+        return digest.hexdigest()[:16]
+
+    def isCached(self):
+        """
+        A method for checking whether the dataset for the current source and attributes files is cached.
+        :return: True if all the cached files of the current key exist, False otherwise
+        """
+        if not os.path.isfile(self.manifest_path):
+            return False
+
+        with open(self.manifest_path, 'r') as fh:
+            manifest = json.load(fh)
+
+        if manifest.get("key") != self.key:
+            return False
+
+        for file in manifest["files"]:
+            if not os.path.isfile(f"{self.directory}/{file}"):
+                return False
+        return True
+
+    @profileStage("dataset")
+    def saveDataset(self, dataset):
+        """
+        A method for saving the dataset to the cache. The dataset is converted to an Arrow table once and written
+        as uncompressed Feather files (so that they can be memory-mapped), each of them no bigger than
+        max_filesize. Cached files of other keys are removed.
+        :param dataset: the cleaned dataset with optimized data types
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+        status = -1
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        try:
+            table = pa.Table.from_pandas(dataset, preserve_index=True)
+            max_bytes = self.max_filesize * 1_000_000
+
+            # the size of an uncompressed Feather file is very close to the size of the Arrow table in memory,
+            # if any of the files still exceeds the limit, the table is split into more parts
+            n_parts = max(1, math.ceil(table.nbytes / max_bytes))
+            while True:
+                files = self.writeParts(table, n_parts)
+                if all(os.path.getsize(f"{self.directory}/{file}") < max_bytes for file in files):
+                    break
+                n_parts += 1
+
+            # remove the files of the previous cache keys and all the parts which are not used anymore
+            for file in os.listdir(self.directory):
+                if file.startswith("Optimized_") & file.endswith(".feather") & (file not in files):
+                    os.remove(f"{self.directory}/{file}")
+
+            with open(self.manifest_path, 'w') as fh:
+                json.dump({"key": self.key, "files": files, "records": table.num_rows,
+                           "columns": list(dataset.columns)}, fh, indent=2)
+            status = 0
+
+        except Exception as e:
+            print("Error: %s" % e)
+
+        return status
+
+    def writeParts(self, table, n_parts):
+        """
+        A method for writing the table split into n_parts Feather files.
+        :param table: Arrow table with the dataset
+        :param n_parts: number of files
+        :return: list of names of the written files
+        """
+        files = []
+        part_size = math.ceil(table.num_rows / n_parts)
+        for i in range(n_parts):
+            file = f"{self.pattern}{i + 1}.feather"
+            feather.write_feather(table.slice(i * part_size, part_size), f"{self.directory}/{file}",
+                                  compression="uncompressed")
+            files.append(file)
+        return files
+
+    @profileStage("dataset")
+    def loadDataset(self, columns=None, memory_map=True):
+        """
+        A method for loading the cached dataset. Sets the dataset field to the loaded dataset.
+        :param columns: names of attributes to read, all attributes are read if None
+        :param memory_map: whether to memory-map the cached files
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+        assembler = AssembleDataset(self.pattern, self.directory)
+        status = assembler.assembleFromFeatherFiles(columns, memory_map)
+        self.dataset = assembler.dataset
+        return status
@@ -1,16 +1,244 @@
+import bz2
+import gzip
+import json
+import lzma
 import sys
 import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from modules.StageProfiler import profileStage
+
+# A constant for specifying the maximal file size that can be hosted in a remote repository.
+# The size should be in MB
+MAX_FILESIZE = 100
+
+# Fraction of MAX_FILESIZE planned for a chunk, the rest is a reserve for records longer than those of the sample
+SIZE_MARGIN = 0.95
+
+# Compressions of the fragmented dataset, with the suffixes of the files (from which pandas infers the compression)
+# and the functions compressing the sample of records in planChunks()
+COMPRESSION_EXTENSIONS = {None: "", "gzip": ".gz", "bz2": ".bz2", "xz": ".xz"}
+COMPRESSORS = {None: lambda data: data, "gzip": gzip.compress, "bz2": bz2.compress, "xz": lzma.compress}
+
+# String attributes with at most this ratio of distinct values to records are stored as categoricals,
+# the other string attributes (e.g. Accident_Index, unique for every record) as Arrow strings
+CATEGORY_RATIO = 0.5
+
+# Attributes with the time of day ("HH:MM"), stored as the minute of the day (int16)
+TIME_ATTRIBUTES = ["Time"]
+
+# Geospatial attributes are never converted to integers, only downcast to float32 if it is lossless
+GEO_ATTRIBUTES = ["Latitude", "Longitude"]
+
+
+def optimalUnsignedType(minimal, maximal):
+    """
+    A function for selecting the narrowest unsigned integer data type which can hold values between minimal and
+    maximal (both inclusive).
+    :param minimal: the minimal value of an attribute
+    :param maximal: the maximal value of an attribute
+    :return: name of the data type ("uint8" or "uint16") or None if none of them can hold the values
+    """
+    if ((minimal >= 0) & (maximal < 256)):
+        return "uint8"
+    elif ((minimal >= 0) & (maximal < 65535)):
+        return "uint16"
+    return None
+
+
+def optimalIntegerType(minimal, maximal):
+    """
+    A function for selecting the narrowest integer data type which can hold values between minimal and maximal
+    (both inclusive). Unsigned types are preferred for non-negative values, as in optimalUnsignedType().
+    :return: name of the data type or None if none of them can hold the values
+    """
+    optimal_type = optimalUnsignedType(minimal, maximal)
+    if optimal_type is not None:
+        return optimal_type
+    for datatype in ["int8", "int16", "int32"]:
+        if (minimal >= np.iinfo(datatype).min) & (maximal <= np.iinfo(datatype).max):
+            return datatype
+    return None
+
+
+def minutesOfDay(values):
+    """
+    A function for parsing the time of day ("HH:MM") to the minute of the day. Every distinct time is parsed once.
+    :param values: Series of strings without missing values
+    :return: Series of int16 minutes
+    """
+    codes, times = pd.factorize(values)
+    parts = pd.Series(times).str.split(":", expand=True).astype("int16")
+    minutes = (parts[0] * 60 + parts[1]).to_numpy(dtype="int16")
+    return pd.Series(minutes[codes], index=values.index, name=values.name)
+
+
+def planDatatypes(dataset, category_ratio=CATEGORY_RATIO):
+    """
+    A function for planning the compact data type of every attribute of the dataset:
+        strings - "category" for low-cardinality attributes, "string[pyarrow]" for the others,
+        time of day - "minutes" (the minute of the day as int16, see minutesOfDay()),
+        floats - the narrowest integer type if all the values are integers (apart from geospatial attributes),
+                 "float32" if it holds all the values exactly,
+        integers - the narrowest integer type (signed for negative values).
+    Attributes with missing values keep a type which can hold them and attributes which are already compact
+    (categoricals, Arrow strings) are left out of the plan.
+    :param dataset: DataFrame
+    :param category_ratio: the maximal ratio of distinct values to records of a categorical attribute
+    :return: dictionary of attribute name -> planned data type, only for the attributes to convert
+    """
+    plan = {}
+    for column in dataset.columns:
+        values = dataset[column]
+        datatype = values.dtype
+        if (len(values) == 0) or isinstance(datatype, (pd.CategoricalDtype, pd.StringDtype)):
+            continue
+
+        if datatype == "object":
+            if values.isnull().any():
+                continue
+            if column in TIME_ATTRIBUTES:
+                plan[column] = "minutes"
+            elif values.nunique() <= category_ratio * len(values):
+                plan[column] = "category"
+            else:
+                plan[column] = "string[pyarrow]"
+
+        elif pd.api.types.is_float_dtype(datatype):
+            array = values.to_numpy()
+            if (column not in GEO_ATTRIBUTES) and (not np.isnan(array).any()) and (np.mod(array, 1) == 0).all():
+                optimal_type = optimalIntegerType(array.min(), array.max())
+                if optimal_type is not None:
+                    plan[column] = optimal_type
+            elif (datatype == "float64") and np.array_equal(array.astype("float32").astype("float64"), array,
+                                                            equal_nan=True):
+                plan[column] = "float32"
+
+        elif pd.api.types.is_integer_dtype(datatype):
+            optimal_type = optimalIntegerType(values.min(), values.max())
+            if (optimal_type is not None) and (np.dtype(optimal_type).itemsize < datatype.itemsize):
+                plan[column] = optimal_type
+
+    return plan
+
+
+def applyDatatypePlan(dataset, plan):
+    """
+    A function for converting the attributes of the dataset (in place) according to the plan of planDatatypes().
+    """
+    for column, datatype in plan.items():
+        if datatype == "minutes":
+            dataset[column] = minutesOfDay(dataset[column])
+        else:
+            dataset[column] = dataset[column].astype(datatype)
+    return dataset
+
+
+def writeMemoryReport(before, after, plan, report_path="reports/Memory-report.txt"):
+    """
+    A function for writing the report on memory of the dataset before and after optimizing its data types.
+    :param before: Series of attribute name -> bytes before the optimization
+    :param after: Series of attribute name -> bytes after the optimization
+    :param plan: dictionary of attribute name -> (data type before, data type after)
+    :param report_path: path of the report text file
+    """
+    report_directory = os.path.dirname(report_path)
+    if report_directory and not os.path.isdir(report_directory):
+        os.mkdir(report_directory)
+
+    with open(report_path, 'w') as fh:
+        fh.write("Memory of the dataset (deep):\n")
+        for column in after.index:
+            old_type, new_type = plan[column]
+            fh.write(f"{column} : {old_type} -> {new_type}, "
+                     f"{before[column] / 1_000_000:.3f} MB -> {after[column] / 1_000_000:.3f} MB\n")
+        fh.write(f"Total : {before.sum() / 1_000_000:.3f} MB -> {after.sum() / 1_000_000:.3f} MB "
+                 f"({after.sum() / max(before.sum(), 1):.1%})\n")
+
+
+def planChunks(dataset, max_bytes, compression=None, sample_size=10_000, seed=0):
+    """
+    A function for planning the number of records of a chunk of the dataset, so that every chunk saved to a CSV file
+    is smaller than max_bytes. A random sample of records is serialized (and compressed) as the saved files and its
+    size gives the number of bytes of a record.
+    :param dataset: DataFrame
+    :param max_bytes: the maximal size of a file in bytes
+    :param compression: compression of the files: None, "gzip", "bz2" or "xz"
+    :param sample_size: number of records in the sample
+    :param seed: seed of the sample
+    :return: number of records of a chunk
+    """
+    if len(dataset) == 0:
+        return 1
+    sample = dataset.sample(n=min(sample_size, len(dataset)), random_state=seed)
+    sample_bytes = len(COMPRESSORS[compression](sample.to_csv(header=False).encode()))
+    header_bytes = len(dataset.iloc[:0].to_csv().encode())
+    row_bytes = sample_bytes / len(sample)
+
+    rows = max(1, int((max_bytes * SIZE_MARGIN - header_bytes) / row_bytes))
+    # the records are spread evenly among the chunks, so the last chunk is not much smaller than the others
+    n_chunks = -(-len(dataset) // rows)
+    return -(-len(dataset) // n_chunks)
+
+
+def writeChunk(chunk, path):
+    """
+    Write a chunk of the dataset to a CSV file, compressed according to the suffix of the path.
+    :return: size of the file in bytes
+    """
+    chunk.to_csv(path)
+    return os.path.getsize(path)
+
+
+def writeChunksManifest(path, dataset, files, rows, sizes, compression):
+    """
+    A function for writing the manifest of the chunks of a fragmented dataset: names, numbers of records and sizes
+    of the files in the order of records and the data types of attributes (with the categories of categoricals).
+    """
+    dtypes = {}
+    for column in dataset.columns:
+        datatype = dataset[column].dtype
+        if isinstance(datatype, pd.CategoricalDtype):
+            dtypes[column] = {"categories": datatype.categories.tolist()}
+        elif isinstance(datatype, pd.StringDtype):
+            dtypes[column] = f"string[{datatype.storage}]"
+        else:
+            dtypes[column] = str(datatype)
+
+    with open(path, 'w') as fh:
+        json.dump({"files": files, "rows": [int(r) for r in rows], "bytes": [int(b) for b in sizes],
+                   "compression": compression, "columns": list(dataset.columns), "dtypes": dtypes}, fh, indent=2)
+
+
+def writeMissingValuesReport(missing_values, n_records, report_path="reports/Missing-values-report.txt"):
+    """
+    A function for writing the report on missing values. The generated text file contains frequencies of missing
+    values for each attribute as well as the ratio of missing values to all records.
+    :param missing_values: a dictionary of attribute name -> number of missing values, in the order of attributes
+    :param n_records: number of all records in the dataset
+    :param report_path: path of the report text file
+    """
+    # ensure that the report can be saved to a separate directory for storing workflow reports.
+    report_directory = os.path.dirname(report_path)
+    if report_directory and not os.path.isdir(report_directory):
+        os.mkdir(report_directory)
+
+    with open(report_path, 'w') as fh:
+        fh.write("Missing Values in the dataset:\n")
+        for column, n_nans in missing_values.items():
+            if n_nans > 0:
+                fh.write(
+                    f"[ MISSING VALUES ] {column} : {n_nans}. Ratio to all records: {round(n_nans / n_records, 3)}\n")
+            else:
+                fh.write(f"{column} : {n_nans}\n")
 
-class DatasetCleaning:
-    def __init__(self, dataset, attributesFile):
 
-        # A constant for specifying the maximal file size that can be hosted in a remote repository.
-        # The size should be in MB
-        MAX_FILESIZE = 100
-        # A constant for specifying the maximal number of times the program will attempt to find the optimal
-        # number of splits for dividing the dataset into chunks.
-        # Basically, the maximal number of chunks we seek.
-        MAX_ITER = 10
+class DatasetCleaning:
+    def __init__(self, dataset, attributesFile, copy=True):
 
         # ensure that data
         if not os.path.isdir("data"):
@@ -18,28 +246,23 @@ class DatasetCleaning:
 
         try:
             # deep copy of the dataset so that the warnings can be avoided
-            self.dataset = dataset.copy(deep=True)
+            # a dataset which is already owned by the caller (e.g. loaded with StreamingLoader) does not have to be
+            # copied, which avoids holding the whole dataset twice in memory.
+            if copy:
+                self.dataset = dataset.copy(deep=True)
+            else:
+                self.dataset = dataset
 
             # A field for storing attributes of interest
             # the assumption is that the attributes are stored in a text file and can be loaded during later
             # steps of execution.
             self.attributes = []
 
-            # get the size of the dataframe, as objects weighting more than MAX_FILESIZE cannot
-            # be added to the remote repository.
-            self.dataframe_size_mb = self.dataset.memory_usage().sum() / 1_000_000
-
-            # to keep track on how many pieces the dataset must be split to,
-            # perform a number of trials to determine the optimal number of splits
+            # the number of chunks the dataset must be split to and the number of records of a chunk, planned by
+            # splitDataset() from the measured size of the serialized records, so every file is below MAX_FILESIZE
             self.optimal_splits = -1
-            # run tests to find the optimal number of splits that must be applied to fragment the dataset
-            for i in range(1, MAX_ITER):
-                # check if chunk is smaller than MAX_FILESIZE
-                if (self.dataframe_size_mb / i < MAX_FILESIZE):
-                    # if it is, this is the optimal split
-                    optimum = i
-                    self.optimal_splits = optimum
-                    break
+            self.chunk_rows = None
+            self.compression = None
 
             # read the attributes names which must be included in the analysis
             # this is our selection for this research and should be treated as a
@@ -53,14 +276,18 @@ class DatasetCleaning:
             # they are no bigger than MAX_FILESIZE
             # if the dataset does not have to be fragmented (as we do not care of the file limits), the dataset can be
             # optimized as a whole and saved using saveDataset() method. In such case, methods splitDataset(),
-            # saveFragmentedDataset(), constants MAX_FILESIZE, MAX_ITER and the field optimal_splits are meaningless.
+            # saveFragmentedDataset(), the constant MAX_FILESIZE and the field optimal_splits are meaningless.
             # the field for saving fragmented dataset will be empty list
             self.fragmented_dataset = []
 
+            # data types and memory of attributes before and after optimizeDatatypes()
+            self.memory_report = None
+
         except Exception as e:
             print("Error: %s" % e)
             sys.exit(-1)
 
+    @profileStage("dataset")
     def selectAttributes(self):
         """
         A "void" (in practice returns None) method which overwrites the dataset field with a dataset containing
@@ -68,6 +295,7 @@ class DatasetCleaning:
         """
         self.dataset = self.dataset[self.attributes]
 
+    @profileStage("dataset")
     def reportMissingValues(self):
         """
         A method for generating a report on missing values found in the dataset.
@@ -77,21 +305,12 @@ class DatasetCleaning:
         """
         status = -1
 
-        # ensure that the report can be saved to a separate directory for storing workflow reports.
-        if not os.path.isdir("reports"):
-            os.mkdir("reports")
-
         try:
             # get number of nans per attribute
-            with open("reports/Missing-values-report.txt", 'w') as fh:
-                fh.write("Missing Values in the dataset:\n")
-                for column in self.dataset.columns:
-                    n_nans = self.dataset[column].isnull().sum()
-                    if n_nans > 0:
-                        fh.write(
-                            f"[ MISSING VALUES ] {column} : {n_nans}. Ratio to all records: {round(n_nans / len(self.dataset[column]), 3)}\n")
-                    else:
-                        fh.write(f"{column} : {n_nans}\n")
+            missing_values = {}
+            for column in self.dataset.columns:
+                missing_values[column] = self.dataset[column].isnull().sum()
+            writeMissingValuesReport(missing_values, len(self.dataset))
             status = 0
 
         except Exception as e:
@@ -99,6 +318,7 @@ class DatasetCleaning:
 
         return status
 
+    @profileStage("dataset")
     def removeMissingValues(self):
         """
         A method to tackle the problem of missing values - remove them.
@@ -110,39 +330,38 @@ class DatasetCleaning:
         """
         status = -1
         try:
-            self.dataset.dropna(axis=0, how="any", thresh=None, subset=None, inplace=True)
+            self.dataset.dropna(axis=0, how="any", inplace=True)
             status = 0
         except Exception as e:
             print("Error: %s" % e)
 
         return status
 
-    def optimizeDatatypes(self):
+    @profileStage("dataset")
+    def optimizeDatatypes(self, report_path="reports/Memory-report.txt"):
         """
-        A method for changing the data types of attributes. The method performs conditional tests to determine the
-        range of integers (the assumption is that the dataset contains integers for numeric values) and selects the
-        data type which can hold the values of a certain attribute with minimal memory cost.
+        A method for changing the data types of attributes to the most compact ones, planned by planDatatypes():
+        low-cardinality strings become categoricals, other strings (Accident_Index) Arrow strings, the time of day
+        the minute of the day (int16), integers and integral floats the narrowest (unsigned if possible) integers
+        and other floats float32 where it is lossless. The memory of every attribute before and after the change
+        is written to the report and stored in the memory_report field.
+        :param report_path: path of the memory report, no report is written if None
         :return: status if successful (0) or unsuccessful (-1)
         """
-        # the assumption here is that there are no fractions,
-        # as we have speed limits, number of vehicles, number of casualties
-        # and year - all relatively small integers
         status = -1
 
         try:
-            for column in self.dataset.columns:
-                # do not apply datatype change for geospatial information: longitude and latitude
-                if ((column == "Latitude") | (column == "Longitude")):
-                    continue
-
-                datatype = self.dataset[column].dtypes
-                if datatype != "object":
-                    minimal = self.dataset[column].min()
-                    maximal = self.dataset[column].max()
-                    if ((minimal >= 0) & (maximal < 256)):
-                        self.dataset[column] = self.dataset[column].astype("uint8")
-                    elif ((minimal >= 0) & (maximal < 65535)):
-                        self.dataset[column] = self.dataset[column].astype("uint16")
+            before = self.dataset.memory_usage(index=False, deep=True)
+            old_types = self.dataset.dtypes.astype(str)
+
+            plan = planDatatypes(self.dataset)
+            applyDatatypePlan(self.dataset, plan)
+
+            after = self.dataset.memory_usage(index=False, deep=True)
+            self.memory_report = {column: (old_types[column], str(self.dataset[column].dtype))
+                                  for column in self.dataset.columns}
+            if report_path is not None:
+                writeMemoryReport(before, after, self.memory_report, report_path)
             status = 0
 
         except Exception as e:
@@ -150,37 +369,25 @@ class DatasetCleaning:
 
         return status
 
-    def splitDataset(self):
+    @profileStage("dataset")
+    def splitDataset(self, max_filesize=MAX_FILESIZE, compression=None):
         """
         A method for splitting the dataset into chunks so that each of them can be saved to a separate file
         which does not exceed the specified file size limit.
-        The method replies on optimal_splits field which is determined using a for loop in the constructor - the dataset
-        will be split to the same number of chunks as the optimal_splits number.
+        The number of records of a chunk is planned by planChunks() from the size of a sample of records serialized
+        (and compressed) the same way as the saved files, so it does not depend on the size of the dataset in
+        memory. Sets the optimal_splits and chunk_rows fields.
+        :param max_filesize: the maximal size of a file in MB
+        :param compression: compression of the saved files: None, "gzip", "bz2" or "xz"
         :return: status if successful (0) or unsuccessful (-1)
         """
 
         status = -1
 
-        # The number of splits will be the optimal splits - 1, as the last split should
-        # take all the skipped fractions of the dataset, so the last chunk will contain the records which we
-        # discarded by using int data type for specifying previous split ranges.
-        splits = self.optimal_splits - 1
-
         try:
-            # the size of a single chunk of the dataset
-            one_part_size = int(self.dataset.shape[0] / self.optimal_splits)
-
-            # keeping track of the min and max index to split the dataset
-            lower_boundary = 0
-            upper_boundary = one_part_size
-
-            # split the dataset to the optimal_splits - 1 parts.
-            for i in range(splits):
-                self.fragmented_dataset.append(self.dataset.iloc[lower_boundary:upper_boundary])
-                lower_boundary += one_part_size
-                upper_boundary += one_part_size
-            # The last part which was not included in the for loop must be added so that the dataset is complete
-            self.fragmented_dataset.append(self.dataset.iloc[lower_boundary:])
+            self.compression = compression
+            self.chunk_rows = planChunks(self.dataset, max_filesize * 1_000_000, compression)
+            self.fragmentDataset()
 
             # if all successful, change status to 0 exitcode
             status = 0
@@ -190,6 +397,15 @@ class DatasetCleaning:
 
         return status
 
+    def fragmentDataset(self):
+        """
+        Split the dataset into consecutive chunks of chunk_rows records (the last one may be smaller).
+        """
+        self.fragmented_dataset = [self.dataset.iloc[start:start + self.chunk_rows]
+                                   for start in range(0, self.dataset.shape[0], self.chunk_rows)]
+        self.optimal_splits = len(self.fragmented_dataset)
+
+    @profileStage("dataset")
     def saveDataset(self, directory, filename):
         """
         :param directory: Directory to which the optimized dataset will be saved
@@ -212,11 +428,18 @@ class DatasetCleaning:
 
     # Python does not support method overloading by default, so instead of overloading saveDataset
     # allowing it to take additional parameter of fragmented dataset, another method is created.
-    def saveFragmentedDataset(self, directory, filename):
+    @profileStage("dataset")
+    def saveFragmentedDataset(self, directory, filename, max_filesize=MAX_FILESIZE, workers=1):
         """
-
+        A method for saving the chunks of splitDataset() to CSV files, compressed as planned by splitDataset().
+        The chunks are written concurrently in a pool of worker processes. If any file still exceeds the limit
+        (the size of the sample was not representative), the chunks are made smaller and written again.
+        A manifest with the files, their records and sizes and the data types of attributes is saved as well,
+        so AssembleDataset.assembleFromManifest() can read the files back in parallel with the same data types.
         :param directory: Directory to which the optimized dataset will be saved
         :param filename: Output file's name of the optimized dataset
+        :param max_filesize: the maximal size of a file in MB
+        :param workers: number of worker processes writing the chunks
         :return: status if successful (0) or unsuccessful (-1)
         """
 
@@ -231,10 +454,34 @@ class DatasetCleaning:
         status = -1
 
         try:
-            file_index = 1
-            for dataset_chunk in self.fragmented_dataset:
-                dataset_chunk.to_csv(f"{directory}/Optimized_{filename}_{file_index}.csv")
-                file_index += 1
+            max_bytes = max_filesize * 1_000_000
+            extension = ".csv" + COMPRESSION_EXTENSIONS[self.compression]
+            while True:
+                files = [f"Optimized_{filename}_{i + 1}{extension}" for i in range(len(self.fragmented_dataset))]
+                paths = [f"{directory}/{file}" for file in files]
+                if (workers > 1) & (len(paths) > 1):
+                    with ProcessPoolExecutor(workers) as executor:
+                        sizes = list(executor.map(writeChunk, self.fragmented_dataset, paths))
+                else:
+                    sizes = [writeChunk(chunk, path) for chunk, path in zip(self.fragmented_dataset, paths)]
+                if max(sizes) < max_bytes:
+                    break
+
+                # smaller chunks in proportion to the largest file, at least one record fewer
+                if self.chunk_rows == 1:
+                    raise ValueError("a single record exceeds the file size limit")
+                scaled = int(self.chunk_rows * SIZE_MARGIN * max_bytes / max(sizes))
+                self.chunk_rows = max(1, min(self.chunk_rows - 1, scaled))
+                self.fragmentDataset()
+
+            # remove the chunks of previous runs which are not part of the dataset anymore
+            pattern = re.compile(re.escape(f"Optimized_{filename}_") + r"[0-9]+\.csv")
+            for file in os.listdir(directory):
+                if pattern.match(file) and (file not in files):
+                    os.remove(f"{directory}/{file}")
+
+            writeChunksManifest(f"{directory}/Optimized_{filename}_manifest.json", self.dataset, files,
+                                [len(chunk) for chunk in self.fragmented_dataset], sizes, self.compression)
             status = 0
 
         except Exception as e:
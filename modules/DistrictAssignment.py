@@ -0,0 +1,253 @@
+import hashlib
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+import shapely
+from pyproj import Transformer
+
+
+# State of a worker process of the parallel assignment, set once by initializeWorker()
+WORKER_STATE = {}
+
+
+def initializeWorker(districts_wkb, source_crs, target_crs, shared_names, n_points):
+    """
+    Initializer of a worker process: builds the spatial index and the transformer once per process
+    and attaches the shared coordinate and output arrays (with the projected coordinates, if they are shared).
+    """
+    WORKER_STATE["tree"] = shapely.STRtree(shapely.from_wkb(districts_wkb))
+    WORKER_STATE["transformer"] = Transformer.from_crs(source_crs, target_crs, always_xy=True)
+    WORKER_STATE["memory"] = [shared_memory.SharedMemory(name=name) for name in shared_names]
+    lon, lat, codes = WORKER_STATE["memory"][:3]
+    WORKER_STATE["lon"] = np.ndarray((n_points,), dtype="float64", buffer=lon.buf)
+    WORKER_STATE["lat"] = np.ndarray((n_points,), dtype="float64", buffer=lat.buf)
+    WORKER_STATE["codes"] = np.ndarray((n_points,), dtype="int16", buffer=codes.buf)
+    WORKER_STATE["points"] = None
+    if len(WORKER_STATE["memory"]) > 3:
+        WORKER_STATE["points"] = np.ndarray((n_points, 2), dtype="float64", buffer=WORKER_STATE["memory"][3].buf)
+
+
+def queryPartition(start, stop):
+    """
+    Task of a worker process: reprojects the points of a partition and finds their districts,
+    writing the codes (and the projected coordinates, if they are shared) to the shared output arrays.
+    """
+    x, y = WORKER_STATE["transformer"].transform(WORKER_STATE["lon"][start:stop], WORKER_STATE["lat"][start:stop])
+    WORKER_STATE["codes"][start:stop] = queryTree(WORKER_STATE["tree"], x, y)
+    if WORKER_STATE["points"] is not None:
+        WORKER_STATE["points"][start:stop, 0] = x
+        WORKER_STATE["points"][start:stop, 1] = y
+    return stop - start
+
+
+def queryTree(tree, x, y):
+    """
+    Find the district of every point using the spatial index of districts.
+    If a point lies within more than one district, the district with the lowest code is taken.
+    :param tree: STRtree of district polygons
+    :param x: numpy array of x coordinates (in the CRS of districts)
+    :param y: numpy array of y coordinates (in the CRS of districts)
+    :return: numpy array of int16 district codes, -1 for points outside all the districts
+    """
+    codes = np.full(len(x), -1, dtype="int16")
+    point_positions, district_positions = tree.query(shapely.points(x, y), predicate="within")
+
+    # keep a single district per point: the one with the lowest code
+    order = np.lexsort((district_positions, point_positions))
+    point_positions, district_positions = point_positions[order], district_positions[order]
+    first = np.ones(len(point_positions), dtype=bool)
+    first[1:] = point_positions[1:] != point_positions[:-1]
+    codes[point_positions[first]] = district_positions[first]
+    return codes
+
+
+class DistrictAssignment:
+    def __init__(self, districts, cache_dir=None, batch_size=500_000, workers=1):
+        """
+        A class for assigning points (accidents) to districts (local authorities) they lie within.
+        The spatial index (STRtree) of the district polygons is built once, points are reprojected and queried
+        against it in vectorized batches and every point gets a compact int16 district code - the position of its
+        district in the districts dataset (-1 if the point is outside all the districts).
+        The codes can be persisted in the cache directory, keyed by the accident index, so the accidents which
+        were already assigned (and did not change their coordinates) are never queried again.
+        With more than one worker, the points are partitioned spatially and processed in a pool of processes,
+        which read the coordinates from shared memory. The codes are the same as in the serial mode.
+        :param districts: GeoDataFrame with district polygons
+        :param cache_dir: directory to persist the assigned codes, nothing is persisted if None
+        :param batch_size: number of points queried at once
+        :param workers: number of worker processes
+        """
+        self.districts = districts
+        self.cache_dir = cache_dir
+        self.batch_size = batch_size
+        self.workers = workers
+
+        # the spatial index of district polygons
+        self.tree = shapely.STRtree(self.districts.geometry.values)
+
+        # the cache is valid only for the same district polygons, so they are a part of the cache file name
+        digest = hashlib.sha256()
+        for geometry in shapely.to_wkb(self.districts.geometry.values):
+            digest.update(geometry)
+        self.districts_key = digest.hexdigest()[:16]
+
+        self.cache_path = None
+        if self.cache_dir is not None:
+            self.cache_path = os.path.join(self.cache_dir, f"district_assignment_{self.districts_key}.feather")
+
+    def queryDistricts(self, lon, lat, crs, return_points=False):
+        """
+        A method for reprojecting points to the CRS of districts and finding their districts.
+        :param lon: numpy array of x coordinates (longitudes) of points
+        :param lat: numpy array of y coordinates (latitudes) of points
+        :param crs: CRS of the coordinates of points
+        :param return_points: whether to return the projected coordinates of points as well
+        :return: numpy array of int16 district codes, -1 for points outside all the districts
+        (and n x 2 array of the projected coordinates if return_points)
+        """
+        if (self.workers > 1) & (len(lon) > self.batch_size):
+            return self.queryDistrictsParallel(lon, lat, crs, return_points)
+
+        transformer = Transformer.from_crs(crs, self.districts.crs, always_xy=True)
+        codes = np.full(len(lon), -1, dtype="int16")
+        points = np.empty((len(lon), 2)) if return_points else None
+        for start in range(0, len(lon), self.batch_size):
+            x, y = transformer.transform(lon[start:start + self.batch_size], lat[start:start + self.batch_size])
+            codes[start:start + self.batch_size] = queryTree(self.tree, x, y)
+            if return_points:
+                points[start:start + self.batch_size, 0] = x
+                points[start:start + self.batch_size, 1] = y
+        return (codes, points) if return_points else codes
+
+    def projectPoints(self, lon, lat, crs):
+        """
+        A method for reprojecting points to the CRS of districts in batches, without finding their districts.
+        :return: n x 2 array of the projected coordinates
+        """
+        transformer = Transformer.from_crs(crs, self.districts.crs, always_xy=True)
+        points = np.empty((len(lon), 2))
+        for start in range(0, len(lon), self.batch_size):
+            x, y = transformer.transform(lon[start:start + self.batch_size], lat[start:start + self.batch_size])
+            points[start:start + self.batch_size, 0] = x
+            points[start:start + self.batch_size, 1] = y
+        return points
+
+    def queryDistrictsParallel(self, lon, lat, crs, return_points=False):
+        """
+        A method for reprojecting and assigning points in a pool of worker processes.
+        The points are sorted by the cells of a regular grid over their extent, so every partition covers a compact
+        area and queries only a small part of the spatial index. The sorted coordinates are placed in shared memory
+        and every worker processes contiguous ranges of them. The codes are written back in the original order.
+        :param lon: numpy array of x coordinates (longitudes) of points
+        :param lat: numpy array of y coordinates (latitudes) of points
+        :param crs: CRS of the coordinates of points
+        :param return_points: whether to return the projected coordinates of points as well
+        :return: numpy array of int16 district codes, -1 for points outside all the districts
+        (and n x 2 array of the projected coordinates if return_points)
+        """
+        n_points = len(lon)
+
+        # spatial partitioning: sort points by the cell of a grid with a few cells per partition
+        n_cells = math.ceil(math.sqrt(4 * self.workers))
+        cell_x = np.floor((lon - lon.min()) / max(np.ptp(lon), 1e-9) * (n_cells - 1e-9)).astype("int64")
+        cell_y = np.floor((lat - lat.min()) / max(np.ptp(lat), 1e-9) * (n_cells - 1e-9)).astype("int64")
+        order = np.argsort(cell_y * n_cells + cell_x, kind="stable")
+
+        memory = [shared_memory.SharedMemory(create=True, size=n_points * 8),
+                  shared_memory.SharedMemory(create=True, size=n_points * 8),
+                  shared_memory.SharedMemory(create=True, size=n_points * 2)]
+        if return_points:
+            memory.append(shared_memory.SharedMemory(create=True, size=n_points * 16))
+        try:
+            np.ndarray((n_points,), dtype="float64", buffer=memory[0].buf)[:] = lon[order]
+            np.ndarray((n_points,), dtype="float64", buffer=memory[1].buf)[:] = lat[order]
+            shared_codes = np.ndarray((n_points,), dtype="int16", buffer=memory[2].buf)
+
+            # contiguous ranges of sorted points, a few per worker to balance the load
+            bounds = np.linspace(0, n_points, 4 * self.workers + 1).astype("int64")
+            initargs = (shapely.to_wkb(self.districts.geometry.values), crs, self.districts.crs,
+                        [m.name for m in memory], n_points)
+            with ProcessPoolExecutor(self.workers, initializer=initializeWorker, initargs=initargs) as executor:
+                list(executor.map(queryPartition, bounds[:-1], bounds[1:]))
+
+            codes = np.empty(n_points, dtype="int16")
+            codes[order] = shared_codes
+            del shared_codes
+            points = None
+            if return_points:
+                points = np.empty((n_points, 2))
+                points[order] = np.ndarray((n_points, 2), dtype="float64", buffer=memory[3].buf)
+        finally:
+            for m in memory:
+                m.close()
+                m.unlink()
+
+        return (codes, points) if return_points else codes
+
+    def assignDistricts(self, keys, lon, lat, crs, return_points=False):
+        """
+        A method for assigning districts to accidents. Accidents found in the cache with the same coordinates
+        reuse their cached codes, only the new or moved ones are reprojected and queried.
+        The cache is updated afterwards.
+        The projected coordinates are returned on request only: the queried accidents keep the coordinates
+        reprojected for the query, the cached ones are reprojected without querying.
+        :param keys: numpy array of accident indices
+        :param lon: numpy array of x coordinates (longitudes) of accidents
+        :param lat: numpy array of y coordinates (latitudes) of accidents
+        :param crs: CRS of the coordinates of accidents
+        :param return_points: whether to return the projected coordinates of accidents as well
+        :return: numpy array of int16 district codes, -1 for points outside all the districts
+        (and n x 2 array of the projected coordinates if return_points)
+        """
+        if self.cache_path is None:
+            return self.queryDistricts(lon, lat, crs, return_points)
+
+        codes = np.full(len(keys), -1, dtype="int16")
+        points = np.empty((len(keys), 2)) if return_points else None
+        to_query = np.ones(len(keys), dtype=bool)
+
+        cache = None
+        if os.path.isfile(self.cache_path):
+            cache = pd.read_feather(self.cache_path)
+            # caches without the source coordinates cannot be validated
+            if not {"Accident_Index", "lon", "lat", "district"}.issubset(cache.columns):
+                cache = None
+
+        if cache is not None:
+            positions = pd.Index(cache["Accident_Index"]).get_indexer(keys)
+            known = positions >= 0
+            cached = cache.iloc[positions[known]]
+            unchanged = (cached["lon"].to_numpy() == lon[known]) & (cached["lat"].to_numpy() == lat[known])
+            known[known] = unchanged
+            codes[known] = cache["district"].to_numpy()[positions[known]]
+            to_query = ~known
+
+        if return_points and (~to_query).any():
+            points[~to_query] = self.projectPoints(lon[~to_query], lat[~to_query], crs)
+
+        if to_query.any():
+            if return_points:
+                codes[to_query], points[to_query] = self.queryDistricts(lon[to_query], lat[to_query], crs, True)
+            else:
+                codes[to_query] = self.queryDistricts(lon[to_query], lat[to_query], crs)
+
+            # persist the new assignments, replacing the old ones of the same accidents
+            update = pd.DataFrame({"Accident_Index": keys[to_query], "lon": lon[to_query], "lat": lat[to_query],
+                                   "district": codes[to_query]})
+            if cache is not None:
+                update = pd.concat([cache, update], ignore_index=True)
+            update.drop_duplicates(subset="Accident_Index", keep="last", inplace=True)
+
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            # remove the caches of other district polygons
+            for file in os.listdir(self.cache_dir):
+                if file.startswith("district_assignment_") & (os.path.join(self.cache_dir, file) != self.cache_path):
+                    os.remove(os.path.join(self.cache_dir, file))
+            update.reset_index(drop=True).to_feather(self.cache_path)
+
+        return (codes, points) if return_points else codes
@@ -0,0 +1,233 @@
+import hashlib
+import json
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from pyproj import CRS
+
+from modules.StageProfiler import profileStage
+
+
+# Simplified variants of the district polygons: name -> tolerance in the units of the CRS of districts
+# (metres of EPSG:27700). The full geometry is the "full" variant and is never simplified.
+SIMPLIFY_TOLERANCES = {"medium": 100.0, "coarse": 500.0}
+
+
+def simplifyCoverage(geometry, tolerance):
+    """
+    Simplify polygons which cover an area without overlaps (a coverage, e.g. districts). Shared boundaries are
+    simplified once, so neighbouring districts stay adjacent without gaps or overlaps. Older versions of shapely
+    (without coverage_simplify) simplify every polygon on its own, preserving its topology only.
+    :param geometry: numpy array of polygons
+    :param tolerance: tolerance of the simplification
+    :return: numpy array of simplified polygons
+    """
+    if hasattr(shapely, "coverage_simplify"):
+        return shapely.coverage_simplify(geometry, tolerance)
+    return shapely.simplify(geometry, tolerance, preserve_topology=True)
+
+
+class DistrictCache:
+    def __init__(self, shapefile="data/Local_authorities.shp", directory="data/cache/districts/",
+                 tolerances=None, name_attr="LAD21NM"):
+        """
+        A class for caching the districts (local authorities) built once from the shapefile, so the shapefile
+        is not parsed by every stage. The cache holds, in the order of the shapefile:
+            district_id - a stable integer ID of every district, its position in the shapefile (the same as
+                          the district codes of DistrictAssignment and the positions of PanelStore),
+            the attributes of districts,
+            the full geometry (WKB), used for joins,
+            simplified variants of the geometry (WKB), for outputs and plotting,
+            the centroids of the full geometry.
+        The cache is keyed on the hash of the files of the shapefile and the tolerances, so changing any of them
+        rebuilds it. Geometry of a variant is decoded only when it is used.
+        Files of the cache:
+            districts_{key}.feather - the IDs, attributes, WKB of all the variants and centroids,
+            districts_{key}.json - CRS, variants and name attribute.
+        :param shapefile: path to the shapefile with districts
+        :param directory: directory of the cache, nothing is persisted if None
+        :param tolerances: simplified variants (name -> tolerance), SIMPLIFY_TOLERANCES if None
+        :param name_attr: attribute with the names of districts
+        """
+        self.shapefile = shapefile
+        self.directory = directory
+        self.tolerances = dict(SIMPLIFY_TOLERANCES if tolerances is None else tolerances)
+        self.name_attr = name_attr
+
+        self.key = self.computeKey()
+        self.data_path, self.meta_path = None, None
+        if self.directory is not None:
+            self.data_path = os.path.join(self.directory, f"districts_{self.key}.feather")
+            self.meta_path = os.path.join(self.directory, f"districts_{self.key}.json")
+
+        # set by load()
+        self.table = None
+        self.meta = None
+        self.crs = None
+        self.centroid_coords = None
+        self.geometries = {}
+        self.frames = {}
+
+    @property
+    def variants(self):
+        return ["full"] + list(self.tolerances)
+
+    def computeKey(self):
+        """
+        A method for computing the cache key from the files of the shapefile (.shp, .shx, .dbf, .prj, ...)
+        and the tolerances of the simplified variants.
+        :return: hexadecimal key of the cache
+        """
+        directory, filename = os.path.split(self.shapefile)
+        name = os.path.splitext(filename)[0]
+        parts = sorted(os.path.join(directory, x) for x in os.listdir(directory or ".")
+                       if os.path.splitext(x)[0] == name)
+
+        digest = hashlib.sha256(json.dumps(self.tolerances, sort_keys=True).encode())
+        for path in parts:
+            with open(path, 'rb') as fh:
+                for block in iter(lambda: fh.read(8 * 1024 * 1024), b""):
+                    digest.update(block)
+        return digest.hexdigest()[:16]
+
+    def isCached(self):
+        """
+        :return: True if the cache of the current shapefile and tolerances exists
+        """
+        return (self.directory is not None) and os.path.isfile(self.data_path) and os.path.isfile(self.meta_path)
+
+    @profileStage()
+    def build(self):
+        """
+        A method for building the cache from the shapefile: simplified variants and centroids are computed
+        and everything is persisted to the cache directory (if any). Caches of other keys are removed.
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+        status = -1
+
+        try:
+            districts = gpd.read_file(self.shapefile)
+            geometry = districts.geometry.values
+            centroids = shapely.centroid(geometry)
+
+            table = pd.DataFrame(districts.drop(columns=districts.geometry.name))
+            table.insert(0, "district_id", np.arange(len(districts), dtype="int32"))
+            table["geometry"] = shapely.to_wkb(geometry)
+            for variant, tolerance in self.tolerances.items():
+                table[f"geometry_{variant}"] = shapely.to_wkb(simplifyCoverage(geometry, tolerance))
+            table["centroid_x"] = shapely.get_x(centroids)
+            table["centroid_y"] = shapely.get_y(centroids)
+            meta = {"key": self.key, "crs": districts.crs.to_wkt(), "variants": self.variants,
+                    "tolerances": self.tolerances, "name_attr": self.name_attr,
+                    "geometry_name": districts.geometry.name}
+
+            if self.directory is not None:
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                table.to_feather(self.data_path + ".tmp")
+                os.replace(self.data_path + ".tmp", self.data_path)
+                with open(self.meta_path, 'w') as fh:
+                    json.dump(meta, fh, indent=2)
+
+                # remove the caches of other shapefiles or tolerances
+                for file in os.listdir(self.directory):
+                    path = os.path.join(self.directory, file)
+                    if file.startswith("districts_") and (path not in [self.data_path, self.meta_path]):
+                        os.remove(path)
+
+            self.setTable(table, meta)
+            status = 0
+
+        except Exception as e:
+            print("Error: %s" % e)
+
+        return status
+
+    def load(self):
+        """
+        A method for loading the cache, built first if it does not exist. Nothing is done if it is loaded.
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+        status = -1
+
+        try:
+            if self.table is not None:
+                status = 0
+            elif self.isCached():
+                with open(self.meta_path, 'r') as fh:
+                    meta = json.load(fh)
+                self.setTable(pd.read_feather(self.data_path), meta)
+                status = 0
+            else:
+                status = self.build()
+
+        except Exception as e:
+            print("Error: %s" % e)
+
+        return status
+
+    def setTable(self, table, meta):
+        self.table = table
+        self.meta = meta
+        self.crs = CRS.from_wkt(meta["crs"])
+        self.centroid_coords = table[["centroid_x", "centroid_y"]].to_numpy(dtype="float64")
+        self.geometries, self.frames = {}, {}
+
+    def geometryValues(self, variant="full"):
+        """
+        :param variant: "full" or a name of a simplified variant
+        :return: GeometryArray of all the districts, decoded once; the full geometry is prepared for joins
+        """
+        if variant not in self.variants:
+            raise ValueError("Unsupported variant: %s" % variant)
+        if variant not in self.geometries:
+            geometry = shapely.from_wkb(self.table["geometry" if variant == "full" else f"geometry_{variant}"])
+            if variant == "full":
+                shapely.prepare(geometry)
+            self.geometries[variant] = gpd.array.from_shapely(geometry, crs=self.crs)
+        return self.geometries[variant]
+
+    def ids(self, districts=None):
+        """
+        :param districts: None (all the districts) or a list of district names or IDs
+        :return: numpy array of district IDs
+        """
+        if districts is None:
+            return self.table["district_id"].to_numpy()
+        names = pd.Index(self.table[self.name_attr])
+        return np.array([d if isinstance(d, (int, np.integer)) else names.get_loc(d) for d in districts],
+                        dtype="int64")
+
+    def geometry(self, districts=None, variant="full"):
+        """
+        :param districts: None (all the districts) or a list of district names or IDs
+        :param variant: "full" or a name of a simplified variant
+        :return: GeoSeries with the geometry of the districts, indexed by their IDs
+        """
+        ids = self.ids(districts)
+        return gpd.GeoSeries(self.geometryValues(variant).take(ids), index=ids, crs=self.crs)
+
+    def centroids(self, districts=None):
+        """
+        :param districts: None (all the districts) or a list of district names or IDs
+        :return: n x 2 float64 array of coordinates of the centroids of the full geometry
+        """
+        return self.centroid_coords[self.ids(districts)]
+
+    def districts(self, variant="full"):
+        """
+        A method for getting the districts as read from the shapefile: the attributes and the geometry
+        of a variant, indexed by the district IDs. The GeoDataFrame is built once per variant.
+        :param variant: "full" or a name of a simplified variant
+        :return: GeoDataFrame of all the districts
+        """
+        if variant not in self.frames:
+            attributes = [x for x in self.table.columns if (x != "district_id") and (not x.startswith("geometry"))
+                          and (x not in ["centroid_x", "centroid_y"])]
+            frame = pd.DataFrame(self.table[attributes])
+            frame[self.meta["geometry_name"]] = self.geometryValues(variant)
+            self.frames[variant] = gpd.GeoDataFrame(frame, geometry=self.meta["geometry_name"], crs=self.crs)
+        return self.frames[variant]
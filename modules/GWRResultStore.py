@@ -0,0 +1,259 @@
+import json
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+from modules.GeoPackageWriter import writeFrame
+from modules.LazyGeoPackage import LazyGeoPackage
+from modules.StageProfiler import profileStage
+
+
+# What-if modes of the changed regressor values: the new values are set, shifted by or scaled by the given values
+WHAT_IF_MODES = ["set", "shift", "scale"]
+
+
+class GWRResultStore:
+    def __init__(self, path="reports/GWR-results.npz"):
+        """
+        A class for persisting a fitted GWR model and predicting from it without refitting.
+        The model is stored in a single compressed NumPy file: local coefficients, their standard errors and
+        t-values, the design matrix (with the constant), the dependent variable, the coordinate set, the names
+        of districts and the metadata (bandwidth, kernel, fixed or adaptive, names of coefficients, the critical
+        t-value, AICc and R2, the source GeoPackage). Loading it takes milliseconds.
+        Predictions are local linear predictors X_i * beta_i evaluated for all the districts at once, so any number
+        of what-if scenarios (changed regressor values) is a single batched product.
+        :param path: path of the .npz file
+        """
+        self.path = path
+
+        # set by storeResults() or loadResults()
+        self.params = None
+        self.bse = None
+        self.tvalues = None
+        self.X = None
+        self.y = None
+        self.coords = None
+        self.districts = None
+        self.meta = None
+
+    @property
+    def coefficient_names(self):
+        return self.meta["coefficient_names"]
+
+    @property
+    def variable_names(self):
+        # names of the regressors, without the constant
+        return self.coefficient_names[1:]
+
+    @profileStage()
+    def storeResults(self, gwr, group_attr="auth"):
+        """
+        A method for storing the fitted model of AnalyzeGWR (after fitRegression()) and saving it to the file.
+        :param gwr: AnalyzeGWR object with the results field set
+        :param group_attr: attribute of the source GeoPackage with the names of districts
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+        status = -1
+
+        try:
+            results = gwr.results
+            self.params = np.asarray(results.params, dtype="float64")
+            self.bse = np.asarray(results.bse, dtype="float64")
+            self.tvalues = np.asarray(results.tvalues, dtype="float64")
+            self.X = np.asarray(results.model.X, dtype="float64")
+            self.y = np.asarray(results.model.y, dtype="float64").ravel()
+            self.coords = np.asarray(gwr.g_coords, dtype="float64")
+
+            # names of districts in the order of the observations, if the source has them
+            self.districts = None
+            if group_attr in gwr.source.columns():
+                self.districts = np.asarray(gwr.source[group_attr], dtype=str)
+
+            self.meta = {
+                "bandwidth": float(results.model.bw),
+                "kernel": results.model.kernel,
+                "fixed": bool(results.model.fixed),
+                "dependent_variable": gwr.dependent_columns[0],
+                "coefficient_names": list(gwr.coefficient_names),
+                "critical_tval": float(results.critical_tval()),
+                "aicc": float(results.aicc),
+                "R2": float(results.R2),
+                "source": gwr.source.path,
+                "group_attr": group_attr
+            }
+            status = self.saveResults()
+
+        except Exception as e:
+            print("Error: %s" % e)
+
+        return status
+
+    def saveResults(self):
+        """
+        A method for saving the stored model to the .npz file (replaced atomically).
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+        status = -1
+
+        try:
+            directory = os.path.dirname(self.path)
+            if directory and (not os.path.isdir(directory)):
+                os.makedirs(directory)
+            arrays = {"params": self.params, "bse": self.bse, "tvalues": self.tvalues, "X": self.X, "y": self.y,
+                      "coords": self.coords, "meta": np.array(json.dumps(self.meta))}
+            if self.districts is not None:
+                arrays["districts"] = self.districts
+            np.savez_compressed(self.path + ".tmp.npz", **arrays)
+            os.replace(self.path + ".tmp.npz", self.path)
+            status = 0
+
+        except Exception as e:
+            print("Error: %s" % e)
+
+        return status
+
+    def loadResults(self):
+        """
+        A method for loading the model from the .npz file.
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+        status = -1
+
+        try:
+            with np.load(self.path) as stored:
+                self.params = stored["params"]
+                self.bse = stored["bse"]
+                self.tvalues = stored["tvalues"]
+                self.X = stored["X"]
+                self.y = stored["y"]
+                self.coords = stored["coords"]
+                self.districts = stored["districts"] if "districts" in stored.files else None
+                self.meta = json.loads(str(stored["meta"]))
+            status = 0
+
+        except Exception as e:
+            print("Error: %s" % e)
+
+        return status
+
+    def index(self):
+        """
+        :return: index of the observations - names of districts if stored, their positions otherwise
+        """
+        if self.districts is not None:
+            return pd.Index(self.districts, name=self.meta["group_attr"])
+        return pd.RangeIndex(len(self.y))
+
+    def designMatrix(self, X=None):
+        """
+        :param X: n x (k - 1) array or DataFrame of regressors (without the constant), stored ones if None
+        :return: n x k design matrix with the constant
+        """
+        if X is None:
+            return self.X
+        if isinstance(X, pd.DataFrame):
+            X = X[self.variable_names].to_numpy(dtype="float64")
+        X = np.asarray(X, dtype="float64")
+        return np.column_stack([np.ones(len(X)), X])
+
+    def predict(self, X=None):
+        """
+        A method for predicting the dependent variable with the local coefficients of every district.
+        :param X: n x (k - 1) array or DataFrame of regressors of the districts (in the order of the model),
+        the regressors of the model if None (the fitted values)
+        :return: numpy array of n predictions
+        """
+        return np.einsum("ij,ij->i", self.designMatrix(X), self.params)
+
+    def scenarioMatrices(self, scenarios, mode="scale"):
+        """
+        A method for building the design matrices of what-if scenarios.
+        :param scenarios: dictionary of scenarios, name -> {regressor: value}; a value is a scalar or an array
+        with a value per district
+        :param mode: "set", "shift" or "scale" (see WHAT_IF_MODES)
+        :return: s x n x k array of design matrices
+        """
+        if mode not in WHAT_IF_MODES:
+            raise ValueError("Unsupported mode: %s" % mode)
+
+        matrices = np.repeat(self.X[np.newaxis], len(scenarios), axis=0)
+        for i, changes in enumerate(scenarios.values()):
+            for variable, value in changes.items():
+                if variable == self.coefficient_names[0]:
+                    raise ValueError("The constant cannot be changed")
+                column = self.coefficient_names.index(variable)
+                if mode == "set":
+                    matrices[i, :, column] = value
+                elif mode == "shift":
+                    matrices[i, :, column] += value
+                else:
+                    matrices[i, :, column] *= value
+        return matrices
+
+    def whatIf(self, scenarios, mode="scale"):
+        """
+        A method for predicting the dependent variable of all the districts under changed regressor values,
+        e.g. {"wet_down_10": {"wet_1": 0.9}} for 10% fewer accidents on wet roads. All the scenarios are evaluated
+        in a single batched product with the local coefficients, without refitting.
+        :param scenarios: dictionary of scenarios, name -> {regressor: value}, see scenarioMatrices()
+        :param mode: "set", "shift" or "scale" (see WHAT_IF_MODES)
+        :return: DataFrame indexed by districts with the fitted values ("baseline") and the prediction
+        and the change from the baseline ("{scenario}_change") of every scenario
+        """
+        baseline = self.predict()
+        predictions = np.einsum("sij,ij->si", self.scenarioMatrices(scenarios, mode), self.params)
+
+        frame = pd.DataFrame({"baseline": baseline}, index=self.index())
+        for name, prediction in zip(scenarios, predictions):
+            frame[name] = prediction
+            frame[f"{name}_change"] = prediction - baseline
+        return frame
+
+    def coefficients(self):
+        """
+        :return: DataFrame indexed by districts with the local coefficients, their standard errors and t-values,
+        whether they are significant (the t-value over the critical one), the fitted values and residuals
+        """
+        frame = pd.DataFrame(index=self.index())
+        critical = self.meta["critical_tval"]
+        for i, name in enumerate(self.coefficient_names):
+            frame[f"beta_{name}"] = self.params[:, i]
+            frame[f"se_{name}"] = self.bse[:, i]
+            frame[f"t_{name}"] = self.tvalues[:, i]
+            frame[f"significant_{name}"] = np.abs(self.tvalues[:, i]) > critical
+        frame["predy"] = self.predict()
+        frame["resid"] = self.y - frame["predy"].to_numpy()
+        return frame
+
+    @profileStage()
+    def saveCoefficients(self, path="data/gwr_coefficients.gpkg", districts=None, variant="full"):
+        """
+        A method for exporting the maps of local coefficients to a GeoPackage (layer "coefficients").
+        Geometry of districts is taken from the district cache by their names, or read from the source GeoPackage
+        of the model (in the order of the observations).
+        :param path: path of the GeoPackage, replaced if it exists
+        :param districts: DistrictCache with geometry of districts, not used if None
+        :param variant: geometry variant of the district cache, "full" or a simplified one (e.g. "coarse")
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+        status = -1
+
+        try:
+            frame = self.coefficients()
+            if (districts is not None) and (self.districts is not None) and (districts.load() == 0):
+                geometry = districts.geometry(list(self.districts), variant=variant)
+            else:
+                geometry = LazyGeoPackage(self.meta["source"]).read([], geometry=True).geometry
+
+            frame = gpd.GeoDataFrame(frame.reset_index(), geometry=geometry.values, crs=geometry.crs)
+            if os.path.isfile(path):
+                os.remove(path)
+            writeFrame(frame, path, layer="coefficients")
+            status = 0
+
+        except Exception as e:
+            print("Error: %s" % e)
+
+        return status
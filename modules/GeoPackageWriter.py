@@ -0,0 +1,131 @@
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import geopandas as gpd
+import pandas as pd
+import pyogrio
+
+from modules.StageProfiler import profileStage
+
+
+# Output modes of GeoPackageWriter:
+#   "files" - one aggregated_YYYY.gpkg file per year (the layout read by NormalizeTarget and IncrementalPipeline),
+#   "layers" - a single GeoPackage with one aggregated_YYYY layer per year,
+#   "long" - a single GeoPackage with one layer of all the years, told apart by the year attribute.
+MODES = ["files", "layers", "long"]
+
+
+def writeFrame(frame, path, layer=None, append=False):
+    """
+    Write a GeoDataFrame to a GeoPackage layer. The records are passed to GDAL as Arrow batches, so they are
+    inserted in bulk within a single transaction, and the spatial index is built once, after all the inserts.
+    :return: number of written records
+    """
+    # a named or non-default index is written as attributes, as by GeoDataFrame.to_file()
+    if (not isinstance(frame.index, pd.RangeIndex)) or any(name is not None for name in frame.index.names):
+        frame = frame.reset_index()
+    pyogrio.write_dataframe(frame, path, layer=layer, driver="GPKG", append=append, use_arrow=True,
+                            layer_options={"SPATIAL_INDEX": "YES"})
+    return len(frame)
+
+
+class GeoPackageWriter:
+    def __init__(self, output_dir, mode="files", filename="aggregated.gpkg", workers=1):
+        """
+        A class for writing the yearly aggregated GeoDataFrames. All the years are written either as separate
+        files (in a pool of worker processes with workers > 1), as layers of a single GeoPackage or as a single
+        long layer. Only the "long" mode writes all the years in a single transaction; the "layers" mode commits
+        every layer in its own transaction (pyogrio opens the dataset once per layer) and the "files" mode every
+        file. The throughput of every write is measured and stored in the throughput field.
+        :param output_dir: output directory
+        :param mode: "files", "layers" or "long" (see MODES)
+        :param filename: name of the single GeoPackage of the "layers" and "long" modes
+        :param workers: number of worker processes of the "files" mode
+        """
+        if mode not in MODES:
+            raise ValueError("Unsupported mode: %s" % mode)
+        self.output_dir = output_dir
+        self.mode = mode
+        self.filename = filename
+        self.workers = workers
+
+        # paths of the written files and the throughput of the last write
+        self.paths = []
+        self.throughput = None
+
+    def yearPath(self, year):
+        return os.path.join(self.output_dir, f"aggregated_{year}.gpkg")
+
+    @profileStage()
+    def writeYears(self, frames, years):
+        """
+        A method for writing the aggregated GeoDataFrames of all the years in the mode of the writer.
+        The existing outputs of the mode are replaced.
+        :param frames: list of GeoDataFrames, one per year
+        :param years: list of years of the frames
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+        status = -1
+
+        try:
+            if not os.path.isdir(self.output_dir):
+                os.makedirs(self.output_dir)
+
+            start = time.perf_counter()
+            if self.mode == "files":
+                self.paths = [self.yearPath(y) for y in years]
+                for path in self.paths:
+                    if os.path.isfile(path):
+                        os.remove(path)
+                if (self.workers > 1) & (len(frames) > 1):
+                    with ProcessPoolExecutor(self.workers) as executor:
+                        records = sum(executor.map(writeFrame, frames, self.paths))
+                else:
+                    records = sum(writeFrame(frame, path) for frame, path in zip(frames, self.paths))
+            else:
+                self.paths = [os.path.join(self.output_dir, self.filename)]
+                if os.path.isfile(self.paths[0]):
+                    os.remove(self.paths[0])
+                if self.mode == "layers":
+                    # the layers are added to the same file, each in its own transaction (not a single one,
+                    # use the "long" mode for that)
+                    records = sum(writeFrame(frame, self.paths[0], layer=f"aggregated_{y}")
+                                  for frame, y in zip(frames, years))
+                else:
+                    # all the years in a single layer: one transaction and one spatial index
+                    long_frame = gpd.GeoDataFrame(pd.concat(frames, axis=0),
+                                                  geometry="geometry", crs=frames[0].crs)
+                    records = writeFrame(long_frame, self.paths[0], layer="aggregated")
+            seconds = time.perf_counter() - start
+
+            size = sum(os.path.getsize(path) for path in self.paths)
+            self.throughput = {"mode": self.mode, "workers": self.workers, "years": len(frames),
+                               "records": int(records), "bytes": int(size), "seconds": round(seconds, 4),
+                               "records_per_s": round(records / seconds, 1) if seconds > 0 else None,
+                               "mb_per_s": round(size / 2 ** 20 / seconds, 3) if seconds > 0 else None}
+            status = 0
+
+        except Exception as e:
+            print("Error: %s" % e)
+
+        return status
+
+    def saveThroughput(self, path="reports/Write-throughput.json"):
+        """
+        A method for saving the throughput of the last write to a JSON file.
+        :param path: path of the JSON file
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+        status = -1
+
+        try:
+            with open(path, 'w') as fh:
+                json.dump(self.throughput, fh, indent=2)
+            status = 0
+
+        except Exception as e:
+            print("Error: %s" % e)
+
+        return status
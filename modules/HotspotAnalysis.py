@@ -0,0 +1,306 @@
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyogrio
+import scipy.sparse as sparse
+import shapely
+from pyproj import CRS
+from scipy.signal import fftconvolve
+from scipy.spatial import cKDTree
+from scipy.stats import norm
+
+from modules.StageProfiler import profileStage
+
+
+# Confidence levels of the hot spot classes (as in the Hot Spot Analysis of ArcGIS): the class is +-3, +-2 or +-1
+# for hot (cold) spots significant at the 99 %, 95 % and 90 % level, 0 otherwise
+CONFIDENCE_LEVELS = [(3, 0.01), (2, 0.05), (1, 0.10)]
+
+
+def hexagonBins(coords, size, origin):
+    """
+    Assign points to pointy-top hexagons, with the distance of centres of neighbouring hexagons equal to size.
+    The axial coordinates of the hexagon of every point are found by rounding its fractional cube coordinates.
+    :param coords: n x 2 array of coordinates
+    :param size: distance of centres of neighbouring hexagons
+    :param origin: coordinates of the centre of the hexagon (0, 0)
+    :return: n x 2 array of axial coordinates (q, r) of hexagons
+    """
+    radius = size / np.sqrt(3)
+    x = (coords[:, 0] - origin[0]) / radius
+    y = (coords[:, 1] - origin[1]) / radius
+    q = np.sqrt(3) / 3 * x - y / 3
+    r = 2 / 3 * y
+    s = -q - r
+
+    # the rounded cube coordinates must sum to zero: the one with the largest rounding error is recomputed
+    rq, rr, rs = np.round(q), np.round(r), np.round(s)
+    dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+    fix_q = (dq > dr) & (dq > ds)
+    fix_r = ~fix_q & (dr > ds)
+    rq[fix_q] = -rr[fix_q] - rs[fix_q]
+    rr[fix_r] = -rq[fix_r] - rs[fix_r]
+    return np.column_stack([rq, rr]).astype("int64")
+
+
+def hexagonCentres(axial, size, origin):
+    """
+    :return: m x 2 array of centres of pointy-top hexagons given by their axial coordinates
+    """
+    radius = size / np.sqrt(3)
+    x = origin[0] + radius * np.sqrt(3) * (axial[:, 0] + axial[:, 1] / 2)
+    y = origin[1] + radius * 1.5 * axial[:, 1]
+    return np.column_stack([x, y])
+
+
+def binPolygons(centres, shape, size):
+    """
+    :return: array of polygons of square or (pointy-top) hexagonal bins with the given centres
+    """
+    if shape == "square":
+        half = size / 2
+        return shapely.box(centres[:, 0] - half, centres[:, 1] - half, centres[:, 0] + half, centres[:, 1] + half)
+    radius = size / np.sqrt(3)
+    angles = np.radians(30 + 60 * np.arange(7))
+    vertices = np.stack([centres[:, :1] + radius * np.cos(angles), centres[:, 1:] + radius * np.sin(angles)], axis=2)
+    return shapely.polygons(vertices)
+
+
+class HotspotAnalysis:
+    def __init__(self, coords, years, crs="EPSG:27700", cell_size=1000.0, extent=None):
+        """
+        A class for finding hot spots of accidents at the resolution of points, below the level of districts.
+        The kernel density is estimated on a regular grid and the Getis-Ord Gi* statistic is computed over square
+        or hexagonal bins, for every year. Points are binned with histogram operations (bincount) and the density
+        is the convolution of the histogram with the kernel (computed with FFT), so millions of points are
+        processed in seconds. The neighbouring bins of Gi* are found once with a KD-tree.
+        :param coords: n x 2 array of projected coordinates of accidents, e.g. the point_coords field
+        of DataPreprocessing
+        :param years: n array of years of accidents
+        :param crs: CRS of the coordinates (a projected CRS in metres)
+        :param cell_size: size of cells of the density grid (in metres)
+        :param extent: (xmin, ymin, xmax, ymax) of the density grid, e.g. of the national grid,
+        the bounds of the points if None
+        """
+        self.coords = np.asarray(coords, dtype="float64")
+        self.years = np.asarray(years).astype("int64")
+        self.crs = CRS(crs)
+        self.cell_size = float(cell_size)
+
+        # extent of the grid, snapped outwards to the multiples of the cell size
+        if extent is None:
+            extent = (self.coords[:, 0].min(), self.coords[:, 1].min(),
+                      self.coords[:, 0].max(), self.coords[:, 1].max())
+        xmin, ymin = np.floor(np.asarray(extent[:2]) / self.cell_size) * self.cell_size
+        xmax, ymax = np.ceil(np.asarray(extent[2:]) / self.cell_size) * self.cell_size
+        self.extent = (float(xmin), float(ymin), float(xmax), float(ymax))
+        self.n_cols = max(1, int(round((xmax - xmin) / self.cell_size)))
+        self.n_rows = max(1, int(round((ymax - ymin) / self.cell_size)))
+
+        # density grids (rows from the north) of every year and of all the years ("all"), set by kernelDensity()
+        self.density = {}
+        self.bandwidth = None
+
+        # bins of Gi* and the statistics of every year, set by getisOrd()
+        self.bin_shape = None
+        self.bin_size = None
+        self.bin_centres = None
+        self.hotspots = {}
+
+    def gridCells(self, coords):
+        """
+        :return: positions of grid cells (row from the south * n_cols + column) of the points inside the grid,
+        and the mask of the points inside the grid
+        """
+        col = np.floor((coords[:, 0] - self.extent[0]) / self.cell_size).astype("int64")
+        row = np.floor((coords[:, 1] - self.extent[1]) / self.cell_size).astype("int64")
+        # points on the north and east edges belong to the last cells
+        col[col == self.n_cols] = self.n_cols - 1
+        row[row == self.n_rows] = self.n_rows - 1
+        inside = (col >= 0) & (col < self.n_cols) & (row >= 0) & (row < self.n_rows)
+        return row[inside] * self.n_cols + col[inside], inside
+
+    @profileStage()
+    def kernelDensity(self, bandwidth=5000.0):
+        """
+        A method for estimating the kernel density of accidents (per km2) on the grid, with the quartic kernel
+        (as the Kernel Density tool of ArcGIS and QGIS heatmaps). Points are counted in the grid cells and
+        the counts are convolved with the kernel sampled at the cells, for every year and for all the years.
+        Sets the density field.
+        :param bandwidth: search radius of the kernel (in metres)
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+        status = -1
+
+        try:
+            # quartic kernel sampled at the centres of cells around the centre cell, normalized to the sum of one
+            reach = int(np.ceil(bandwidth / self.cell_size))
+            offsets = np.arange(-reach, reach + 1) * self.cell_size
+            distances2 = (offsets[None, :] ** 2 + offsets[:, None] ** 2) / bandwidth ** 2
+            kernel = np.where(distances2 < 1, (1 - distances2) ** 2, 0)
+            kernel = kernel / kernel.sum()
+            # counts per cell -> counts per km2
+            scale = 1_000_000 / self.cell_size ** 2
+
+            cells, inside = self.gridCells(self.coords)
+            years = self.years[inside]
+            year_values = np.unique(years)
+            counts = np.bincount(np.searchsorted(year_values, years) * self.n_rows * self.n_cols + cells,
+                                 minlength=len(year_values) * self.n_rows * self.n_cols)
+            counts = counts.reshape(len(year_values), self.n_rows, self.n_cols).astype("float64")
+
+            grids = {int(year): grid for year, grid in zip(year_values, counts)}
+            grids["all"] = counts.sum(axis=0)
+            self.density = {}
+            for year, grid in grids.items():
+                # FFT rounding errors of empty areas are cut to zero, rows are flipped to start from the north
+                density = np.maximum(fftconvolve(grid, kernel, mode="same"), 0) * scale
+                density[density < 1e-12 * scale] = 0
+                self.density[year] = density[::-1]
+            self.bandwidth = bandwidth
+            status = 0
+
+        except Exception as e:
+            print("Error: %s" % e)
+
+        return status
+
+    def binPoints(self, shape, size):
+        """
+        Assign points to square or hexagonal bins of the given size. Only the bins with at least one accident
+        in any of the years are kept.
+        :return: bin of every point and m x 2 array of centres of bins
+        """
+        origin = (self.extent[0], self.extent[1])
+        if shape == "square":
+            keys = np.floor((self.coords - np.asarray(origin)) / size).astype("int64")
+        elif shape == "hex":
+            keys = hexagonBins(self.coords, size, origin)
+        else:
+            raise ValueError("Unsupported shape of bins: %s" % shape)
+
+        # the pairs of bin coordinates are combined to a single integer key, so the bins are found
+        # by a one-dimensional unique (sort) instead of a row-wise one
+        low = keys.min(axis=0)
+        span = int(keys[:, 1].max() - low[1]) + 1
+        combined = (keys[:, 0] - low[0]) * span + (keys[:, 1] - low[1])
+        unique_combined, point_bins = np.unique(combined, return_inverse=True)
+        unique_keys = np.column_stack([unique_combined // span + low[0], unique_combined % span + low[1]])
+        if shape == "square":
+            centres = np.asarray(origin) + (unique_keys + 0.5) * size
+        else:
+            centres = hexagonCentres(unique_keys, size, origin)
+        return point_bins.reshape(-1), centres
+
+    @profileStage()
+    def getisOrd(self, shape="hex", size=None, distance=None):
+        """
+        A method for computing the Getis-Ord Gi* statistic of the numbers of accidents in bins for every year.
+        The neighbours of a bin are the bins (with accidents in any of the years) whose centres lie within
+        the distance, including the bin itself, with binary weights. The sums of neighbours of all the years are
+        computed at once as a product with the sparse weights matrix. Sets the hotspots field to a DataFrame
+        per year with the count, z-score, p-value and class of every bin (see CONFIDENCE_LEVELS).
+        :param shape: "hex" or "square"
+        :param size: size of bins (the distance of centres of neighbouring bins), 5 cells of the grid if None
+        :param distance: neighbourhood distance, 1.5 * size if None (the adjacent bins)
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+        status = -1
+
+        try:
+            size = 5 * self.cell_size if size is None else float(size)
+            distance = 1.5 * size if distance is None else float(distance)
+            point_bins, centres = self.binPoints(shape, size)
+            m = len(centres)
+
+            # binary weights of the neighbours within the distance, including the bin itself
+            pairs = cKDTree(centres).query_pairs(distance, output_type="ndarray")
+            rows = np.concatenate([pairs[:, 0], pairs[:, 1], np.arange(m)])
+            cols = np.concatenate([pairs[:, 1], pairs[:, 0], np.arange(m)])
+            weights = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(m, m))
+            weight_sums = np.asarray(weights.sum(axis=1)).ravel()
+
+            # counts of accidents in bins of every year (years x bins)
+            year_values = np.unique(self.years)
+            counts = np.bincount(np.searchsorted(year_values, self.years) * m + point_bins,
+                                 minlength=len(year_values) * m).reshape(len(year_values), m).astype("float64")
+
+            neighbour_sums = (weights @ counts.T).T
+            mean = counts.mean(axis=1, keepdims=True)
+            deviation = np.sqrt((counts ** 2).mean(axis=1, keepdims=True) - mean ** 2)
+            # binary weights: the sum of squared weights equals the sum of weights
+            denominator = deviation * np.sqrt((m * weight_sums - weight_sums ** 2) / (m - 1))
+            z = np.divide(neighbour_sums - mean * weight_sums, denominator,
+                          out=np.zeros_like(neighbour_sums), where=denominator > 0)
+            p = 2 * norm.sf(np.abs(z))
+
+            classes = np.zeros(z.shape, dtype="int8")
+            for level, alpha in reversed(CONFIDENCE_LEVELS):
+                classes[p <= alpha] = np.sign(z[p <= alpha]) * level
+
+            self.hotspots = {}
+            for i, year in enumerate(year_values):
+                self.hotspots[int(year)] = pd.DataFrame({"count": counts[i].astype("int64"), "gi_z": z[i],
+                                                         "gi_p": p[i], "hotspot": classes[i]})
+            self.bin_shape, self.bin_size, self.bin_centres = shape, size, centres
+            status = 0
+
+        except Exception as e:
+            print("Error: %s" % e)
+
+        return status
+
+    def saveDensityRasters(self, directory="data/hotspots/"):
+        """
+        A method for saving the density grids as ESRI ASCII rasters (density_YYYY.asc and density_all.asc),
+        with the CRS in .prj files.
+        :param directory: output directory
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+        status = -1
+
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            header = (f"ncols {self.n_cols}\nnrows {self.n_rows}\nxllcorner {self.extent[0]}\n"
+                      f"yllcorner {self.extent[1]}\ncellsize {self.cell_size}\nNODATA_value -9999")
+            for year, density in self.density.items():
+                path = os.path.join(directory, f"density_{year}")
+                np.savetxt(path + ".asc", density, fmt="%.6g", header=header, comments="")
+                with open(path + ".prj", 'w') as fh:
+                    fh.write(self.crs.to_wkt("WKT1_ESRI"))
+            status = 0
+
+        except Exception as e:
+            print("Error: %s" % e)
+
+        return status
+
+    def saveHotspots(self, path="data/hotspots/hotspots.gpkg"):
+        """
+        A method for saving the Gi* statistics of bins to a GeoPackage, a layer per year (gi_YYYY).
+        The polygons of bins are built once and shared by all the layers.
+        :param path: path of the GeoPackage
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+        status = -1
+
+        try:
+            directory = os.path.dirname(path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            if os.path.isfile(path):
+                os.remove(path)
+
+            polygons = binPolygons(self.bin_centres, self.bin_shape, self.bin_size)
+            for year, statistics in self.hotspots.items():
+                layer = gpd.GeoDataFrame(statistics, geometry=polygons, crs=self.crs)
+                pyogrio.write_dataframe(layer, path, layer=f"gi_{year}", driver="GPKG", use_arrow=True)
+            status = 0
+
+        except Exception as e:
+            print("Error: %s" % e)
+
+        return status
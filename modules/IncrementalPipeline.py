@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import re
+
+import pandas as pd
+
+from modules.VariablesPreprocessing import RECODING
+
+
+class IncrementalPipeline:
+    def __init__(self, manifest_path, districts_path, attributesFile, population_dir, year_attribute="Year"):
+        """
+        A class for tracking which years of the accidents dataset must be processed again.
+        Every year of the cleaned dataset is fingerprinted by hashing its records. Together with fingerprints of the
+        district shapefile, the recoding configuration (RECODING table and the attributes file) and the population
+        files, they are compared with the manifest of the previous run, so only the years whose inputs changed are
+        formatted, joined with districts and aggregated again, while the aggregated files of other years are reused.
+        :param manifest_path: path to the JSON manifest of the previous run
+        :param districts_path: path to the districts shapefile
+        :param attributesFile: path to the text file with names of attributes selected for the analysis
+        :param population_dir: directory with population_YYYY.csv files (or population.feather)
+        :param year_attribute: name of the year attribute in the cleaned dataset
+        """
+        self.manifest_path = manifest_path
+        self.year_attribute = year_attribute
+
+        # the manifest of the previous run (empty if there was none)
+        self.previous = {}
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path, 'r') as fh:
+                self.previous = json.load(fh)
+
+        # fingerprints of the current run
+        self.manifest = {
+            "config": {
+                "districts": self.hashFiles(self.shapefileParts(districts_path)),
+                "recoding": self.hashFiles([attributesFile], repr(RECODING))
+            },
+            "population": self.hashFiles(
+                sorted(f"{population_dir}{x}" for x in os.listdir(population_dir)
+                       if re.compile("population_[0-9]+|population.feather").match(x))
+            ),
+            "years": {},
+            "first_year": None,
+            "dummy_classes": self.previous.get("dummy_classes")
+        }
+
+        # the years to process again and the years which are not in the dataset anymore, set by compareYears()
+        self.changed_years = []
+        self.removed_years = []
+
+    @staticmethod
+    def shapefileParts(path):
+        """
+        List all the files of a shapefile (.shp, .shx, .dbf, .prj, ...).
+        :param path: path to the .shp file
+        :return: sorted list of paths of existing files with the same name
+        """
+        directory, filename = os.path.split(path)
+        name = os.path.splitext(filename)[0]
+        return sorted(os.path.join(directory, x) for x in os.listdir(directory or ".")
+                      if os.path.splitext(x)[0] == name)
+
+    @staticmethod
+    def hashFiles(paths, extra=""):
+        """
+        Hash the contents of files (read in blocks) and an additional string.
+        :return: hexadecimal fingerprint
+        """
+        digest = hashlib.sha256(extra.encode())
+        for path in paths:
+            with open(path, 'rb') as fh:
+                for block in iter(lambda: fh.read(8 * 1024 * 1024), b""):
+                    digest.update(block)
+        return digest.hexdigest()[:16]
+
+    def compareYears(self, dataset, output_dir, force=False):
+        """
+        A method for fingerprinting every year of the cleaned dataset and comparing the fingerprints with the
+        previous run. All the years are processed again if the district shapefile, the recoding configuration
+        or the first year (which defines the one-hot encoded classes) changed.
+        Sets the changed_years and removed_years fields.
+        :param dataset: cleaned accidents dataset
+        :param output_dir: directory with aggregated_YYYY.gpkg files of the previous run
+        :param force: whether to process all the years again (e.g. when the aggregated data of the previous run
+        is missing)
+        :return: list of years to process again
+        """
+        # hash of every record, combined in the order of records within every year
+        row_hashes = pd.util.hash_pandas_object(dataset, index=False).to_numpy()
+        year_values = dataset[self.year_attribute].to_numpy()
+        years = [int(y) for y in pd.unique(year_values)]
+        for year in years:
+            year_hashes = row_hashes[year_values == year]
+            self.manifest["years"][str(year)] = hashlib.sha256(year_hashes.tobytes()).hexdigest()[:16]
+        self.manifest["first_year"] = years[0] if len(years) > 0 else None
+
+        previous_years = self.previous.get("years", {})
+        full_run = (force | (self.previous.get("config") != self.manifest["config"]) |
+                    (self.previous.get("first_year") != self.manifest["first_year"]) |
+                    (self.manifest["dummy_classes"] is None))
+        if full_run:
+            self.manifest["dummy_classes"] = None
+
+        self.changed_years = []
+        for year in years:
+            if (full_run or (previous_years.get(str(year)) != self.manifest["years"][str(year)]) or
+                    not os.path.isfile(f"{output_dir}aggregated_{year}.gpkg")):
+                self.changed_years.append(year)
+        self.removed_years = [int(y) for y in previous_years if int(y) not in years]
+
+        return self.changed_years
+
+    def isFullRun(self):
+        """
+        :return: True if all the years are processed again
+        """
+        return len(self.changed_years) == len(self.manifest["years"])
+
+    def normalizationChanged(self, normalized_path):
+        """
+        :param normalized_path: path to the normalized GeoPackage of the previous run
+        :return: True if the normalized data must be computed again
+        """
+        return ((len(self.changed_years) > 0) | (len(self.removed_years) > 0) |
+                (self.previous.get("population") != self.manifest["population"]) |
+                (not os.path.isfile(normalized_path)))
+
+    def saveManifest(self, dummy_classes=None):
+        """
+        A method for saving the manifest of the current run.
+        :param dummy_classes: classes one-hot encoded by DataPreprocessing.aggregateDistricts(), reused for the
+        years processed in the following runs
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+        status = -1
+
+        try:
+            if dummy_classes is not None:
+                self.manifest["dummy_classes"] = dummy_classes
+
+            directory = os.path.dirname(self.manifest_path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(self.manifest_path, 'w') as fh:
+                json.dump(self.manifest, fh, indent=2)
+            status = 0
+
+        except Exception as e:
+            print("Error: %s" % e)
+
+        return status
@@ -0,0 +1,107 @@
+import numpy as np
+import pyogrio
+
+from modules.StageProfiler import profileStage
+
+
+def sqlList(values):
+    """
+    Format values as a list of SQL literals, e.g. for an IN clause.
+    """
+    literals = []
+    for value in values:
+        if isinstance(value, str):
+            literals.append("'" + value.replace("'", "''") + "'")
+        else:
+            literals.append(str(int(value)) if float(value).is_integer() else str(float(value)))
+    return "(" + ", ".join(literals) + ")"
+
+
+class LazyGeoPackage:
+    def __init__(self, path, layer=None):
+        """
+        A class for reading a layer of a GeoPackage lazily. Nothing is read when the object is created: the schema
+        is read on the first use and the data only when it is accessed, with only the requested columns,
+        without geometry if it is not needed, and with the records filtered by an SQL WHERE clause evaluated by
+        the GeoPackage driver (so the filtered out records are never loaded). Read data is cached.
+        :param path: path to the GeoPackage
+        :param layer: name of the layer, the first layer if None
+        """
+        self.path = path
+        self.layer = layer
+        self.info = None
+        self.cache = {}
+
+    def schema(self):
+        """
+        :return: information about the layer (fields, CRS, number of features, ...), read once
+        """
+        if self.info is None:
+            self.info = pyogrio.read_info(self.path, layer=self.layer)
+        return self.info
+
+    def columns(self):
+        """
+        :return: list of names of attributes of the layer (without geometry)
+        """
+        return list(self.schema()["fields"])
+
+    @staticmethod
+    def whereIn(attribute, values):
+        """
+        :return: SQL WHERE clause selecting the records with the attribute in values
+        """
+        return f'"{attribute}" IN {sqlList(values)}'
+
+    @classmethod
+    def whereYears(cls, years, year_attr="year"):
+        return cls.whereIn(year_attr, years)
+
+    @classmethod
+    def whereAuthorities(cls, authorities, group_attr="auth"):
+        return cls.whereIn(group_attr, authorities)
+
+    @profileStage()
+    def read(self, columns=None, where=None, geometry=True):
+        """
+        A method for reading the layer.
+        :param columns: names of attributes to read, all attributes if None
+        :param where: SQL WHERE clause filtering the records (e.g. from whereYears()), all records if None
+        :param geometry: whether to read geometry (a DataFrame is returned without it)
+        :return: GeoDataFrame (or DataFrame without geometry)
+        """
+        key = (None if columns is None else tuple(columns), where, geometry)
+        if key not in self.cache:
+            self.cache[key] = pyogrio.read_dataframe(self.path, layer=self.layer,
+                                                     columns=None if columns is None else list(columns),
+                                                     where=where, read_geometry=geometry)
+        return self.cache[key]
+
+    def __getitem__(self, columns):
+        """
+        Read attributes (without geometry) on access, e.g. layer["casualties"] or layer[["casualties", "dark_1"]].
+        """
+        if isinstance(columns, str):
+            return self.read([columns], geometry=False)[columns]
+        return self.read(columns, geometry=False)
+
+    def centroids(self, where=None, centroid_attrs=("centroid_x", "centroid_y"), districts=None, group_attr="auth"):
+        """
+        A method for getting the coordinates of the centroids of features. Precomputed centroids are taken
+        from the district cache by the names of districts, or read from the centroid attributes if the layer
+        has them, otherwise only the geometry is read.
+        :param where: SQL WHERE clause filtering the records, all records if None
+        :param centroid_attrs: names of the attributes with precomputed x and y coordinates of centroids
+        :param districts: loaded DistrictCache with the centroids of districts, not used if None
+        :param group_attr: attribute with the names of districts
+        :return: n x 2 array of coordinates
+        """
+        if (districts is not None) and (group_attr in self.columns()):
+            return districts.centroids(list(self.read([group_attr], where=where, geometry=False)[group_attr]))
+
+        if all(attr in self.columns() for attr in centroid_attrs):
+            centroids = self.read(list(centroid_attrs), where=where, geometry=False)
+            return centroids[list(centroid_attrs)].to_numpy(dtype="float64")
+
+        centroids = self.read([], where=where, geometry=True).geometry.centroid
+        return np.column_stack([centroids.x.to_numpy(), centroids.y.to_numpy()])
@@ -0,0 +1,189 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+from mgwr.gwr import GWR, MGWR
+from mgwr.sel_bw import Sel_BW
+
+from modules.BandwidthSearch import BandwidthSearch
+from modules.LazyGeoPackage import LazyGeoPackage
+from modules.StageProfiler import profileStage
+
+
+# State of a worker process of the model runner, set once by initializeWorker()
+WORKER_STATE = {}
+
+
+def initializeWorker(shared_names, n_observations, n_columns, columns):
+    """
+    Initializer of a worker process: attaches the shared read-only coordinates and data arrays.
+    """
+    WORKER_STATE["memory"] = [shared_memory.SharedMemory(name=name) for name in shared_names]
+    coords, data = WORKER_STATE["memory"]
+    WORKER_STATE["coords"] = np.ndarray((n_observations, 2), dtype="float64", buffer=coords.buf)
+    WORKER_STATE["data"] = np.ndarray((n_observations, n_columns), dtype="float64", buffer=data.buf)
+    WORKER_STATE["columns"] = columns
+
+
+def fitSharedModel(specification):
+    """
+    Task of a worker process: fits a model on the shared arrays.
+    """
+    return fitModel(WORKER_STATE["coords"], WORKER_STATE["data"], WORKER_STATE["columns"], specification, n_jobs=1)
+
+
+def fitModel(coords, data, columns, specification, n_jobs=-1):
+    """
+    Fit a single GWR or MGWR model and summarize it.
+    :param coords: n x 2 array of coordinates of observations
+    :param data: n x m array with the dependent variable (the first column) and all the independent variables
+    :param columns: names of the columns of data
+    :param specification: dictionary with "name", "model" ("GWR" or "MGWR") and "variables" of the model
+    :param n_jobs: number of jobs used by mgwr
+    :return: dictionary with the comparison of the model
+    """
+    start = time.perf_counter()
+    positions = [columns.index(variable) for variable in specification["variables"]]
+    y = data[:, :1]
+    X = data[:, positions]
+
+    if specification["model"] == "MGWR":
+        selector = Sel_BW(coords, y, X, multi=True, n_jobs=n_jobs)
+        selector.search(multi_bw_min=[2])
+        results = MGWR(coords, y, X, selector, n_jobs=n_jobs).fit()
+        # a bandwidth per covariate (the constant first), kept apart so the bandwidth column stays numeric
+        bandwidth = np.nan
+        bandwidths = " ".join(str(bw) for bw in np.asarray(selector.bw[0]).ravel())
+    else:
+        bandwidth = float(BandwidthSearch(coords, y, X).search(bw_min=2))
+        bandwidths = np.nan
+        results = GWR(coords, y, X, bandwidth, n_jobs=n_jobs).fit()
+
+    return {
+        "name": specification["name"],
+        "model": specification["model"],
+        "variables": " ".join(specification["variables"]),
+        "n_variables": len(specification["variables"]),
+        "bandwidth": bandwidth,
+        "mgwr_bandwidths": bandwidths,
+        "aicc": float(results.aicc),
+        "r2": float(results.R2),
+        "adj_r2": float(results.adj_R2),
+        "fit_time_s": round(time.perf_counter() - start, 4)
+    }
+
+
+class ModelRunner:
+    def __init__(self, geopackage, dependent_variable, workers=1, districts=None):
+        """
+        A class for fitting and comparing many GWR and MGWR models of the same dependent variable.
+        The coordinates of the district centroids are computed once and only the variables of the models are read
+        from the GeoPackage. The models are fitted in a pool of worker processes, which read the coordinates
+        and the data from shared memory.
+        :param geopackage: path to the GeoPackage with normalized data
+        :param dependent_variable: name of the dependent variable
+        :param workers: number of worker processes
+        :param districts: DistrictCache with the centroids of districts, the centroids are computed from
+        the geometry of the GeoPackage if None
+        """
+        # the attributes are read by runModels(), only the variables of the models
+        self.source = LazyGeoPackage(geopackage)
+        self.dependent_variable = dependent_variable
+        self.workers = workers
+
+        if (districts is not None) and (districts.load() != 0):
+            districts = None
+        self.coords = self.source.centroids(districts=districts)
+
+        self.comparison = None
+
+    @staticmethod
+    def specifications(variable_sets):
+        """
+        Normalize the variable sets to model specifications. A variable set is either a list of independent
+        variables (a GWR model) or a dictionary with "variables" and optionally "model" ("GWR" or "MGWR")
+        and "name".
+        :return: list of dictionaries with "name", "model" and "variables"
+        """
+        specifications = []
+        for i, variable_set in enumerate(variable_sets):
+            if not isinstance(variable_set, dict):
+                variable_set = {"variables": list(variable_set)}
+            model = variable_set.get("model", "GWR").upper()
+            if model not in ["GWR", "MGWR"]:
+                raise ValueError("Unsupported model: %s" % model)
+            specifications.append({"name": variable_set.get("name", f"{model.lower()}_{i + 1}"), "model": model,
+                                   "variables": list(variable_set["variables"])})
+        return specifications
+
+    @profileStage("comparison")
+    def runModels(self, variable_sets):
+        """
+        A method for fitting all the models and comparing them. Sets the comparison field to a DataFrame
+        with AICc, R2, adjusted R2 and bandwidth of every model, ordered by AICc. The bandwidth of MGWR models
+        is NaN, their bandwidths of the covariates (the constant first) are in the mgwr_bandwidths column.
+        :param variable_sets: list of variable sets (see specifications())
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+        status = -1
+
+        try:
+            specifications = self.specifications(variable_sets)
+            columns = sorted({variable for specification in specifications
+                              for variable in specification["variables"]})
+            # the dependent variable is the first column of the shared data
+            columns = [self.dependent_variable] + columns
+            data = self.source[columns].to_numpy(dtype="float64")
+
+            if (self.workers > 1) & (len(specifications) > 1):
+                rows = self.runParallel(data, columns, specifications)
+            else:
+                rows = [fitModel(self.coords, data, columns, specification) for specification in specifications]
+
+            self.comparison = pd.DataFrame(rows).sort_values("aicc", kind="stable").reset_index(drop=True)
+            status = 0
+
+        except Exception as e:
+            print("Error: %s" % e)
+
+        return status
+
+    def runParallel(self, data, columns, specifications):
+        """
+        A method for fitting the models in a pool of worker processes sharing the coordinates and the data.
+        :return: list of dictionaries with the comparison of the models
+        """
+        memory = [shared_memory.SharedMemory(create=True, size=self.coords.nbytes),
+                  shared_memory.SharedMemory(create=True, size=data.nbytes)]
+        try:
+            np.ndarray(self.coords.shape, dtype="float64", buffer=memory[0].buf)[:] = self.coords
+            np.ndarray(data.shape, dtype="float64", buffer=memory[1].buf)[:] = data
+
+            initargs = ([m.name for m in memory], data.shape[0], data.shape[1], columns)
+            with ProcessPoolExecutor(self.workers, initializer=initializeWorker, initargs=initargs) as executor:
+                rows = list(executor.map(fitSharedModel, specifications))
+        finally:
+            for m in memory:
+                m.close()
+                m.unlink()
+
+        return rows
+
+    def saveComparison(self, path="reports/Model-comparison.csv"):
+        """
+        A method for saving the comparison of models to a CSV file.
+        :param path: path of the CSV file
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+        status = -1
+
+        try:
+            self.comparison.to_csv(path, index=False)
+            status = 0
+
+        except Exception as e:
+            print("Error: %s" % e)
+
+        return status
@@ -2,42 +2,124 @@ import pandas as pd
 import geopandas as gpd
 import os
 import re
+import numpy as np
+import pyarrow.feather as feather
+import pyogrio
 from pyproj import CRS
 
+from modules.LazyGeoPackage import LazyGeoPackage
+from modules.StageProfiler import profileStage
+
+
 class NormalizeTarget:
-    def __init__(self, dir, target):
+    def __init__(self, dir, target, years=None, panel=None):
         self.dir = dir
         self.aggregatedData = []
+        # lazy readers of the yearly GeoPackages, read by aggregateData() with only the needed columns
+        self.sources = []
         self.target = target
         self.norm_df = None
 
+        # population of districts (rows) in every year (columns), set by loadPopulation()
+        self.population = None
+        self.population_ids = None
+        self.population_dtype = None
+
+        # with the panel store, the aggregated data is read from it instead of the yearly GeoPackages
+        self.panel = panel
+        if self.panel is not None:
+            return
+
         for filename in os.listdir(self.dir):
-            if filename.startswith('aggregated'):
-                self.aggregatedData.append(gpd.read_file(dir + filename, index_col=0, header=0))
+            if re.fullmatch("aggregated_[0-9]+\\.gpkg", filename):
+                # with years specified, read only the aggregated data of these years (e.g. the changed ones)
+                if (years is not None) and (filename not in [f"aggregated_{y}.gpkg" for y in years]):
+                    continue
+                self.sources.append((LazyGeoPackage(dir + filename), None))
             else:
                 continue
 
-    def mergePopulationFiles(self):
-        pop_path_list = list(filter(re.compile("population_[0-9]+").match, os.listdir(self.dir)))
-        pop_path_list = [self.dir + x for x in pop_path_list]
-
-        # Store list of population sub-datasets
-        pop_list = []
-        for f in pop_path_list:
-            pop_year = pd.read_csv(f, index_col=0, header=0).reset_index()
-            pop_year.columns = ["auth", "auth_id", "population"]
-            pop_list.append(pop_year)
+        # without the yearly files, the years saved to a single aggregated.gpkg by GeoPackageWriter are read:
+        # a layer per year ("layers" mode) or the records of the years from the long layer ("long" mode)
+        if (len(self.sources) == 0) and os.path.isfile(dir + "aggregated.gpkg"):
+            for layer in pyogrio.list_layers(dir + "aggregated.gpkg")[:, 0]:
+                if layer == "aggregated":
+                    where = None if years is None else LazyGeoPackage.whereYears(years)
+                    self.sources.append((LazyGeoPackage(dir + "aggregated.gpkg", layer), where))
+                elif (years is None) or (layer in [f"aggregated_{y}" for y in years]):
+                    self.sources.append((LazyGeoPackage(dir + "aggregated.gpkg", layer), None))
+
+    @profileStage()
+    def loadPopulation(self):
+        """
+        Load the population of all the years once into an aligned (year x district) array.
+        The long-format population.feather (saved by PopulationData.saveLongRecords()) is read if it is in dir,
+        otherwise the population_YYYY.csv files are read. The table is small (a record per district and year),
+        so it is read into memory and converted to the data types of the CSV files.
+        Sets the population field to a DataFrame with districts (auth) as rows and years as columns (missing
+        populations are NaN) and the population_ids field to the codes of districts.
+        """
+        if os.path.isfile(self.dir + "population.feather"):
+            pop_concat = feather.read_table(self.dir + "population.feather").to_pandas()
+            pop_concat.columns = ["auth", "auth_id", "year", "population"]
+            pop_concat = pop_concat.astype({"auth": "object", "auth_id": "object", "year": "int64",
+                                            "population": "int64"})
+        else:
+            pop_path_list = sorted(filter(re.compile("population_[0-9]+").match, os.listdir(self.dir)))
+
+            pop_list = []
+            for f in pop_path_list:
+                pop_year = pd.read_csv(self.dir + f, header=0)
+                pop_year.columns = ["auth", "auth_id", "population"]
+                pop_year["year"] = int(re.search("[0-9]+", f).group())
+                pop_list.append(pop_year)
+            pop_concat = pd.concat(pop_list, axis=0, ignore_index=True)
+
+        # the sum of duplicated districts within a year, as in the pooled aggregation
+        self.population = pop_concat.pivot_table(index="auth", columns="year", values="population", aggfunc="sum")
+        self.population_ids = pop_concat.groupby("auth")["auth_id"].first()
+        self.population_dtype = pop_concat["population"].dtype
+        return self.population
 
-        # Concatenate list of sub-datasets
-        pop_concat = pd.concat(pop_list, axis=0, ignore_index=True)
+    def mergePopulationFiles(self):
+        if self.population is None:
+            self.loadPopulation()
 
-        # Aggregate concatenated dataset on local authority level
-        pop_aggr = pop_concat.groupby("auth").aggregate({"auth_id": "first", "population": "sum"}).reset_index()
+        # Aggregate population of all the years on local authority level
+        pop_aggr = pd.DataFrame({"auth": self.population.index.to_numpy(),
+                                 "auth_id": self.population_ids.reindex(self.population.index).to_numpy(),
+                                 "population": self.population.sum(axis=1).to_numpy().astype(self.population_dtype)})
         return pop_aggr
 
+    @profileStage("aggregatedData")
     def aggregateData(self, geometry_attr, group_attr, drop_attr):
+        # the dropped attributes are not read at all
+        self.aggregatedData = [source.read([x for x in source.columns() if x not in drop_attr], where=where)
+                               for source, where in self.sources]
         data = pd.concat(self.aggregatedData, axis=0, ignore_index=True)
-        data.drop(drop_attr, axis=1, inplace=True)
+        return self.aggregateFrame(data, geometry_attr, group_attr, drop_attr)
+
+    @profileStage()
+    def aggregatePanel(self, geometry_attr="geometry", group_attr="auth"):
+        """
+        Aggregate data of all the years from the panel store, summing the years of every district in one pass
+        over the memory-mapped panel. The geometry of districts is read once from the store.
+        :param geometry_attr: name of the geometry attribute
+        :param group_attr: name of the attribute to group records by (district name)
+        :return: aggregated GeoDataFrame and the list of aggregated attributes, the same as aggregateData()
+        """
+        # districts with accidents in any of the years, as in the concatenated yearly data
+        districts = np.flatnonzero(np.asarray(self.panel.present).any(axis=0))
+        sums = np.asarray(self.panel.values[:, districts, :]).sum(axis=0)
+
+        data = pd.DataFrame(sums, columns=self.panel.features)
+        data = data.astype({x: self.panel.dtypes[x] for x in self.panel.features})
+        data.insert(0, group_attr, self.panel.district_names[districts])
+        data[geometry_attr] = self.panel.geometry(districts).values
+        return self.aggregateFrame(data, geometry_attr, group_attr, [])
+
+    def aggregateFrame(self, data, geometry_attr, group_attr, drop_attr):
+        data = data.drop(drop_attr, axis=1, errors="ignore")
 
         # Define accidents aggregation scheme (agg_dict)
         agg_cols = [x for x in list(data.columns) if x not in [geometry_attr, group_attr]]
@@ -51,13 +133,116 @@ class NormalizeTarget:
         return gdf_aggr, agg_cols
 
 
+    @profileStage("norm_df")
     def normalize(self, population, aggrGdf, cols):
         # Merge accidents data with population data, normalize attributes
         self.norm_df = aggrGdf.merge(population, on="auth", how="inner")
-        self.norm_df[cols] = self.norm_df[cols].apply(lambda x: x / (self.norm_df["population"] / 10000))
+        self.norm_df[cols] = self.norm_df[cols].div(self.norm_df["population"] / 10000, axis=0)
         gpd.GeoDataFrame(self.norm_df, geometry="geometry", crs=CRS("EPSG:27700")).to_file(self.dir+"normalized.gpkg",
                                                                                             driver="GPKG")
 
-
-
-
+    @profileStage()
+    def normalizeRates(self, windows=(3,), output_path=None):
+        """
+        Normalize the aggregated attributes of the panel store to rates per 10k inhabitants:
+            pooled - the sums over all the years divided by the population summed over all the years
+                     (the same as the normalized.gpkg of normalize()),
+            yearly - the counts of every year divided by the population of the same year,
+            rolling_W - the sums over windows of W consecutive calendar years divided by the population summed
+                     over the same years (indexed by the last year of the window); a window is emitted only if all
+                     its years are in the panel and the population of the district is known in all of them.
+        All the rates are computed with broadcasted operations on the (year x district x feature) panel and
+        the aligned (year x district) population and written to a single GeoPackage with a layer per variant
+        (only the pooled layer has geometry, the other ones refer to it by auth).
+        :param windows: lengths of the rolling windows in years (at least 1)
+        :param output_path: path of the GeoPackage, normalized_rates.gpkg in dir by default
+        :return: dictionary with a DataFrame of every variant
+        """
+        for window in windows:
+            if (int(window) != window) or (window < 1):
+                raise ValueError("Window length must be a positive integer: %s" % window)
+        windows = [int(window) for window in windows]
+
+        if self.population is None:
+            self.loadPopulation()
+        if output_path is None:
+            output_path = self.dir + "normalized_rates.gpkg"
+
+        years = np.array(self.panel.years)
+        features = self.panel.features
+        # the panel holds compact integers, the rates are computed in float64
+        counts = np.asarray(self.panel.values, dtype="float64")
+        present = np.asarray(self.panel.present)
+
+        # population aligned to the districts and years of the panel (NaN if missing)
+        district_rows = self.population.index.get_indexer(self.panel.district_names)
+        year_columns = self.population.columns.get_indexer(years)
+        # the last row and column of the padded population are missing values (for the position -1)
+        padded = np.full((self.population.shape[0] + 1, self.population.shape[1] + 1), np.nan)
+        padded[:-1, :-1] = self.population.to_numpy(dtype="float64")
+        aligned = padded[np.ix_(district_rows, year_columns)].T
+        pooled_population = np.append(np.nansum(padded[:-1, :-1], axis=1), np.nan)[district_rows]
+
+        # the rolling windows span consecutive calendar years: the years missing in the panel (e.g. removed
+        # by IncrementalPipeline) have zero counts, no districts present and are not available
+        full_years = np.arange(years.min(), years.max() + 1) if len(years) > 0 else years
+        positions = full_years.searchsorted(years)
+        full_counts = np.zeros((len(full_years),) + counts.shape[1:])
+        full_counts[positions] = counts
+        full_present = np.zeros((len(full_years), present.shape[1]), dtype=bool)
+        full_present[positions] = present
+        available = np.zeros(len(full_years), dtype=bool)
+        available[positions] = True
+        full_population = np.full((len(full_years), aligned.shape[1]), np.nan)
+        full_population[positions] = aligned
+
+        def windowSums(values, window):
+            # sums over all the windows of consecutive years, along the first axis
+            cumulative = np.concatenate([np.zeros((1,) + values.shape[1:]), values.cumsum(axis=0)])
+            return cumulative[window:] - cumulative[:len(cumulative) - window]
+
+        # NaN-aware sums of population: a missing year does not affect the windows without it
+        known_population = ~np.isnan(full_population)
+        population_values = np.where(known_population, full_population, 0.0)
+
+        sums = [counts.sum(axis=0)[None], counts]
+        populations = [pooled_population[None], aligned]
+        rolling_present = []
+        for window in windows:
+            complete = (windowSums(available.astype("int64"), window) == window)[:, None] & \
+                       (windowSums(known_population.astype("int64"), window) == window)
+            population_sum = windowSums(population_values, window)
+            population_sum[~complete] = np.nan
+            sums.append(windowSums(full_counts, window))
+            populations.append(population_sum)
+            rolling_present.append(complete & (windowSums(full_present.astype("int64"), window) > 0))
+        rates = np.concatenate(sums, axis=0) / (np.concatenate(populations, axis=0)[:, :, None] / 10000)
+
+        # tidy frames of the variants, only with the districts with accidents (and population)
+        variants = {}
+        offset = 0
+        layers = [("pooled", None, present.any(axis=0)[None], pooled_population[None])]
+        layers.append(("yearly", years, present, aligned))
+        for window, population_sum, window_present in zip(windows, populations[2:], rolling_present):
+            layers.append((f"rolling_{window}", full_years[window - 1:], window_present, population_sum))
+        for name, layer_years, layer_present, layer_population in layers:
+            block = rates[offset:offset + len(layer_present)]
+            offset += len(layer_present)
+            year_index, district_index = np.nonzero(layer_present & ~np.isnan(layer_population))
+            frame = pd.DataFrame(block[year_index, district_index], columns=features)
+            frame.insert(0, "auth", self.panel.district_names[district_index])
+            if layer_years is not None:
+                frame.insert(0, "year", layer_years[year_index])
+            frame["auth_id"] = self.population_ids.reindex(frame["auth"]).to_numpy()
+            frame["population"] = layer_population[year_index, district_index]
+            variants[name] = frame
+
+        pooled = variants["pooled"].sort_values("auth", kind="stable").reset_index(drop=True)
+        variants["pooled"] = gpd.GeoDataFrame(pooled, geometry=self.panel.geometry(list(pooled["auth"])).values,
+                                              crs=CRS(self.panel.meta["crs"]))
+        if os.path.isfile(output_path):
+            os.remove(output_path)
+        for name, frame in variants.items():
+            pyogrio.write_dataframe(frame, output_path, layer=name, driver="GPKG")
+
+        return variants
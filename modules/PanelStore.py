@@ -0,0 +1,271 @@
+import hashlib
+import json
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from pyproj import CRS
+
+from modules.StageProfiler import profileStage
+
+
+def compactDtype(dtypes, values):
+    """
+    Find the narrowest data type holding all the values of the panel: the smallest integer type of their range
+    if all the features are integers (counts and codes), float64 otherwise.
+    :param dtypes: data types of the features
+    :param values: list of numpy arrays with the values to store
+    :return: numpy data type
+    """
+    if not all(np.issubdtype(np.dtype(dtype), np.integer) for dtype in dtypes):
+        return np.dtype("float64")
+    values = [x for x in values if x.size > 0]
+    low = min([int(x.min()) for x in values], default=0)
+    high = max([int(x.max()) for x in values], default=0)
+    return np.result_type(np.min_scalar_type(low), np.min_scalar_type(high))
+
+
+class PanelStore:
+    def __init__(self, directory="data/panel/"):
+        """
+        A class for storing the aggregated data as a dense (years x districts x features) panel.
+        The panel is persisted as a NumPy file, opened memory-mapped, so slicing it by a year range, districts
+        or features reads only the needed parts, and a single value is looked up in O(1) by its position.
+        The geometry and names of districts are stored once (as WKB), not in every year.
+        Files of the store:
+            values.npy - array (years x districts x features) with the aggregated attributes, of the narrowest
+                         integer type holding all of them (float64 if any attribute is not an integer),
+                         cast back to the data types of the features by frame(),
+            present.npy - bool array (years x districts), True for the districts with accidents in a year,
+            districts.feather - names and WKB geometry of all the districts (in the order of the shapefile),
+            panel.json - years, features and their data types, CRS and the key of the district polygons.
+        :param directory: directory of the store
+        """
+        self.directory = directory
+        self.values_path = os.path.join(directory, "values.npy")
+        self.present_path = os.path.join(directory, "present.npy")
+        self.districts_path = os.path.join(directory, "districts.feather")
+        self.meta_path = os.path.join(directory, "panel.json")
+
+        # set by loadPanel()
+        self.values = None
+        self.present = None
+        self.years = []
+        self.features = []
+        self.dtypes = {}
+        self.district_names = None
+        self.meta = None
+
+    def isStored(self):
+        """
+        :return: True if all the files of the panel exist
+        """
+        return all(os.path.isfile(path) for path in [self.values_path, self.present_path, self.districts_path,
+                                                    self.meta_path])
+
+    @staticmethod
+    def districtsKey(districts):
+        """
+        :return: fingerprint of the district polygons
+        """
+        digest = hashlib.sha256()
+        for geometry in shapely.to_wkb(districts.geometry.values):
+            digest.update(geometry)
+        return digest.hexdigest()[:16]
+
+    @profileStage("values")
+    def savePanel(self, aggregated_df, districts, removed_years=(), name_attr="LAD21NM"):
+        """
+        A method for saving the aggregated (year, district) cube to the panel. The years of the cube replace
+        the same years of the stored panel, the removed years are dropped and the other stored years are kept,
+        as long as the districts and features of the stored panel are the same. Otherwise the panel is replaced.
+        Only numerical attributes are stored.
+        :param aggregated_df: DataFrame indexed by (year, index) - the aggregated_df field of DataPreprocessing
+        :param districts: GeoDataFrame with all the districts (index is the position of a district in it)
+        :param removed_years: years to drop from the stored panel
+        :param name_attr: attribute with the names of districts
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+        status = -1
+
+        try:
+            features = [x for x in aggregated_df.columns if pd.api.types.is_numeric_dtype(aggregated_df[x].dtype)]
+            dtypes = {x: str(aggregated_df[x].dtype) for x in features}
+            districts_key = self.districtsKey(districts)
+            new_years = sorted(int(y) for y in aggregated_df.index.get_level_values("year").unique())
+
+            # the stored years to keep
+            kept_years = []
+            if self.isStored() and (self.loadPanel() == 0):
+                if (self.meta["districts_key"] == districts_key) & (self.features == features):
+                    kept_years = [y for y in self.years if (y not in new_years) and (y not in removed_years)]
+
+            years = sorted(kept_years + new_years)
+            new_values = aggregated_df[features].to_numpy()
+            kept_values = [np.asarray(self.values[self.years.index(year)]) for year in kept_years]
+            dtype = compactDtype(dtypes.values(), [new_values] + kept_values)
+            values = np.zeros((len(years), len(districts), len(features)), dtype=dtype)
+            present = np.zeros((len(years), len(districts)), dtype=bool)
+            for year, kept in zip(kept_years, kept_values):
+                values[years.index(year)] = kept
+                present[years.index(year)] = self.present[self.years.index(year)]
+
+            year_positions = pd.Index(years).get_indexer(
+                aggregated_df.index.get_level_values("year").to_numpy().astype(int)
+            )
+            district_positions = aggregated_df.index.get_level_values("index").to_numpy()
+            values[year_positions, district_positions] = new_values
+            present[year_positions, district_positions] = True
+
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            pd.DataFrame({"auth": districts[name_attr].to_numpy(),
+                          "geometry": shapely.to_wkb(districts.geometry.values)}).to_feather(self.districts_path)
+            self.writePanel(values, present, {"years": years, "features": features, "dtypes": dtypes,
+                                              "crs": districts.crs.to_string(), "districts_key": districts_key})
+            status = self.loadPanel()
+
+        except Exception as e:
+            print("Error: %s" % e)
+
+        return status
+
+    def removeYears(self, removed_years):
+        """
+        A method for dropping years from the stored panel.
+        :param removed_years: years to drop
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+        status = -1
+
+        try:
+            if self.loadPanel() == 0:
+                kept = [i for i, y in enumerate(self.years) if y not in removed_years]
+                meta = dict(self.meta, years=[self.years[i] for i in kept])
+                self.writePanel(np.asarray(self.values[kept]), np.asarray(self.present[kept]), meta)
+                status = self.loadPanel()
+
+        except Exception as e:
+            print("Error: %s" % e)
+
+        return status
+
+    def writePanel(self, values, present, meta):
+        """
+        Write the values, the presence of districts and the metadata, replacing the stored files.
+        """
+        # release the memory-mapped files of the stored panel before replacing them
+        self.values, self.present = None, None
+
+        np.save(self.values_path + ".tmp.npy", values)
+        os.replace(self.values_path + ".tmp.npy", self.values_path)
+        np.save(self.present_path + ".tmp.npy", present)
+        os.replace(self.present_path + ".tmp.npy", self.present_path)
+        with open(self.meta_path, 'w') as fh:
+            json.dump(meta, fh, indent=2)
+
+    def loadPanel(self):
+        """
+        A method for opening the stored panel. The values are memory-mapped, not read.
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+        status = -1
+
+        try:
+            with open(self.meta_path, 'r') as fh:
+                self.meta = json.load(fh)
+            self.years = self.meta["years"]
+            self.features = self.meta["features"]
+            self.dtypes = self.meta["dtypes"]
+            self.values = np.load(self.values_path, mmap_mode="r")
+            self.present = np.load(self.present_path, mmap_mode="r")
+            self.district_names = pd.read_feather(self.districts_path, columns=["auth"])["auth"].to_numpy()
+            status = 0
+
+        except Exception as e:
+            print("Error: %s" % e)
+
+        return status
+
+    def yearPositions(self, years=None):
+        """
+        :param years: None (all the years), a (first, last) range (inclusive) or a list of years
+        :return: slice or list of positions of the years
+        """
+        if years is None:
+            return slice(None)
+        if isinstance(years, tuple):
+            first, last = years
+            positions = [i for i, y in enumerate(self.years) if first <= y <= last]
+            return slice(positions[0], positions[-1] + 1) if len(positions) > 0 else slice(0, 0)
+        return [self.years.index(int(y)) for y in years]
+
+    def districtPositions(self, districts=None):
+        """
+        :param districts: None (all the districts) or a list of district names or positions
+        :return: slice or list of positions of the districts
+        """
+        if districts is None:
+            return slice(None)
+        names = pd.Index(self.district_names)
+        return [d if isinstance(d, (int, np.integer)) else names.get_loc(d) for d in districts]
+
+    def featurePositions(self, features=None):
+        """
+        :param features: None (all the features) or a list of feature names
+        :return: slice or list of positions of the features
+        """
+        if features is None:
+            return slice(None)
+        return [self.features.index(f) for f in features]
+
+    def select(self, years=None, districts=None, features=None):
+        """
+        A method for slicing the panel. Axes are indexed one by one, starting from the years (the outermost axis),
+        so only the needed years are read from the memory-mapped file.
+        :param years: None (all the years), a (first, last) range (inclusive) or a list of years
+        :param districts: None (all the districts) or a list of district names or positions
+        :param features: None (all the features) or a list of feature names
+        :return: numpy array (years x districts x features)
+        """
+        selected = self.values[self.yearPositions(years)]
+        selected = selected[:, self.districtPositions(districts)]
+        return np.asarray(selected[:, :, self.featurePositions(features)])
+
+    def value(self, year, district, feature):
+        """
+        :return: the value of a feature of a district in a year
+        """
+        return self.values[self.years.index(int(year)), self.districtPositions([district])[0],
+                           self.features.index(feature)]
+
+    def frame(self, years=None, districts=None, features=None):
+        """
+        A method for getting a slice of the panel as a tidy DataFrame with (year, auth) index. Only the districts
+        with accidents in a year are included, as in the aggregated data of DataPreprocessing.
+        :return: DataFrame with the features as columns
+        """
+        year_positions = np.arange(len(self.years))[self.yearPositions(years)]
+        district_positions = np.arange(len(self.district_names))[self.districtPositions(districts)]
+        features = self.features if features is None else features
+
+        values = self.select(years, districts, features)
+        present = np.asarray(self.present[year_positions][:, district_positions])
+        year_index, district_index = np.nonzero(present)
+        frame = pd.DataFrame(values[year_index, district_index], columns=features,
+                             index=pd.MultiIndex.from_arrays(
+                                 [np.array(self.years)[year_positions][year_index],
+                                  self.district_names[district_positions][district_index]],
+                                 names=["year", "auth"]))
+        return frame.astype({f: self.dtypes[f] for f in features})
+
+    def geometry(self, districts=None):
+        """
+        :param districts: None (all the districts) or a list of district names or positions
+        :return: GeoSeries with the geometry of the districts
+        """
+        wkb = pd.read_feather(self.districts_path, columns=["geometry"])["geometry"].to_numpy()
+        positions = np.arange(len(wkb))[self.districtPositions(districts)]
+        return gpd.GeoSeries(shapely.from_wkb(wkb[positions]), crs=CRS(self.meta["crs"]))
@@ -0,0 +1,143 @@
+import os
+
+import pandas as pd
+
+from modules.DatasetCleaning import applyDatatypePlan, planDatatypes, writeMissingValuesReport
+from modules.DistrictCache import DistrictCache
+from modules.StageProfiler import profileStage
+from modules.StreamingLoader import NA_VALUES, PARSE_DTYPES
+from modules.VariablesPreprocessing import DataPreprocessing, mergePartialAggregates
+
+
+class PartitionedPipeline:
+    def __init__(self, filename, attributesFile, districts_path="data/Local_authorities.shp", output_dir="data/",
+                 partition_size=500_000, years=None, cache_dir="data/cache/"):
+        """
+        A class for running the cleaning, recoding, district join and aggregation out of core, partition by
+        partition, for datasets which do not fit in memory (e.g. more years or vehicle and casualty level tables).
+        Every partition of the CSV file is cleaned and typed as by StreamingLoader and DatasetCleaning, processed
+        by DataPreprocessing up to partialAggregates() and merged into the running partial aggregates, so only
+        the accidents of a single partition are held in memory at once. The merge is associative and the aggregates
+        are finalized by DataPreprocessing.aggregatePartials(), so the outputs are identical to those of the
+        in-memory path.
+        The memory is not bounded by the partition and the (year, district) cells, though: the string attributes
+        (Accident_Index and Local_Authority_(District)) are concatenated within cells, as in the outputs, so the
+        running aggregates grow linearly with the number of accidents (O(N) characters) and every merge copies them.
+        The partitions are processed by the local process; the assignment of districts is not cached, as the cache
+        holds all the accidents.
+        :param filename: path to the CSV file with accidents data
+        :param attributesFile: path to the text file with names of attributes selected for the analysis
+        :param districts_path: path to the shapefile with districts
+        :param output_dir: output directory of the aggregated data
+        :param partition_size: number of records of a partition
+        :param years: years to process, all the years if None
+        :param cache_dir: directory of the district cache (see DistrictCache), not persisted if None
+        """
+        self.filename = filename
+        self.output_dir = output_dir
+        self.partition_size = partition_size
+        self.years = None if years is None else [int(y) for y in years]
+        # districts are loaded once and shared by the partitions
+        self.district_cache = DistrictCache(districts_path, directory=None if cache_dir is None
+                                            else os.path.join(cache_dir, "districts"))
+        if self.district_cache.load() != 0:
+            raise ValueError("Districts cannot be loaded from %s" % districts_path)
+        self.districts = self.district_cache.districts()
+
+        self.attributes = []
+        with open(attributesFile, 'r') as fh:
+            for line in fh.readlines():
+                attribute = line.strip()
+                if attribute:
+                    self.attributes.append(attribute)
+
+        # missing values and records seen while streaming, as in StreamingLoader
+        self.missing_values = dict(zip(self.attributes, [0] * len(self.attributes)))
+        self.n_records = 0
+        self.n_partitions = 0
+
+        # set by run()
+        self.partial = None
+        self.aggregated_df = None
+        self.dummy_classes = None
+
+    def partitions(self):
+        """
+        Generator of the cleaned partitions of the dataset: only the selected attributes, without missing values
+        and with compact data types.
+        """
+        dtypes = {attribute: PARSE_DTYPES.get(attribute, "object") for attribute in self.attributes}
+        reader = pd.read_csv(self.filename, usecols=self.attributes, dtype=dtypes, chunksize=self.partition_size,
+                             keep_default_na=False, na_values=NA_VALUES)
+        for partition in reader:
+            self.n_records += len(partition)
+            for column, n_nans in partition.isnull().sum().items():
+                self.missing_values[column] += int(n_nans)
+
+            partition.dropna(axis=0, how="any", inplace=True)
+            if self.years is not None:
+                partition = partition.loc[partition["Year"].isin(self.years)]
+            if len(partition) == 0:
+                continue
+            applyDatatypePlan(partition, planDatatypes(partition))
+            yield partition[self.attributes].copy()
+
+    @profileStage()
+    def run(self, save=False, dummy_classes=None, save_mode="files", geometry_variant="full"):
+        """
+        A method for processing the dataset partition by partition and aggregating it.
+        Sets the aggregated_df and dummy_classes fields, the same as DataPreprocessing.aggregateDistricts().
+        :param save: whether to save aggregated data (GeoPackage format)
+        :param dummy_classes: classes of categorical attributes to one-hot encode, see aggregateDistricts()
+        :param save_mode: "files", "layers" or "long", see GeoPackageWriter
+        :param geometry_variant: geometry of districts attached to the outputs, see aggregateDistricts()
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+        status = -1
+
+        try:
+            dp = None
+            for partition in self.partitions():
+                dp = DataPreprocessing(partition, output_dir=self.output_dir, cache_dir=None,
+                                       districts=self.district_cache)
+                dp.formatVariables()
+                dp.geoTransform()
+                dp.sjoinDistricts()
+                if len(dp.accidents_df) == 0:
+                    continue
+
+                # the running aggregates absorb every partition, which is released afterwards
+                partial = dp.partialAggregates()
+                self.partial = partial if self.partial is None else mergePartialAggregates([self.partial, partial])
+                self.n_partitions += 1
+                dp.accidents_df = None
+
+            if self.partial is None:
+                raise ValueError("no accidents within the districts")
+
+            dp.aggregatePartials(self.partial, save=save, dummy_classes=dummy_classes, save_mode=save_mode,
+                                 geometry_variant=geometry_variant)
+            self.aggregated_df = dp.aggregated_df
+            self.dummy_classes = dp.dummy_classes
+            status = 0
+
+        except Exception as e:
+            print("Error: %s" % e)
+
+        return status
+
+    def reportMissingValues(self):
+        """
+        A method for generating a report on missing values found while streaming the partitions.
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+        status = -1
+
+        try:
+            writeMissingValuesReport(self.missing_values, self.n_records)
+            status = 0
+
+        except Exception as e:
+            print("Error: %s" % e)
+
+        return status
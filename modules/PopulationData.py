@@ -1,6 +1,10 @@
 import pandas as pd
 import os
 
+# Data types of the long-format population table: years and populations are stored as compact integers
+LONG_DTYPES = {"year": "uint16", "population": "uint32"}
+
+
 class PopulationData:
     def __init__(self, filename, min_year, max_year):
         # load the population CSV files
@@ -17,9 +21,25 @@ class PopulationData:
                 if ((int(column.split("_")[-1]) >= min_year) & (int(column.split("_")[-1]) <= max_year)):
                     self.population_by_year.append(column)
 
-    def saveAnnualRecords(self, groupby_attributes, output_directory):
+        # population of all the years grouped by the groupby attributes, set by groupPopulation()
+        self.grouped = None
+        self.groupby_attributes = None
+
+    def groupPopulation(self, groupby_attributes):
+        """
+        Group the records once, summing all the yearly population columns in the same aggregation.
+        :param groupby_attributes: the attribute to perform grouping of records
+        :return: DataFrame with the yearly populations (columns) of every group (rows)
         """
+        if (self.grouped is None) or (self.groupby_attributes != groupby_attributes):
+            self.grouped = self.dataset.groupby(groupby_attributes)[self.population_by_year].sum()
+            self.groupby_attributes = groupby_attributes
+        return self.grouped
 
+    def saveAnnualRecords(self, groupby_attributes, output_directory):
+        """
+        Save the population of every year to its own CSV file (kept for compatibility, the long format
+        of saveLongRecords() holds all the years in one file).
         :param groupby_attributes: the attribute to perform grouping of records
         :param output_directory: the directory to save all of the population CSV files
         :return: status if successful (0) or unsuccessful (-1)
@@ -32,14 +52,39 @@ class PopulationData:
             if not os.path.isdir(output_directory):
                 os.mkdir(output_directory)
 
-            # save the records grouped by year
+            # save the records grouped by year, all of them taken from the single grouped aggregation
+            grouped = self.groupPopulation(groupby_attributes)
             for year in self.population_by_year:
-                # check if NT standard
-                if (os.name == "nt"):
-                    pd.DataFrame(self.dataset.groupby(groupby_attributes)[year].sum()).to_csv(f"{output_directory}\\{year}.csv")
-                # otherwise use a forward slash
-                else:
-                    pd.DataFrame(self.dataset.groupby(groupby_attributes)[year].sum()).to_csv(f"{output_directory}/{year}.csv")
+                grouped[[year]].to_csv(os.path.join(output_directory, f"{year}.csv"))
+            status = 0
+
+        except Exception as e:
+            print("Error %s" % e)
+
+        return status
+
+    def saveLongRecords(self, groupby_attributes, path="data/population.feather"):
+        """
+        Save the population of all the years in the long format (group attributes, year, population) to a single
+        uncompressed Feather file, which can be memory-mapped by the normalization.
+        Group attributes are stored as categories, years and populations as compact unsigned integers.
+        :param groupby_attributes: the attribute to perform grouping of records
+        :param path: path of the Feather file
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+        status = -1
+
+        try:
+            directory = os.path.dirname(path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            grouped = self.groupPopulation(groupby_attributes)
+            long = grouped.rename(columns=lambda column: int(column.split("_")[-1]))
+            long = long.rename_axis(columns="year").stack().rename("population").reset_index()
+            long = long.astype({attribute: "category" for attribute in groupby_attributes})
+            long = long.astype(LONG_DTYPES)
+            long.to_feather(path, compression="uncompressed")
             status = 0
 
         except Exception as e:
@@ -56,8 +101,9 @@ class PopulationData:
         status = -1
 
         try:
+            grouped = self.groupPopulation(groupby_attributes)
             for year in self.population_by_year:
-                self.population_dataframes.append(pd.DataFrame(self.dataset.groupby(groupby_attributes)[year].sum()))
+                self.population_dataframes.append(grouped[[year]])
             status = 0
         except Exception as e:
             print("Error %s" % e)
@@ -0,0 +1,257 @@
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import numpy as np
+from scipy import sparse
+from scipy.spatial import cKDTree
+from scipy.stats import t
+
+from modules.BandwidthSearch import EPS, BandwidthSearch, gaussianAICc, kernelFunction
+from modules.StageProfiler import profileStage
+
+
+def localFits(X, y, neighbours, weights, X_local, cct=True):
+    """
+    Solve the weighted least squares of a batch of local regressions over the neighbours of their locations,
+    with the diagnostics of mgwr (GWR._local_fit()).
+    :param X: independent variables (with the constant) of all the observations
+    :param y: dependent variable of all the observations
+    :param neighbours: b x m array of positions of neighbours of every location of the batch
+    :param weights: b x m array of kernel weights of the neighbours
+    :param X_local: b x k array of independent variables at the locations
+    :param cct: whether to compute the diagonal of (XtWX)^-1 XtW^2X (XtWX)^-1 (for the standard errors)
+    :return: tuple (b x k local coefficients, b influences (diagonal of the hat matrix), b x k CCT or None)
+    """
+    Xn = X[neighbours]
+    XtWX = np.einsum("bm,bmk,bml->bkl", weights, Xn, Xn)
+    XtWy = np.einsum("bm,bmk,bm->bk", weights, Xn, y[neighbours])
+    rhs = np.stack([XtWy, X_local], axis=2)
+    if cct:
+        rhs = np.concatenate([rhs, np.einsum("bm,bmk,bml->bkl", weights ** 2, Xn, Xn)], axis=2)
+    inverse = None
+    try:
+        solved = np.linalg.solve(XtWX, rhs)
+    except np.linalg.LinAlgError:
+        # too few neighbours with non-zero weights, the pseudo-inverse is used for all the products of the batch
+        inverse = np.linalg.pinv(XtWX)
+        solved = inverse @ rhs
+
+    betas = solved[:, :, 0]
+    # the own weight of every location is 1 (the kernel at zero distance)
+    influence = np.einsum("bk,bk->b", X_local, solved[:, :, 1])
+    CCT = None
+    if cct:
+        # diagonal of (XtWX)^-1 XtW^2X (XtWX)^-1, both matrices are symmetric
+        C = np.swapaxes(solved[:, :, 2:], 1, 2)
+        CCT = np.einsum("bkk->bk", np.linalg.solve(XtWX, C) if inverse is None else inverse @ C)
+    return betas, influence, CCT
+
+
+class SparseGWRResults:
+    def __init__(self, model, bw, params, influ, CCT, W):
+        """
+        Results of a Gaussian GWR model fitted by SparseGWR, with the attributes of mgwr.gwr.GWRResults used
+        by the project (e.g. by GWRResultStore). The kernel weights are kept as a sparse (n x n CSR) matrix.
+        """
+        self.model = SimpleNamespace(coords=model.coords, X=model.X, y=model.y.reshape(-1, 1), bw=bw,
+                                     kernel=model.kernel, fixed=model.fixed)
+        self.n, self.k = model.n, model.k
+        self.W = W
+        self.params = params
+        self.influ = influ.reshape(-1, 1)
+
+        y = model.y
+        self.predy = np.einsum("ik,ik->i", model.X, params).reshape(-1, 1)
+        self.resid_response = y - self.predy.ravel()
+        self.resid_ss = float(self.resid_response @ self.resid_response)
+        self.tr_S = float(influ.sum())
+        self.ENP = self.tr_S
+        self.sigma2 = self.resid_ss / (self.n - self.tr_S)
+        self.CCT = CCT * self.sigma2
+        self.bse = np.sqrt(self.CCT)
+        self.tvalues = params / self.bse
+        self.aicc = gaussianAICc(self.resid_ss, self.n, self.tr_S)
+        self.R2 = 1.0 - self.resid_ss / float(((y - y.mean()) ** 2).sum())
+
+        # local R2 from the geographically weighted sums of squares of every location
+        rows = np.repeat(np.arange(self.n), np.diff(W.indptr))
+        y_bar = (W @ y) / np.asarray(W.sum(axis=1)).ravel()
+        TSS = np.bincount(rows, weights=W.data * (y[W.indices] - y_bar[rows]) ** 2, minlength=self.n)
+        RSS = W @ (self.resid_response ** 2)
+        self.localR2 = ((TSS - RSS) / TSS).reshape(-1, 1)
+
+    @property
+    def adj_alpha(self):
+        # alpha corrected for multiple testing at the 90%, 95% and 99.9% levels, as in mgwr
+        return np.array([.1, .05, .001]) * self.k / self.ENP
+
+    def critical_tval(self, alpha=None):
+        """
+        :param alpha: significance level, the corrected alpha at the 95% level if None
+        :return: the critical t-value, as in mgwr
+        """
+        alpha = np.abs(self.adj_alpha[1] if alpha is None else alpha) / 2.0
+        return t.ppf(1 - alpha, self.n - 1)
+
+
+class SparseGWR(BandwidthSearch):
+    def __init__(self, coords, y, X, constant=True, workers=1, batch_size=1024, batch_elements=2_000_000,
+                 slack=8):
+        """
+        A class for selecting the bandwidth and fitting a Gaussian GWR model with the adaptive bisquare kernel
+        for many locations (e.g. LSOAs, grid cells or accident points), giving the same results as mgwr.
+        No pairwise distances are computed: the k nearest neighbours of every location are queried from a KD-tree,
+        the bisquare kernel is zero beyond them, so every local regression is solved over its neighbours only.
+        The local regressions are solved in batches (in a pool of threads with more workers), and the kernel
+        weights of the fitted model are kept as a sparse matrix, so memory grows linearly with the number
+        of locations for a given bandwidth.
+        The bandwidth is selected by the golden section search of BandwidthSearch (the same as Sel_BW); for many
+        locations the search is best limited by bw_max, as the default section extends to all the locations.
+        :param coords: coordinates of observations (n x 2 array or list of tuples)
+        :param y: dependent variable (n x 1 array)
+        :param X: independent variables without the constant (n x k array)
+        :param constant: whether to add the constant (intercept) to the independent variables
+        :param workers: number of threads solving the batches of local regressions
+        :param batch_size: maximal number of local regressions solved at once
+        :param batch_elements: maximal number of (location, neighbour) pairs of a batch, bounds the batch memory
+        :param slack: number of neighbours queried over the bandwidth, to find the neighbours tied with the last one
+        """
+        self.coords = np.asarray(coords, dtype="float64")
+        self.y = np.asarray(y, dtype="float64").reshape(-1)
+        X = np.asarray(X, dtype="float64").reshape(len(self.y), -1)
+        self.X = np.hstack([np.ones((len(self.y), 1)), X]) if constant else X
+        self.kernel = "bisquare"
+        self.fixed = False
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_elements = batch_elements
+        self.slack = slack
+        self.n, self.k = self.X.shape
+
+        # spatial index of the locations, instead of the sorted distances of BandwidthSearch
+        self.tree = cKDTree(self.coords)
+
+        # scores of the evaluated bandwidths, the history of the search (as in Sel_BW) and the kept kernel weights
+        self.scores = {}
+        self.kernels = {}
+        self.sel_hist = []
+        self.bw = None
+
+    def neighbourhood(self, start, stop, bw):
+        """
+        A method for finding the neighbours of a batch of locations and their kernel weights. The bandwidth of
+        a location is the distance to its bw-th nearest neighbour (the location itself is the first one),
+        neighbours tied with the last one are included, as in mgwr.
+        :param start: position of the first location of the batch
+        :param stop: position after the last location of the batch
+        :param bw: bandwidth (number of neighbours)
+        :return: tuple (positions of neighbours (b x m array), weights (b x m array)), only the neighbours
+        within the bandwidth
+        """
+        nn = int(bw)
+        m = min(nn + self.slack, self.n)
+        while True:
+            distances, neighbours = self.tree.query(self.coords[start:stop], k=m)
+            distances = distances.reshape(stop - start, -1)
+            neighbours = neighbours.reshape(stop - start, -1)
+            bandwidths = distances[:, nn - 1] * EPS
+            if (m == self.n) or (distances[:, -1] >= bandwidths).all():
+                break
+            # more neighbours are tied with the last one than the slack
+            m = min(2 * m, self.n)
+
+        within = distances < bandwidths[:, None]
+        weights = np.where(within, kernelFunction(self.kernel, distances / bandwidths[:, None]), 0.0)
+        m = int(within.sum(axis=1).max())
+        return neighbours[:, :m], weights[:, :m]
+
+    def mapBatches(self, function, bw):
+        """
+        Apply a function to the batches of locations (start, stop), in a pool of threads with more workers.
+        :return: list of the results of the batches in their order
+        """
+        rows = max(1, min(self.batch_size, self.batch_elements // (int(bw) + self.slack)))
+        starts = list(range(0, self.n, rows))
+        stops = [min(start + rows, self.n) for start in starts]
+        if (self.workers > 1) & (len(starts) > 1):
+            with ThreadPoolExecutor(self.workers) as executor:
+                return list(executor.map(function, starts, stops))
+        return [function(start, stop) for start, stop in zip(starts, stops)]
+
+    def localKernel(self, bw, keep=False):
+        """
+        A method for computing the kernel weights of the neighbours of every location (e.g. for the refits of
+        the permutation test of AnalyzeGWR), padded with zero weights to the largest neighbourhood.
+        :param bw: bandwidth (number of neighbours)
+        :param keep: whether to keep the weights for the following calls
+        :return: tuple (positions of neighbours (n x m array), weights (n x m array))
+        """
+        if bw in self.kernels:
+            return self.kernels[bw]
+
+        batches = self.mapBatches(lambda start, stop: self.neighbourhood(start, stop, bw), bw)
+        m = max(batch_neighbours.shape[1] for batch_neighbours, _ in batches)
+        neighbours = np.zeros((self.n, m), dtype="int64")
+        weights = np.zeros((self.n, m))
+        row = 0
+        for batch_neighbours, batch_weights in batches:
+            b, width = batch_neighbours.shape
+            neighbours[row:row + b, :width] = batch_neighbours
+            weights[row:row + b, :width] = batch_weights
+            row += b
+
+        kernel = (neighbours, weights)
+        if keep:
+            self.kernels[bw] = kernel
+        return kernel
+
+    def score(self, bw):
+        """
+        A method for computing AICc of the GWR model with the given bandwidth. The neighbourhoods are queried
+        batch by batch, so only the kernel weights of a batch are held at once.
+        :param bw: bandwidth (number of neighbours, np.inf for the global model)
+        :return: AICc
+        """
+        if bw in self.scores:
+            return self.scores[bw]
+        if bw == np.inf:
+            return BandwidthSearch.score(self, bw)
+
+        def scoreBatch(start, stop):
+            neighbours, weights = self.neighbourhood(start, stop, bw)
+            betas, influence, _ = localFits(self.X, self.y, neighbours, weights, self.X[start:stop], cct=False)
+            return np.einsum("bk,bk->b", self.X[start:stop], betas), influence
+
+        batches = self.mapBatches(scoreBatch, bw)
+        predy = np.concatenate([batch_predy for batch_predy, _ in batches])
+        tr_S = sum(influence.sum() for _, influence in batches)
+
+        aicc = gaussianAICc(np.sum((self.y - predy) ** 2), self.n, tr_S)
+        self.scores[bw] = aicc
+        return aicc
+
+    @profileStage()
+    def fit(self, bw=None):
+        """
+        A method for fitting the GWR model: local coefficients, their standard errors and the diagnostics.
+        :param bw: bandwidth (number of neighbours), the one selected by search() if None
+        :return: SparseGWRResults
+        """
+        bw = self.bw[0] if bw is None else bw
+
+        def fitBatch(start, stop):
+            neighbours, weights = self.neighbourhood(start, stop, bw)
+            betas, influence, CCT = localFits(self.X, self.y, neighbours, weights, self.X[start:stop])
+
+            # non-zero kernel weights of the batch, for the sparse weights matrix
+            rows, columns = np.nonzero(weights)
+            return betas, influence, CCT, (rows + start, neighbours[rows, columns], weights[rows, columns])
+
+        batches = self.mapBatches(fitBatch, bw)
+        params = np.concatenate([batch[0] for batch in batches])
+        influ = np.concatenate([batch[1] for batch in batches])
+        CCT = np.concatenate([batch[2] for batch in batches])
+        rows, columns, weights = [np.concatenate(parts) for parts in zip(*[batch[3] for batch in batches])]
+        W = sparse.csr_matrix((weights, (rows, columns)), shape=(self.n, self.n))
+
+        return SparseGWRResults(self, bw, params, influ, CCT, W)
@@ -0,0 +1,314 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import scipy.sparse as sparse
+import shapely
+from scipy.optimize import minimize_scalar
+from scipy.sparse.linalg import splu
+from scipy.stats import norm
+
+from modules.LazyGeoPackage import LazyGeoPackage
+from modules.StageProfiler import profileStage
+
+
+def contiguityWeights(geometries, queen=True):
+    """
+    Build the binary contiguity matrix of polygons through their spatial index. Only the pairs of polygons
+    whose bounding boxes intersect are tested, instead of all the pairs.
+    :param geometries: array of polygons
+    :param queen: True for queen contiguity (a common point), False for rook contiguity (a common edge)
+    :return: sparse (CSR) n x n matrix with 1 for neighbouring polygons
+    """
+    geometries = np.asarray(geometries)
+    tree = shapely.STRtree(geometries)
+    left, right = tree.query(geometries, predicate="intersects")
+    different = left != right
+    left, right = left[different], right[different]
+
+    if not queen:
+        # rook neighbours share a part of the boundary, not only a point
+        shared = shapely.intersection(shapely.boundary(geometries[left]), shapely.boundary(geometries[right]))
+        common_edge = shapely.length(shared) > 0
+        left, right = left[common_edge], right[common_edge]
+
+    n = len(geometries)
+    return sparse.csr_matrix((np.ones(len(left)), (left, right)), shape=(n, n))
+
+
+def rowStandardize(weights):
+    """
+    Row-standardize the weights matrix (style "W"). Polygons without neighbours keep zero rows.
+    """
+    row_sums = np.asarray(weights.sum(axis=1)).ravel()
+    scale = np.divide(1.0, row_sums, out=np.zeros_like(row_sums), where=row_sums > 0)
+    return sparse.diags(scale) @ weights
+
+
+def logDeterminant(weights, coefficient):
+    """
+    Compute log|I - coefficient * W| through the sparse LU decomposition.
+    """
+    n = weights.shape[0]
+    lu = splu((sparse.identity(n, format="csc") - coefficient * weights).tocsc())
+    # the lower triangular factor has a unit diagonal
+    return np.sum(np.log(np.abs(lu.U.diagonal())))
+
+
+def fitLeastSquares(y, X):
+    """
+    :return: tuple (coefficients, residuals) of the OLS regression
+    """
+    betas = np.linalg.lstsq(X, y, rcond=None)[0]
+    return betas, y - X @ betas
+
+
+class SpatialDiagnostics:
+    def __init__(self, geopackage, dependent_variable, independent_variables, queen=True, cache_dir="data/cache/"):
+        """
+        A class for testing the spatial autocorrelation of the OLS residuals (Moran's I) and fitting
+        the spatial lag and spatial error models, as in spatial_regression.R (spdep and spatialreg).
+        The row-standardized contiguity weights of districts are built through the spatial index of their polygons
+        and cached in cache_dir, keyed by the polygons, so they are built once.
+        :param geopackage: path to the GeoPackage with normalized data
+        :param dependent_variable: name of the dependent variable
+        :param independent_variables: names of the independent variables
+        :param queen: True for queen contiguity, False for rook contiguity
+        :param cache_dir: directory to cache the weights, nothing is cached if None
+        """
+        # only the variables of the models and the polygons are read
+        self.dataset = LazyGeoPackage(geopackage).read([dependent_variable] + list(independent_variables))
+        self.dependent_variable = dependent_variable
+        self.independent_variables = independent_variables
+        self.queen = queen
+        self.cache_dir = cache_dir
+
+        self.y = self.dataset[dependent_variable].to_numpy(dtype="float64")
+        self.X = np.column_stack([np.ones(len(self.y)),
+                                  self.dataset[independent_variables].to_numpy(dtype="float64")])
+
+        self.weights = None
+        self.residuals = None
+        self.results = {}
+
+    def cachePath(self):
+        """
+        :return: path of the cached weights of the current polygons and contiguity
+        """
+        digest = hashlib.sha256()
+        for geometry in shapely.to_wkb(self.dataset.geometry.values):
+            digest.update(geometry)
+        contiguity = "queen" if self.queen else "rook"
+        return os.path.join(self.cache_dir, f"contiguity_{contiguity}_{digest.hexdigest()[:16]}.npz")
+
+    @profileStage("dataset")
+    def buildWeights(self):
+        """
+        A method for building (or loading from the cache) the row-standardized contiguity weights.
+        Sets the weights field.
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+        status = -1
+
+        try:
+            path = self.cachePath() if self.cache_dir is not None else None
+            if (path is not None) and os.path.isfile(path):
+                binary = sparse.load_npz(path).tocsr()
+            else:
+                binary = contiguityWeights(self.dataset.geometry.values, self.queen)
+                if path is not None:
+                    if not os.path.isdir(self.cache_dir):
+                        os.makedirs(self.cache_dir)
+                    sparse.save_npz(path, binary)
+
+            self.weights = rowStandardize(binary).tocsr()
+            neighbours = np.diff(binary.indptr)
+            self.results["weights"] = {"contiguity": "queen" if self.queen else "rook",
+                                       "links": int(binary.nnz), "mean_neighbours": float(neighbours.mean()),
+                                       "islands": int((neighbours == 0).sum())}
+            status = 0
+
+        except Exception as e:
+            print("Error: %s" % e)
+
+        return status
+
+    @profileStage("dataset")
+    def fitOLS(self):
+        """
+        A method for fitting the OLS model.
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+        status = -1
+
+        try:
+            n, k = self.X.shape
+            betas, residuals = fitLeastSquares(self.y, self.X)
+            sigma2 = residuals @ residuals / n
+            llf = -n / 2 * np.log(2 * np.pi * sigma2) - n / 2
+            self.results["ols"] = {"coefficients": dict(zip(["constant"] + self.independent_variables,
+                                                             betas.tolist())),
+                                   "log_likelihood": float(llf), "aic": float(-2 * llf + 2 * (k + 1))}
+            self.residuals = residuals
+            status = 0
+
+        except Exception as e:
+            print("Error: %s" % e)
+
+        return status
+
+    @profileStage("dataset")
+    def moranTest(self, permutations=999, batch_size=100, seed=0):
+        """
+        A method for testing the spatial autocorrelation of the OLS residuals with Moran's I.
+        The inference is based on random permutations of the residuals, evaluated in batches:
+        every batch of permuted residuals is multiplied by the weights matrix at once.
+        :param permutations: number of permutations
+        :param batch_size: number of permutations evaluated at once
+        :param seed: seed of the permutations
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+        status = -1
+
+        try:
+            z = self.residuals - self.residuals.mean()
+            n = len(z)
+            s0 = self.weights.sum()
+            observed = n / s0 * (z @ (self.weights @ z)) / (z @ z)
+
+            rng = np.random.default_rng(seed)
+            simulated = np.empty(permutations)
+            for start in range(0, permutations, batch_size):
+                size = min(batch_size, permutations - start)
+                Z = z[rng.permuted(np.tile(np.arange(n), (size, 1)), axis=1)].T
+                simulated[start:start + size] = n / s0 * np.sum(Z * (self.weights @ Z), axis=0) / (z @ z)
+
+            # pseudo p-value of the one-sided test in the direction of the observed autocorrelation
+            if observed >= simulated.mean():
+                extreme = np.sum(simulated >= observed)
+            else:
+                extreme = np.sum(simulated <= observed)
+            self.results["moran"] = {"I": float(observed), "expected": -1 / (n - 1),
+                                     "mean_permuted": float(simulated.mean()),
+                                     "sd_permuted": float(simulated.std(ddof=1)),
+                                     "z": float((observed - simulated.mean()) / simulated.std(ddof=1)),
+                                     "p_value": float((extreme + 1) / (permutations + 1)),
+                                     "permutations": permutations}
+            status = 0
+
+        except Exception as e:
+            print("Error: %s" % e)
+
+        return status
+
+    def concentratedLikelihood(self, coefficient, model):
+        """
+        Log-likelihood of the spatial lag ("lag") or spatial error ("error") model, concentrated on
+        the spatial coefficient (rho or lambda).
+        :return: tuple (log-likelihood, coefficients, residuals, transformed X)
+        """
+        n = len(self.y)
+        if model == "lag":
+            X = self.X
+            y = self.y - coefficient * (self.weights @ self.y)
+        else:
+            X = self.X - coefficient * (self.weights @ self.X)
+            y = self.y - coefficient * (self.weights @ self.y)
+        betas, residuals = fitLeastSquares(y, X)
+        sigma2 = residuals @ residuals / n
+        llf = -n / 2 * np.log(2 * np.pi * sigma2) - n / 2 + logDeterminant(self.weights, coefficient)
+        return llf, betas, residuals, X
+
+    def lagInformation(self, rho, betas, sigma2):
+        """
+        Asymptotic information matrix of the spatial lag model over (beta, rho, sigma2), built with the traces
+        of W_A, W_A'W_A and W_A W_A, where W_A = W (I - rho W)^-1 (computed densely, for districts).
+        :param rho: spatial coefficient
+        :param betas: coefficients of the independent variables
+        :param sigma2: variance of the residuals
+        :return: (k + 2) x (k + 2) information matrix
+        """
+        n, k = self.X.shape
+        lu = splu((sparse.identity(n, format="csc") - rho * self.weights).tocsc())
+        WA = self.weights @ lu.solve(np.eye(n))
+        WAxb = WA @ (self.X @ betas)
+
+        information = np.zeros((k + 2, k + 2))
+        information[:k, :k] = self.X.T @ self.X / sigma2
+        information[:k, k] = information[k, :k] = self.X.T @ WAxb / sigma2
+        # tr(W_A W_A) + tr(W_A'W_A) + (W_A X beta)'(W_A X beta) / sigma2
+        information[k, k] = np.sum(WA * WA.T) + np.sum(WA * WA) + WAxb @ WAxb / sigma2
+        information[k, k + 1] = information[k + 1, k] = np.trace(WA) / sigma2
+        information[k + 1, k + 1] = n / (2 * sigma2 ** 2)
+        return information
+
+    def fitSpatialModel(self, model):
+        """
+        A method for fitting the spatial lag ("lag") or spatial error ("error") model by maximum likelihood.
+        The spatial coefficient is found by maximizing the concentrated log-likelihood, whose log-determinant
+        term is computed with the sparse LU decomposition. Standard errors of the lag model (and of rho) are
+        the full asymptotic ones (see lagInformation()).
+        :param model: "lag" or "error"
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+        status = -1
+
+        try:
+            optimum = minimize_scalar(lambda c: -self.concentratedLikelihood(c, model)[0], bounds=(-0.99, 0.99),
+                                      method="bounded", options={"xatol": 1e-8})
+            coefficient = float(optimum.x)
+            llf, betas, residuals, X = self.concentratedLikelihood(coefficient, model)
+
+            sigma2 = residuals @ residuals / len(self.y)
+            k = self.X.shape[1]
+            if model == "lag":
+                # asymptotic standard errors from the information matrix of (beta, rho, sigma2), as spreg (ML_Lag)
+                # and spatialreg (lagsarlm) do, since the coefficients are not independent of rho
+                covariance = np.linalg.inv(self.lagInformation(coefficient, betas, sigma2))
+                errors = np.sqrt(np.diag(covariance)[:k])
+            else:
+                # the information matrix of the error model is block-diagonal in beta and (lambda, sigma2)
+                errors = np.sqrt(np.diag(sigma2 * np.linalg.inv(X.T @ X)))
+            self.results[model] = {"rho" if model == "lag" else "lambda": coefficient,
+                                   "coefficients": dict(zip(["constant"] + self.independent_variables,
+                                                            betas.tolist())),
+                                   "standard_errors": dict(zip(["constant"] + self.independent_variables,
+                                                               errors.tolist())),
+                                   "log_likelihood": float(llf), "aic": float(-2 * llf + 2 * (k + 2))}
+            if model == "lag":
+                rho_error = float(np.sqrt(covariance[k, k]))
+                self.results[model].update({"rho_standard_error": rho_error, "rho_z": coefficient / rho_error,
+                                            "rho_p_value": float(2 * norm.sf(abs(coefficient / rho_error)))})
+            status = 0
+
+        except Exception as e:
+            print("Error: %s" % e)
+
+        return status
+
+    @profileStage("dataset")
+    def fitLagModel(self):
+        return self.fitSpatialModel("lag")
+
+    @profileStage("dataset")
+    def fitErrorModel(self):
+        return self.fitSpatialModel("error")
+
+    def saveResults(self, path="reports/Spatial-diagnostics.json"):
+        """
+        A method for saving the results of all the diagnostics to a JSON file.
+        :param path: path of the JSON file
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+        status = -1
+
+        try:
+            with open(path, 'w') as fh:
+                json.dump(self.results, fh, indent=2)
+            status = 0
+
+        except Exception as e:
+            print("Error: %s" % e)
+
+        return status
@@ -0,0 +1,229 @@
+import cProfile
+import functools
+import json
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import pandas as pd
+
+# the resource module is not available on Windows, where the peak RSS is not reported
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# The profiler which records the stages decorated with profileStage(), set by StageProfiler.activate()
+ACTIVE_PROFILER = None
+
+
+def currentRSS():
+    """
+    Get the current resident set size of the process in MB (Linux only, None elsewhere).
+    """
+    try:
+        with open("/proc/self/statm", 'r') as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1_000_000
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def peakRSS():
+    """
+    Get the peak resident set size of the process so far in MB (None if not available).
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / 1_000_000
+    return peak * 1024 / 1_000_000
+
+
+def describeFrame(frame, deep_memory=False):
+    """
+    Get number of rows and memory usage (in MB) of a dataframe, an array or a list of dataframes.
+    :return: tuple (rows, memory) with None values for other objects
+    """
+    if isinstance(frame, (list, tuple)):
+        described = [describeFrame(f, deep_memory) for f in frame]
+        if (len(described) == 0) or any(rows is None for rows, _ in described):
+            return None, None
+        return sum(rows for rows, _ in described), sum(memory for _, memory in described)
+    if isinstance(frame, pd.DataFrame):
+        return len(frame), frame.memory_usage(deep=deep_memory).sum() / 1_000_000
+    if hasattr(frame, "nbytes") and hasattr(frame, "shape") and len(frame.shape) > 0:
+        return frame.shape[0], frame.nbytes / 1_000_000
+    return None, None
+
+
+def profileStage(frame_attribute=None, output_attribute=None):
+    """
+    Decorator of pipeline stages (methods). If a profiler is active, the stage is recorded by it: wall time,
+    CPU time, memory and rows of the dataframe stored in frame_attribute of the object before the stage and
+    in output_attribute (frame_attribute by default) after the stage.
+    If the attribute is empty after the stage, the returned dataframe (or the first element of the returned tuple)
+    is described instead.
+    :param frame_attribute: name of the attribute holding the processed dataframe
+    :param output_attribute: name of the attribute holding the output dataframe, if it is not frame_attribute
+    """
+    if output_attribute is None:
+        output_attribute = frame_attribute
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            profiler = ACTIVE_PROFILER
+            if profiler is None:
+                return method(self, *args, **kwargs)
+
+            name = f"{type(self).__name__}.{method.__name__}"
+            frame_in = getattr(self, frame_attribute, None) if frame_attribute is not None else None
+            with profiler.stage(name, frame_in) as record:
+                result = method(self, *args, **kwargs)
+                frame_out = getattr(self, output_attribute, None) if output_attribute is not None else None
+                if frame_out is None:
+                    frame_out = result[0] if isinstance(result, tuple) and len(result) > 0 else result
+                record["frame_out"] = frame_out
+            return result
+        return wrapper
+    return decorator
+
+
+class StageProfiler:
+    def __init__(self, report_path="reports/Run-report.json", profile=False, trace_memory=False,
+                 deep_memory=False):
+        """
+        A class for recording where the pipeline spends time and memory. Every stage records wall time, CPU time,
+        the current and peak resident set size, rows and memory of the processed dataframe before and after it.
+        :param report_path: path of the JSON run report
+        :param profile: whether to capture cProfile statistics of every stage (saved next to the report)
+        :param trace_memory: whether to trace the peak of Python memory allocations of every stage with tracemalloc
+        :param deep_memory: whether to measure the memory of dataframes including the contents of object columns
+        """
+        self.report_path = report_path
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.deep_memory = deep_memory
+        self.stages = []
+        self.started = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+        # number of stages currently running, cProfile and tracemalloc are used by the outermost stage only
+        self.depth = 0
+
+    def activate(self):
+        """
+        Make the profiler record all the stages decorated with profileStage().
+        """
+        global ACTIVE_PROFILER
+        ACTIVE_PROFILER = self
+
+    def deactivate(self):
+        global ACTIVE_PROFILER
+        if ACTIVE_PROFILER is self:
+            ACTIVE_PROFILER = None
+
+    @contextmanager
+    def stage(self, name, frame_in=None):
+        """
+        Context manager recording a single stage. The frame processed by the stage can be set as "frame_out" of the
+        yielded dictionary.
+        :param name: name of the stage
+        :param frame_in: dataframe processed by the stage
+        """
+        rows_in, memory_in = describeFrame(frame_in, self.deep_memory)
+        record = {"frame_out": None}
+
+        outermost = self.depth == 0
+        self.depth += 1
+        trace_memory = self.trace_memory & outermost
+
+        profiler = None
+        if self.profile & outermost:
+            profiler = cProfile.Profile()
+        if trace_memory:
+            tracemalloc.start()
+
+        rss_start = currentRSS()
+        peak_start = peakRSS()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        if profiler is not None:
+            profiler.enable()
+
+        try:
+            yield record
+        finally:
+            self.depth -= 1
+            if profiler is not None:
+                profiler.disable()
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+            peak_end = peakRSS()
+
+            rows_out, memory_out = describeFrame(record["frame_out"], self.deep_memory)
+            stage = {
+                "stage": name,
+                # number of enclosing stages, e.g. 1 for the writer of aggregateDistricts()
+                "depth": self.depth,
+                "wall_time_s": round(wall, 4),
+                "cpu_time_s": round(cpu, 4),
+                "rss_start_mb": rss_start,
+                "rss_end_mb": currentRSS(),
+                "peak_rss_mb": peak_end,
+                "peak_rss_increase_mb": None if peak_end is None else peak_end - peak_start,
+                "rows_in": rows_in,
+                "rows_out": rows_out,
+                "frame_memory_in_mb": memory_in,
+                "frame_memory_out_mb": memory_out
+            }
+
+            if trace_memory:
+                stage["traced_peak_mb"] = tracemalloc.get_traced_memory()[1] / 1_000_000
+                tracemalloc.stop()
+
+            if profiler is not None:
+                profile_path = os.path.join(os.path.dirname(self.report_path) or ".", "profiles",
+                                            f"{len(self.stages) + 1:02d}_{name}.prof")
+                if not os.path.isdir(os.path.dirname(profile_path)):
+                    os.makedirs(os.path.dirname(profile_path))
+                profiler.dump_stats(profile_path)
+                stage["profile"] = profile_path
+
+            self.stages.append(stage)
+
+    def saveReport(self):
+        """
+        A method for saving the JSON run report with all the recorded stages. The total times are the sums
+        of the outermost stages (depth 0).
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+        status = -1
+
+        try:
+            directory = os.path.dirname(self.report_path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            report = {
+                "started": self.started,
+                # nested stages are already counted by their enclosing stages
+                "total_wall_time_s": round(sum(stage["wall_time_s"] for stage in self.stages
+                                               if stage["depth"] == 0), 4),
+                "total_cpu_time_s": round(sum(stage["cpu_time_s"] for stage in self.stages
+                                              if stage["depth"] == 0), 4),
+                "peak_rss_mb": peakRSS(),
+                "stages": self.stages
+            }
+            with open(self.report_path, 'w') as fh:
+                json.dump(report, fh, indent=2, default=float)
+            status = 0
+
+        except Exception as e:
+            print("Error: %s" % e)
+
+        return status
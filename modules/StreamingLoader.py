@@ -0,0 +1,163 @@
+import pandas as pd
+
+from modules.DatasetCleaning import applyDatatypePlan, planDatatypes, writeMemoryReport, writeMissingValuesReport
+from modules.StageProfiler import profileStage
+
+
+# Data types applied to the attributes while parsing the CSV file.
+# Numeric attributes which may contain missing values cannot be parsed directly into unsigned integers,
+# so they are parsed into narrow floats and downcast after the missing values are dropped from each chunk.
+# Latitude and longitude keep the full precision, as they are used for geospatial operations.
+# All the remaining attributes from attributes.txt are parsed as strings (object).
+PARSE_DTYPES = {
+    "Latitude": "float64",
+    "Longitude": "float64",
+    "Number_of_Casualties": "float32",
+    "Number_of_Vehicles": "float32",
+    "Speed_limit": "float32",
+    "Year": "float32"
+}
+
+# Only empty fields are treated as missing values. Strings such as "None" are valid categories of the accidents
+# data (e.g. Carriageway_Hazards, Special_Conditions_at_Site) and must not be parsed as NaN.
+NA_VALUES = [""]
+
+
+class StreamingLoader:
+    def __init__(self, filename, attributesFile, chunksize=250_000):
+        """
+        A class for loading the accidents dataset chunk by chunk, so that the whole raw CSV file never has to be
+        held in memory. Only the attributes listed in the attributes file are parsed, the narrow data types are
+        applied during parsing and the records with missing values are dropped from each chunk.
+        :param filename: path to the CSV file with accidents data
+        :param attributesFile: path to the text file with names of attributes selected for the analysis
+        :param chunksize: number of records parsed at once
+        """
+        self.filename = filename
+        self.chunksize = chunksize
+        self.dataset = None
+
+        # read the attributes names which must be included in the analysis
+        self.attributes = []
+        with open(attributesFile, 'r') as fh:
+            for line in fh.readlines():
+                attribute = line.strip()
+                if attribute:
+                    self.attributes.append(attribute)
+
+        # frequencies of missing values for each attribute and the number of records before dropping them,
+        # collected while streaming so that the report on missing values does not require the raw dataset.
+        self.missing_values = dict(zip(self.attributes, [0] * len(self.attributes)))
+        self.n_records = 0
+
+        # memory of the attributes of the kept chunks before and after converting their data types and the parsed
+        # data types, collected while streaming for the memory report
+        self.memory_before = None
+        self.memory_after = None
+        self.parsed_dtypes = None
+
+    @profileStage("dataset")
+    def loadDataset(self):
+        """
+        A method for streaming the CSV file into memory. Each chunk contains only the selected attributes,
+        its records with missing values are removed and its attributes are converted to compact data types before
+        it is kept, so the peak memory stays close to the size of the final, optimized dataset.
+        Sets the dataset field to the loaded dataset.
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+        status = -1
+
+        try:
+            dtypes = {}
+            for attribute in self.attributes:
+                dtypes[attribute] = PARSE_DTYPES.get(attribute, "object")
+
+            chunks = []
+            reader = pd.read_csv(self.filename, usecols=self.attributes, dtype=dtypes, chunksize=self.chunksize,
+                                 keep_default_na=False, na_values=NA_VALUES)
+            for chunk in reader:
+                self.n_records += len(chunk)
+                for column, n_nans in chunk.isnull().sum().items():
+                    self.missing_values[column] += int(n_nans)
+
+                chunk.dropna(axis=0, how="any", inplace=True)
+                if len(chunk) == 0:
+                    continue
+
+                # compact data types of the chunk, planned as in DatasetCleaning.optimizeDatatypes(): categorical
+                # and Arrow strings, the minute of the day and the narrowest integers
+                before = chunk.memory_usage(index=False, deep=True)
+                if self.parsed_dtypes is None:
+                    self.parsed_dtypes = chunk.dtypes.astype(str)
+                applyDatatypePlan(chunk, planDatatypes(chunk))
+                after = chunk.memory_usage(index=False, deep=True)
+                self.memory_before = before if self.memory_before is None else self.memory_before + before
+                self.memory_after = after if self.memory_after is None else self.memory_after + after
+
+                # keep the order of attributes from the attributes file, the same as
+                # DatasetCleaning.selectAttributes()
+                chunks.append(chunk[self.attributes])
+
+            # the chunks keep the row labels of the CSV file, so the index is the same as for the dataset read at once
+            self.dataset = pd.concat(self.unifyCategories(chunks))
+            status = 0
+
+        except Exception as e:
+            print("Error: %s" % e)
+
+        return status
+
+    @staticmethod
+    def unifyCategories(chunks):
+        """
+        Give every categorical attribute the same categories in all the chunks, so that it stays categorical
+        when the chunks are concatenated.
+        :param chunks: list of DataFrames
+        :return: list of DataFrames
+        """
+        for column in chunks[0].columns:
+            if not any(isinstance(chunk[column].dtype, pd.CategoricalDtype) for chunk in chunks):
+                continue
+            categories = pd.Index(sorted(set().union(*[chunk[column].unique() for chunk in chunks])))
+            for chunk in chunks:
+                chunk[column] = chunk[column].astype(pd.CategoricalDtype(categories))
+        return chunks
+
+    def reportMemory(self, report_path="reports/Memory-report.txt"):
+        """
+        A method for generating a report on memory of the attributes as parsed and after converting them
+        to compact data types while streaming. The report has the same format as the one generated by
+        DatasetCleaning.optimizeDatatypes().
+        :param report_path: path of the report text file
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+        status = -1
+
+        try:
+            plan = {column: (self.parsed_dtypes[column], str(self.dataset[column].dtype))
+                    for column in self.dataset.columns}
+            writeMemoryReport(self.memory_before[self.dataset.columns], self.memory_after[self.dataset.columns],
+                              plan, report_path)
+            status = 0
+
+        except Exception as e:
+            print("Error: %s" % e)
+
+        return status
+
+    def reportMissingValues(self):
+        """
+        A method for generating a report on missing values found in the dataset while streaming it.
+        The report has the same format as the one generated by DatasetCleaning.reportMissingValues().
+        :return: status if successful (0) or unsuccessful (-1)
+        """
+        status = -1
+
+        try:
+            writeMissingValuesReport(self.missing_values, self.n_records)
+            status = 0
+
+        except Exception as e:
+            print("Error: %s" % e)
+
+        return status
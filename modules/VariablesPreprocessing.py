@@ -1,13 +1,104 @@
 import sys
 import os
+import operator
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 from pyproj import CRS
-from tqdm import tqdm
+
+from modules.DistrictAssignment import DistrictAssignment
+from modules.DistrictCache import DistrictCache
+from modules.GeoPackageWriter import GeoPackageWriter
+from modules.StageProfiler import profileStage
+
+# Recoding of the categorical classes, applied by formatVariables() after renaming the attributes.
+# Every attribute is recoded in a single vectorized pass to a compact integer (uint8) code using one of the rules:
+#   "map": original class -> code, classes (and missing values) not in the map get the "default" code;
+#          without the "default" code all the classes must be mapped,
+#   "conditions": list of (comparison, threshold) checked in order, the first satisfied gives its position as the
+#          code, values satisfying none of them get the "default" code,
+#   "clip": the maximal code, larger values are clipped to it.
+RECODING = {
+    "road_class": {"map": {'A': 0, 'B': 1, 'C': 2, "A(M)": 0, "Motorway": 0, "Unclassified": 3}},
+    "severity": {"map": {"Slight": 0, "Serious": 1, "Fatal": 2}},
+    "hazards": {"map": {"None": 0}, "default": 1},
+    "junction": {"map": {"Not at junction or within 20 metres": 0}, "default": 1},
+    "dark": {"map": {"Daylight": 0}, "default": 1},
+    "vehicles": {"clip": 5},
+    "wet": {"map": {"Dry": 0, "Data missing or out of range": 0}, "default": 1},
+    "road_type": {"map": {"Single carriageway": 0, "Dual carriageway": 1}, "default": 2},
+    "special": {"map": {"None": 0}, "default": 1},
+    "speed": {"conditions": [(operator.le, 30), (operator.lt, 60)], "default": 2},
+    "urban": {"map": {"Rural": 0, "Urban": 1, "Unallocated": 1}},
+    "weather": {"map": {"Fine no high winds": 0, "Unknown": 0, "Data missing or out of range": 0}, "default": 1}
+}
+
+
+def recodeAttribute(values, rule):
+    """
+    Recode values of a single attribute to compact integer codes according to a rule from the RECODING table.
+    String attributes are recoded through their categorical codes, so the rule is evaluated once per class
+    instead of once per record.
+    :param values: Series with values of the attribute
+    :param rule: recoding rule (dictionary with "map", "conditions" or "clip" key)
+    :return: numpy array of uint8 codes
+    """
+    default = rule.get("default")
+
+    if "map" in rule:
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            categorical = values.array
+        else:
+            categorical = pd.Categorical(values)
+
+        # lookup table of codes for every class, the last element is used for missing values (categorical code -1)
+        classes = list(categorical.categories) + [np.nan]
+        lookup = [rule["map"].get(category, default) for category in classes]
+
+        # classes which occur in the data but cannot be recoded
+        present = np.zeros(len(classes), dtype=bool)
+        present[categorical.codes] = True
+        unmapped = [category for category, code, p in zip(classes, lookup, present) if (code is None) & p]
+        if len(unmapped) > 0:
+            raise ValueError("Classes without a code: %s" % unmapped)
+
+        lookup = np.array([0 if code is None else code for code in lookup], dtype="uint8")
+        return lookup[categorical.codes]
+
+    elif "conditions" in rule:
+        array = values.to_numpy()
+        condlist = [comparison(array, threshold) for comparison, threshold in rule["conditions"]]
+        return np.select(condlist, range(len(condlist)), default).astype("uint8")
+
+    else:
+        return np.minimum(values.to_numpy(), rule["clip"]).astype("uint8")
+
+
+def mergePartialAggregates(partials):
+    """
+    Merge partial aggregates (DataPreprocessing.partialAggregates()) of consecutive parts of the dataset.
+    Sums and counts of the same cells are added and strings concatenated in the order of the parts, so the merge
+    is associative and the merged aggregates of the parts equal the aggregates of the whole dataset.
+    The concatenated strings of the merged cells hold all the strings of the parts, so they are copied by every merge.
+    :param partials: list of partial aggregates in the order of the parts
+    :return: merged partial aggregates
+    """
+    merged = dict(partials[0])
+    merged["years"] = list(dict.fromkeys(year for partial in partials for year in partial["years"]))
+    merged["sums"] = pd.concat([partial["sums"] for partial in partials]).groupby(level=["year", "index"],
+                                                                                 sort=False).sum()
+    merged["counts"] = {}
+    for column in partials[0]["counts"]:
+        # classes missing in some of the parts have zero counts there
+        counts = pd.concat([partial["counts"][column] for partial in partials]).fillna(0)
+        counts = counts.groupby(level=["year", "index"], sort=False).sum().astype("int64")
+        merged["counts"][column] = counts[sorted(counts.columns)]
+    return merged
 
 
 class DataPreprocessing:
-    def __init__(self, dataset, districts_path="data/Local_authorities.shp", output_dir="data/", print_progress=False):
+    def __init__(self, dataset, districts_path="data/Local_authorities.shp", output_dir="data/", print_progress=False,
+                 cache_dir="data/cache/", workers=1, districts=None):
         try:
 
             self.print_progress = print_progress
@@ -17,8 +108,19 @@ class DataPreprocessing:
             # Load accidents dataset from memory
             self.accidents_df = dataset
 
-            # Read local authorities (districts) data
-            self.districts = gpd.read_file(districts_path)
+            # Local authorities (districts) data, loaded from the district cache (built from the shapefile once)
+            # unless they are already loaded (e.g. for every partition of the out-of-core mode); districts is
+            # a DistrictCache or a GeoDataFrame, the simplified geometry of outputs needs the cache
+            if districts is None:
+                districts = DistrictCache(districts_path, directory=None if cache_dir is None
+                                          else os.path.join(cache_dir, "districts"))
+            self.district_cache = None
+            if isinstance(districts, DistrictCache):
+                if districts.load() != 0:
+                    raise ValueError("Districts cannot be loaded from %s" % districts.shapefile)
+                self.district_cache = districts
+                districts = districts.districts()
+            self.districts = districts
 
             # Store Lat and Lang attribute names for GeoDataFrame creation
             self.lat_lng = ["Latitude", "Longitude"]
@@ -29,10 +131,24 @@ class DataPreprocessing:
             # Output directory for aggregated data
             self.output_dir = output_dir
 
+            # Tidy (year, district) cube of aggregated data and the one-hot encoded classes,
+            # set by aggregateDistricts()
+            self.aggregated_df = None
+            self.dummy_classes = None
+
+            # Projected coordinates of accidents (n x 2 array), set by sjoinDistricts(keep_points=True)
+            self.point_coords = None
+            self.write_throughput = None
+
+            # Spatial index of districts, built once, with district codes of accidents persisted in cache_dir
+            # with workers > 1 the reprojection and the spatial join run in a pool of processes
+            self.district_assignment = DistrictAssignment(self.districts, cache_dir=cache_dir, workers=workers)
+
         except Exception as e:
             print("Error: %s" % e)
             sys.exit(-1)
 
+    @profileStage("accidents_df")
     def formatVariables(self):
         """
         Reformat merging categorical classes.
@@ -65,45 +181,16 @@ class DataPreprocessing:
             axis=1, inplace=True
         )
 
-        # Reformat variables
-        self.accidents_df.replace(
-            {
-                "road_class": {'A': 0, 'B': 1, 'C': 2, "A(M)": 0, "Motorway": 0, "Unclassified": 3},
-                "severity": {"Slight": 0, "Serious": 1, "Fatal": 2},
-                "hazards": {"None": 0},
-                "junction": {"Not at junction or within 20 metres": 0},
-                "dark": {"Daylight": 0},
-                "wet": {"Dry": 0, "Data missing or out of range": 0},
-                "road_type": {"Single carriageway": 0, "Dual carriageway": 1},
-                "special": {"None": 0},
-                # "speed": {30: 0, 60: 1},
-                "urban": {"Rural": 0, "Urban": 1, "Unallocated": 1},
-                "weather": {"Fine no high winds": 0, "Unknown": 0, "Data missing or out of range": 0}
-            },
-            inplace=True
-        )
-        self.accidents_df.loc[self.accidents_df["hazards"] != 0, "hazards"] = 1
-        self.accidents_df.loc[self.accidents_df["junction"] != 0, "junction"] = 1
-        self.accidents_df.loc[self.accidents_df["dark"] != 0, "dark"] = 1
-        self.accidents_df.loc[self.accidents_df["vehicles"] >= 5, "vehicles"] = 5
-        self.accidents_df.loc[self.accidents_df["wet"] != 0, "wet"] = 1
-        self.accidents_df.loc[
-            (self.accidents_df["road_type"] != 0) & (self.accidents_df["road_type"] != 1), "road_type"
-        ] = 2
-        self.accidents_df.loc[self.accidents_df["special"] != 0, "special"] = 1
-
-        self.accidents_df.loc[self.accidents_df["speed"] <= 30, "speed"] = 0
-        self.accidents_df.loc[
-            (self.accidents_df["speed"] > 30) & (self.accidents_df["speed"] < 60), "speed"
-            ] = 1
-        self.accidents_df.loc[self.accidents_df["speed"] >= 60, "speed"] = 2
-
-        self.accidents_df.loc[self.accidents_df["weather"] != 0, "weather"] = 1
-
+        # Records without speed limit cannot be assigned to any of the speed classes
         self.accidents_df.dropna(subset="speed", inplace=True)
 
+        # Reformat variables, one vectorized pass per attribute
+        for column, rule in RECODING.items():
+            self.accidents_df[column] = recodeAttribute(self.accidents_df[column], rule)
+
         return 0
 
+    @profileStage("accidents_df")
     def geoTransform(self):
         """
         Transform DataFrame to GeoDataFrame based on given geometry attributes
@@ -123,31 +210,47 @@ class DataPreprocessing:
 
         return 0
 
-    def sjoinDistricts(self):
+    @profileStage("accidents_df")
+    def sjoinDistricts(self, keep_points=False):
         """
         Join Accidents data with district (local authority) dataset
+        :param keep_points: whether to keep the coordinates of accidents in the CRS of districts in the point_coords
+        field (e.g. for the point-level hotspot analysis), as their geometry is replaced by the district polygons
         :return: 1 if successful
         """
         if self.print_progress:
             print("Joining with Local Authorities data")
 
-        # Spatial join of accident points (reprojected)
-        self.accidents_df = self.accidents_df.to_crs(27700).sjoin(
-            self.districts[["geometry", "LAD21NM"]], how="right", predicate="within"
+        # Code of the district each accident lies within (-1 if outside all of them),
+        # accident points are reprojected to the CRS of districts on the way; the projected coordinates
+        # (EPSG:27700) are kept on request only, in the order of accidents_df
+        assigned = self.district_assignment.assignDistricts(
+            self.accidents_df["Accident_Index"].to_numpy(), self.accidents_df[self.lat_lng[1]].to_numpy(),
+            self.accidents_df[self.lat_lng[0]].to_numpy(), self.accidents_df.crs, return_points=keep_points
         )
+        codes, self.point_coords = assigned if keep_points else (assigned, None)
 
-        # Set indices, drop nans, rename some of the columns
-        self.accidents_df.rename({"LAD21NM": "auth"}, axis=1, inplace=True)
-        # Drop nans as we performed the right outer join
-        self.accidents_df.dropna(subset=["index_left"], inplace=True)
-        self.accidents_df['index_left'] = self.accidents_df['index_left'].astype(int)
-        self.accidents_df.reset_index(inplace=True)
-        self.accidents_df.set_index("index_left", inplace=True)
-        self.accidents_df.index.rename("", inplace=True)
+        # Drop accidents outside the districts and the attributes which are not used anymore
         self.accidents_df.drop(["Latitude", "Longitude", "time"], axis=1, inplace=True)
-        self.accidents_df.sort_index(inplace=True)
-
-        # After spatial join operation, change numerical and categorical data types to int
+        if (codes < 0).any():
+            self.accidents_df = self.accidents_df.loc[codes >= 0]
+            if keep_points:
+                self.point_coords = self.point_coords[codes >= 0]
+            codes = codes[codes >= 0]
+
+        # Attach the district code, polygon and name to every accident
+        self.accidents_df.insert(0, "index", codes)
+        self.accidents_df.set_geometry(self.districts.geometry.values.take(codes), inplace=True)
+        self.accidents_df["auth"] = self.districts["LAD21NM"].to_numpy()[codes]
+        self.accidents_df.index.rename("", inplace=True)
+        if not self.accidents_df.index.is_monotonic_increasing:
+            order = np.argsort(self.accidents_df.index.to_numpy(), kind="stable")
+            self.accidents_df = self.accidents_df.iloc[order]
+            if keep_points:
+                self.point_coords = self.point_coords[order]
+
+        # After spatial join operation, change numerical data types to int
+        # (categorical attributes are already compact integer codes after formatVariables)
         self.num_attributes = [
             "index", "casualties"
         ]
@@ -158,42 +261,140 @@ class DataPreprocessing:
         self.group_attributes = [
             "geometry", "year", "auth"
         ]
-        self.accidents_df[self.num_attributes + self.cat_attributes] = \
-            self.accidents_df[self.num_attributes + self.cat_attributes].astype("int")
+        self.accidents_df[self.num_attributes] = self.accidents_df[self.num_attributes].astype("int")
 
         return 0
 
-    def aggregateDistricts(self, save=False, return_list=False):
+    @profileStage("accidents_df", "aggregated_df")
+    def aggregateDistricts(self, save=False, return_list=False, dummy_classes=None, save_mode="files",
+                           save_workers=1, geometry_variant="full"):
         """
         Groups data by year,county keys and aggregates attributes by sum.
+        All the years are aggregated in a single pass into a tidy (year, district) cube stored in the aggregated_df
+        field, geometry of districts is attached only to the yearly GeoDataFrames.
+        The partial aggregates of the accidents (see partialAggregates()) are finalized by aggregatePartials(),
+        the same as the merged partial aggregates of the partitions of the out-of-core mode (PartitionedPipeline).
         :param save: whether to save aggregated data (GeoPackage format)
         :param return_list: whether to return list of aggregated GeoDataFrames
+        :param dummy_classes: classes of categorical attributes to one-hot encode, e.g. {"speed": [1, 2]};
+        by default these are the classes found in the first year, without the first class of each attribute.
+        The classes used are stored in the dummy_classes field.
+        :param save_mode: "files" (aggregated_YYYY.gpkg), "layers" or "long" (a single aggregated.gpkg),
+        see GeoPackageWriter; the throughput of saving is stored in the write_throughput field
+        :param save_workers: number of worker processes saving the files of the "files" mode
+        :param geometry_variant: geometry of districts attached to the outputs, "full" or a simplified variant
+        of the district cache (e.g. "medium", see DistrictCache)
         :return: list of GeoDataFrames aggregated by year and district (local authority)
         """
         if self.print_progress:
             print("Aggregating data")
 
-        # Create a list of dataframes for each year
-        years = list(self.accidents_df.year.unique().astype(int))
-        dfs_agg = []
-        for y in years:
-            dfs_agg.append(self.accidents_df.loc[self.accidents_df['year'] == y])
+        return self.aggregatePartials(self.partialAggregates(), save, return_list, dummy_classes, save_mode,
+                                      save_workers, geometry_variant)
 
-        # Define aggregation scheme (dictionary) based on one of yearly datasets
-        one_hot = pd.get_dummies(dfs_agg[0], columns=self.cat_attributes, drop_first=True)
-        to_sum = [x for x in list(one_hot.columns) if x not in self.group_attributes + self.num_attributes]
-        agg_dict = dict(zip(to_sum, ["sum"] * len(to_sum)))
-        agg_dict["casualties"] = "sum"
-        agg_dict.update(dict(zip(self.group_attributes, ["first"] * 3)))
+    def partialAggregates(self):
+        """
+        Aggregate the accidents into (year, district) cells, keeping the counts of all the classes of categorical
+        attributes, so the aggregates of separate parts of the dataset can be merged (mergePartialAggregates()).
+        :return: dictionary with
+            "years" - years in the order of their appearance,
+            "sums" - DataFrame indexed by (year, index) with the sums of attributes (strings are concatenated),
+            "counts" - dictionary of categorical attribute -> DataFrame with the counts of its classes in cells,
+            "sum_columns", "num_columns" - attributes summed before and after the one-hot encoded ones,
+            "year_dtype" - data type of the year attribute
+        """
+        # Years in the order of their appearance and the (year, district) cell of every accident
+        years = list(self.accidents_df.year.unique().astype(int))
+        n_districts = len(self.districts)
+        year_positions = pd.Index(years).get_indexer(self.accidents_df["year"].to_numpy().astype(int))
+        cell = year_positions.astype("int64") * n_districts + self.accidents_df["index"].to_numpy()
+
+        # Cells with at least one accident (sorted by year position, then district) and the cell of each accident
+        cells, inverse = np.unique(cell, return_inverse=True)
+        index = pd.MultiIndex.from_arrays([np.array(years)[cells // n_districts],
+                                           (cells % n_districts).astype("int64")], names=["year", "index"])
+
+        # Attributes summed as they are and the numerical attributes apart from the district code
+        sum_columns = [x for x in self.accidents_df.columns
+                       if x not in self.cat_attributes + self.group_attributes + self.num_attributes]
+        num_columns = [x for x in self.num_attributes if x != "index"]
+        sums = {}
+        for column in sum_columns + num_columns:
+            sums[column] = self.sumCells(self.accidents_df[column], inverse, len(cells))
+
+        counts = {}
+        for column in self.cat_attributes:
+            # one pass over the attribute: counts of all its classes in every cell
+            codes, classes = pd.factorize(self.accidents_df[column], sort=True)
+            class_counts = np.bincount(inverse * len(classes) + codes, minlength=len(cells) * len(classes))
+            counts[column] = pd.DataFrame(class_counts.reshape(len(cells), len(classes)), index=index,
+                                          columns=classes.tolist())
+
+        return {"years": years, "sums": pd.DataFrame(sums, index=index), "counts": counts,
+                "sum_columns": sum_columns, "num_columns": num_columns,
+                "year_dtype": self.accidents_df["year"].dtype}
+
+    def aggregatePartials(self, partial, save=False, return_list=False, dummy_classes=None, save_mode="files",
+                          save_workers=1, geometry_variant="full"):
+        """
+        Build the tidy (year, district) cube and the yearly GeoDataFrames from partial aggregates
+        (see aggregateDistricts() for the parameters).
+        """
+        # Cells sorted by the position of their year, then district
+        years = partial["years"]
+        year_positions = pd.Index(years).get_indexer(partial["sums"].index.get_level_values("year"))
+        order = np.lexsort((partial["sums"].index.get_level_values("index").to_numpy(), year_positions))
+        sums = partial["sums"].iloc[order]
+        cell_years = year_positions[order]
+        cell_districts = sums.index.get_level_values("index").to_numpy()
+
+        # Aggregation scheme based on the first year: attributes summed as they are, one-hot encoded categorical
+        # attributes (their first class is dropped) and the numerical attributes apart from the district code
+        first_year = cell_years == 0
+        aggregated = {}
+        for column in partial["sum_columns"]:
+            aggregated[column] = sums[column].to_numpy()
+        self.dummy_classes = {}
+        for column, counts in partial["counts"].items():
+            counts = counts.reindex(partial["sums"].index).iloc[order]
+            classes = counts.columns.tolist()
+            if dummy_classes is None:
+                present = counts.to_numpy()[first_year].sum(axis=0) > 0
+                self.dummy_classes[column] = [category for category, p in zip(classes, present) if p][1:]
+            else:
+                self.dummy_classes[column] = list(dummy_classes[column])
+            for category in self.dummy_classes[column]:
+                if category in classes:
+                    aggregated[f"{column}_{category}"] = counts[category].to_numpy()
+                else:
+                    aggregated[f"{column}_{category}"] = np.zeros(len(sums), dtype="int64")
+        for column in partial["num_columns"]:
+            aggregated[column] = sums[column].to_numpy()
+
+        # Tidy (year, district) cube of the aggregated attributes
+        self.aggregated_df = pd.DataFrame(
+            aggregated,
+            index=pd.MultiIndex.from_arrays([np.array(years)[cell_years], cell_districts.astype("int64")],
+                                            names=["year", "index"])
+        )
 
-        # Aggregate data
+        # Attach geometry and name of districts at the end, one GeoDataFrame per year
         uk_crs = CRS("EPSG:27700")
-        for i in range(len(dfs_agg)):
-            one_hot = pd.get_dummies(dfs_agg[i], columns=self.cat_attributes, drop_first=True)
-            one_hot["casualties"] = self.accidents_df["casualties"]
-            dfs_agg[i] = gpd.GeoDataFrame(
-                one_hot.groupby("index").agg(agg_dict), crs=uk_crs, geometry="geometry"
-            )
+        geometry = self.districts.geometry.values
+        if geometry_variant != "full":
+            if self.district_cache is None:
+                raise ValueError("Simplified geometry of districts needs the district cache")
+            geometry = self.district_cache.geometryValues(geometry_variant)
+        year_dtype = partial["year_dtype"]
+        dfs_agg = []
+        for i in range(len(years)):
+            rows = cell_years == i
+            districts = cell_districts[rows]
+            df_agg = self.aggregated_df.iloc[rows].reset_index(level="year", drop=True)
+            df_agg["geometry"] = geometry.take(districts)
+            df_agg["year"] = np.full(len(districts), years[i], dtype=year_dtype)
+            df_agg["auth"] = self.districts["LAD21NM"].to_numpy()[districts]
+            dfs_agg.append(gpd.GeoDataFrame(df_agg, crs=uk_crs, geometry="geometry"))
 
         # Save aggregated data
         if save:
@@ -205,17 +406,45 @@ class DataPreprocessing:
             if self.print_progress:
                 print("Saving aggregated data")
 
-            # Save yearly datasets
+            # Save yearly datasets, as files (in parallel with more workers), layers of a single file or a long table
             print(dfs_agg[0].columns)
-            for d, y in tqdm(zip(dfs_agg, years)):
-
-                d.to_file(self.output_dir + f"aggregated_{y}.gpkg", driver="GPKG")
+            writer = GeoPackageWriter(self.output_dir, mode=save_mode, workers=save_workers)
+            # a failed write stops the run (as GeoDataFrame.to_file() did), so the panel and the manifest of
+            # the incremental runs are never updated for outputs which do not exist
+            if writer.writeYears(dfs_agg, years) != 0:
+                raise IOError("Saving the aggregated data to %s failed" % self.output_dir)
+            self.write_throughput = writer.throughput
 
         if return_list:
             return dfs_agg
         else:
             return 0
 
+    @staticmethod
+    def sumCells(values, inverse, n_cells):
+        """
+        Sum values of an attribute within (year, district) cells.
+        Numerical attributes are summed with a weighted bincount, other attributes (e.g. strings) are concatenated
+        in the order of records, which is the result of summing them with pandas.
+        :param values: Series with values of the attribute
+        :param inverse: numpy array with the cell of every record
+        :param n_cells: number of cells
+        :return: numpy array of sums for every cell
+        """
+        if pd.api.types.is_numeric_dtype(values.dtype):
+            sums = np.bincount(inverse, weights=values.to_numpy(), minlength=n_cells)
+            if pd.api.types.is_integer_dtype(values.dtype):
+                sums = np.rint(sums).astype("int64")
+            return sums
+
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.searchsorted(inverse[order], np.arange(n_cells + 1))
+        values = values.to_numpy()[order]
+        sums = np.empty(n_cells, dtype=object)
+        for i in range(n_cells):
+            sums[i] = "".join(values[bounds[i]:bounds[i + 1]])
+        return sums
+
 
 # Example:
 # dp = DataPreprocessing(print_progress=True)
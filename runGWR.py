@@ -1,9 +1,12 @@
 import geopandas as gpd
 from modules.AnalyzeGWR import AnalyzeGWR
+from modules.DistrictCache import DistrictCache
+from modules.GWRResultStore import GWRResultStore
+from modules.StageProfiler import StageProfiler
 
 target = ["casualties"]
 
-independent_variables = ['weather_0', 'weather_1']
+independent_variables = ['weather_1', 'dark_1']
 # 'road_class_0', 'road_class_1', 'road_class_2', 'road_class_3',
 #                          'severity_0', 'severity_1', 'severity_2', 'hazards_0', 'hazards_1',
 #                          'junction_0', 'junction_1', 'dark_0', 'dark_1', 'vehicles_1',
@@ -13,8 +16,26 @@ independent_variables = ['weather_0', 'weather_1']
 
 
 
-gwr = AnalyzeGWR("data/normalized.gpkg", target, independent_variables)
+# every stage records its wall time, CPU time, memory and rows to the JSON run report
+profiler = StageProfiler("reports/GWR-report.json")
+profiler.activate()
+
+# centroids of districts are taken from the district cache, built from the shapefile on the first run
+districts = DistrictCache("data/Local_authorities.shp")
+gwr = AnalyzeGWR("data/normalized.gpkg", target, independent_variables, districts=districts)
 gwr.calibrateRegression()
 gwr.fitRegression()
 results = gwr.results
-print(results.summary())
\ No newline at end of file
+print(results.summary())
+
+# the fitted model is stored, so follow-up analyses load it instead of calibrating again
+store = GWRResultStore("reports/GWR-results.npz")
+store.storeResults(gwr)
+store.saveCoefficients("data/gwr_coefficients.gpkg", districts=districts, variant="medium")
+
+# what-if: predicted casualties of all the districts with 10% and 20% fewer accidents in bad weather
+what_if = store.whatIf({"weather_down_10": {"weather_1": 0.9}, "weather_down_20": {"weather_1": 0.8}})
+print(what_if.describe().to_string())
+
+profiler.saveReport()
+profiler.deactivate()
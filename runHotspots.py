@@ -0,0 +1,24 @@
+from modules.DatasetCache import DatasetCache
+from modules.HotspotAnalysis import HotspotAnalysis
+from modules.VariablesPreprocessing import DataPreprocessing
+
+# the cleaned dataset cached by Main.py
+cache = DatasetCache("data/Accident_Information.csv", "attributes.txt")
+cache.loadDataset()
+
+# accidents located in the districts, keeping their coordinates in EPSG:27700
+dp = DataPreprocessing(cache.dataset)
+dp.formatVariables()
+dp.geoTransform()
+dp.sjoinDistricts(keep_points=True)
+
+# 1 km density grid with 5 km quartic kernel, Gi* over 5 km hexagons and their adjacent hexagons
+hotspots = HotspotAnalysis(dp.point_coords, dp.accidents_df["year"].to_numpy(), crs=dp.districts.crs,
+                           cell_size=1000)
+hotspots.kernelDensity(bandwidth=5000)
+hotspots.getisOrd(shape="hex", size=5000)
+hotspots.saveDensityRasters("data/hotspots/")
+hotspots.saveHotspots("data/hotspots/hotspots.gpkg")
+for year, statistics in hotspots.hotspots.items():
+    print(year, "hot spots (99 %%): %d, cold spots (99 %%): %d" % ((statistics["hotspot"] == 3).sum(),
+                                                                 (statistics["hotspot"] == -3).sum()))
@@ -0,0 +1,26 @@
+from modules.DistrictCache import DistrictCache
+from modules.ModelRunner import ModelRunner
+from modules.StageProfiler import StageProfiler
+
+target = "casualties"
+
+# every variable set is a GWR model, unless the model is given as "MGWR"
+variable_sets = [
+    ['weather_1'],
+    ['weather_1', 'dark_1', 'wet_1'],
+    ['speed_1', 'speed_2', 'urban_1'],
+    ['road_class_1', 'road_class_2', 'road_class_3', 'junction_1', 'road_type_1', 'road_type_2'],
+    {"name": "mgwr_conditions", "model": "MGWR", "variables": ['weather_1', 'dark_1', 'wet_1']}
+]
+
+# every stage records its wall time, CPU time, memory and rows to the JSON run report
+profiler = StageProfiler("reports/Models-report.json")
+profiler.activate()
+
+runner = ModelRunner("data/normalized.gpkg", target, workers=4, districts=DistrictCache("data/Local_authorities.shp"))
+runner.runModels(variable_sets)
+runner.saveComparison("reports/Model-comparison.csv")
+print(runner.comparison.to_string())
+
+profiler.saveReport()
+profiler.deactivate()
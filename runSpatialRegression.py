@@ -0,0 +1,19 @@
+from modules.SpatialDiagnostics import SpatialDiagnostics
+
+target = "casualties"
+
+independent_variables = ['road_class_1', 'road_class_2', 'road_class_3', 'hazards_1', 'junction_1', 'dark_1',
+                         'vehicles_2', 'vehicles_3', 'vehicles_4', 'vehicles_5', 'wet_1', 'road_type_1',
+                         'road_type_2', 'speed_1', 'speed_2']
+
+# queen contiguity, row-standardized weights (as poly2nb(queen=TRUE) and nb2listw(style="W") in R)
+diagnostics = SpatialDiagnostics("data/normalized.gpkg", target, independent_variables, queen=True)
+diagnostics.buildWeights()
+diagnostics.fitOLS()
+diagnostics.moranTest(permutations=999)
+diagnostics.fitLagModel()
+diagnostics.fitErrorModel()
+diagnostics.saveResults("reports/Spatial-diagnostics.json")
+print(diagnostics.results["moran"])
+print("AIC OLS: %.2f, lag: %.2f, error: %.2f" % (diagnostics.results["ols"]["aic"], diagnostics.results["lag"]["aic"],
+                                                 diagnostics.results["error"]["aic"]))